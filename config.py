@@ -60,6 +60,7 @@ def load_app_config():
         'p2p': {
             'data_dir': './data_hardcoded',
             'listen_port': 1989,
+            'mining_workers': 1,
         }
     }
 
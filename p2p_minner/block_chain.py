@@ -1,57 +1,138 @@
 """
     这里模拟pow进行p2p挖矿。包含简单的节点发现，节点管理。
-    简化挖矿逻辑，只对区块的难度做验证，没有考虑重组的问题。
+    简化挖矿逻辑，只对区块的难度做验证。侧链保存在区块树中，按累计工作量选择主链并做增量重组。
 """
 import datetime
-import io
 import logging
 import hashlib
 import struct
 import time
 import base64
+import os
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from threading import Event
-from typing import List
+from typing import List, Dict
 
-from jsonschema.validators import create
-
-from config import setup_logging
+from p2p_minner.chain_analytics import ChainColumns, run_analytics_command
+from p2p_minner.mining_telemetry import MiningTelemetry
+from p2p_minner.orphan_pool import OrphanPool
+from p2p_minner.mempool import Mempool, MAX_MEMPOOL_BYTES, MAX_BLOCK_TXS, MAX_BLOCK_BYTES
+from p2p_minner.ledger import RewardLedger, block_reward, check_coinbase
+from p2p_minner.transaction import ZERO_HASH, TX_COUNT_LEN, MAX_ADDRESS_LEN, MAX_AMOUNT, Transaction, merkle_root, serialize_transactions, deserialize_transactions
+from config import setup_logging, load_app_config, BLOCK_STATUS_VALID, BLOCK_STATUS_FORK, BLOCK_STATUS_INVALID, \
+    ADJUSTMENT_INTERVAL, TARGET_TIMESPAN
 
 log = logging.getLogger(__name__)
 
+# prev_hash + merkle_root + nonce + bits + timestamp + height
+BLOCK_BIN_FORMAT = '<32s32sI4sII'
+BLOCK_BIN_LEN = struct.calcsize(BLOCK_BIN_FORMAT)
+MERKLE_ROOT_OFFSET = 32 # merkle_root在区块头中的偏移
+NONCE_OFFSET = 64 # nonce在区块头中的偏移，前面的64字节正好是sha256的一个分组，挖矿时只算一次
+BITS_OFFSET = 68 # bits在区块头中的偏移
+MAX_NONCE = 0xFFFFFFFF
+_NONCE_STRUCT = struct.Struct('<I')
+
+MAX_TARGET = (1 << 256) - 1
+# bits来自其它节点，缓存要有上限。一条链每个难度调整周期只有一个bits，256个足够
+BITS_CACHE_SIZE = 256
+
+@lru_cache(maxsize=BITS_CACHE_SIZE)
+def compact_to_target(bits:bytes):
+    """
+        把4字节的compact bits展开为256位的目标值，同比特币nBits:
+        第一个字节为指数(目标值的字节数)，后3个字节为尾数，target = 尾数 * 256^(指数-3)。
+        最近用到的bits只计算一次
+    """
+    compact = int.from_bytes(bits,byteorder='big')
+    exponent = compact >> 24
+    mantissa = compact & 0x007fffff
+    if compact & 0x00800000:
+        # 负数的目标值无效
+        return 0
+    if exponent <= 3:
+        return mantissa >> (8 * (3 - exponent))
+    return min(mantissa << (8 * (exponent - 3)), MAX_TARGET)
+
+def target_to_compact(target:int):
+    # 256位的目标值压缩为4字节的compact bits，会丢掉尾数之后的精度
+    size = (target.bit_length() + 7) // 8
+    if size <= 3:
+        mantissa = target << (8 * (3 - size))
+    else:
+        mantissa = target >> (8 * (size - 3))
+    if mantissa & 0x00800000:
+        # 最高位是符号位，尾数右移一个字节
+        mantissa >>= 8
+        size += 1
+    return ((size << 24) | mantissa).to_bytes(4,byteorder='big')
+
+@lru_cache(maxsize=BITS_CACHE_SIZE)
+def pow_target_bytes(bits:bytes):
+    # 32字节大端的目标值，hash <= 目标值 为有效，直接用bytes比较
+    return compact_to_target(bits).to_bytes(32,byteorder='big')
+
 def int_to_bytes(i:int):
     # 统一int为8个字节
     return i.to_bytes(length=4,byteorder="little")
 
 class Block:
-    BLOCK_BIN_FORMAT = '<32sI4sII'
-    DEFAULT_BITS = bytes.fromhex("000000a8") # 这里的难度代码要运算的次数，即hash前面N的个数.比如4代表前四个字节0x00000a8才符合要求，要计算255^3才有可能。
-    BLOCK_BIN_LEN = 64
+    """
+        已经确定的区块，创建后不要再修改字段。序列化结果和hash只计算一次并缓存，
+        用__slots__去掉每个实例的__dict__。挖矿时需要改nonce的用BlockTemplate。
+        区块头中只有交易的merkle_root，transactions为None表示只有区块头(同步区块头时)。
+    """
+    __slots__ = ('prev_hash','merkle_root','nonce','bits','timestamp','height','transactions','_bin','_hash')
+    BLOCK_BIN_FORMAT = BLOCK_BIN_FORMAT
+    DEFAULT_BITS = bytes.fromhex("1e00a800") # compact格式的难度，目标值为0xa8 << 224，即hash前三个字节为0，第四个字节不超过0xa8，大约要计算255^3次。
+    BLOCK_BIN_LEN = BLOCK_BIN_LEN
     prev_hash:bytes
     bits: bytes
     timestamp: int
     nonce:int
     height:int # 区块高度
+    merkle_root:bytes
 
-    def __init__(self,prev_hash,nonce,bits,timestamp,height):
+    def __init__(self,prev_hash,nonce,bits,timestamp,height,merkle_root=ZERO_HASH,transactions=None,_bin=None):
         self.prev_hash = prev_hash
+        self.merkle_root = merkle_root
+        self.transactions = transactions
         self.nonce= nonce
         self.bits = bits
         self.timestamp  = timestamp
         self.height = height
+        self._bin = _bin
+        self._hash = None
 
     def serialize(self):
         # 序列化 高度在真正的项目是不需要序列化的，因为有hash和位置就能算出高度了。
-        return struct.pack(Block.BLOCK_BIN_FORMAT,
-                           self.prev_hash,
-                           self.nonce,
-                           self.bits,
-                           self.timestamp,
-                           self.height
-                           )
+        if self._bin is None:
+            self._bin = struct.pack(Block.BLOCK_BIN_FORMAT,
+                                    self.prev_hash,
+                                    self.merkle_root,
+                                    self.nonce,
+                                    self.bits,
+                                    self.timestamp,
+                                    self.height
+                                    )
+        return self._bin
     @classmethod
     def deserialize(cls,byte_datas):
-        prev_hash,nonce,bits,timestamp,height = struct.unpack(Block.BLOCK_BIN_FORMAT,byte_datas)
-        return cls(prev_hash,nonce,bits,timestamp,height)
+        prev_hash,merkle_root,nonce,bits,timestamp,height = struct.unpack(Block.BLOCK_BIN_FORMAT,byte_datas)
+        return cls(prev_hash,nonce,bits,timestamp,height,merkle_root,_bin=bytes(byte_datas))
+
+    def serialize_full(self):
+        # 区块头 + 交易，转发新区块时使用
+        return self.serialize() + serialize_transactions(self.transactions or [])
+
+    @classmethod
+    def deserialize_full(cls,byte_datas):
+        block = cls.deserialize(byte_datas[:BLOCK_BIN_LEN])
+        block.transactions = deserialize_transactions(byte_datas,BLOCK_BIN_LEN)
+        return block
     def to_b64(self):
         return base64.b64encode(self.serialize()).decode('utf8')
 
@@ -60,32 +141,209 @@ class Block:
         return Block.deserialize(base64.b64decode(block_b64))
 
     def hash(self):
-        # 计算区块hash
-        return hashlib.sha256(self.serialize()).digest()
+        # 计算区块hash，只计算一次
+        if self._hash is None:
+            self._hash = hashlib.sha256(self.serialize()).digest()
+        return self._hash
+
+    def pow_target(self):
+        # 挖矿内核直接用这个值比较
+        return pow_target_bytes(self.bits)
 
     def is_validate(self):
         # 验证是否是有效的区块,这里只验证hash的pow是否合法
          # 计算pow
-        if   self.hash() > self.bits :
+        if   self.hash() > self.pow_target() :
             # log.debug(f'当前区块POW验证失败.应该为：{Block.DEFAULT_BITS},实际:{self.hash().hex()}')
             return False
         return True
 
+    def check_merkle_root(self):
+        # 只有区块头时不检查
+        if self.transactions is None:
+            return True
+        return merkle_root([tx.hash() for tx in self.transactions]) == self.merkle_root
+
+    def size(self):
+        # 序列化后的大小，有交易时包括交易
+        if self.transactions is None:
+            return BLOCK_BIN_LEN
+        return BLOCK_BIN_LEN + TX_COUNT_LEN + sum(tx.size() for tx in self.transactions)
+
+    def check_size(self):
+        # 交易数和序列化后的大小不超过上限，只有区块头时不检查
+        if self.transactions is None:
+            return True
+        return len(self.transactions) <= MAX_BLOCK_TXS and self.size() <= MAX_BLOCK_BYTES
+
     def __str__(self):
         return f"hash:{self.hash().hex()}, prev:{self.prev_hash.hex()},bits:{self.bits},nonce:{self.nonce},time:{datetime.datetime.fromtimestamp(self.timestamp)},height:{self.height}"
 
+class BlockTemplate:
+    """
+        挖矿用的可修改区块头，只给挖矿程序使用。找到nonce后用to_block生成不可修改的Block
+    """
+    __slots__ = ('prev_hash','merkle_root','nonce','bits','timestamp','height')
+
+    def __init__(self,prev_hash,nonce,bits,timestamp,height,merkle_root=ZERO_HASH):
+        self.prev_hash = prev_hash
+        self.merkle_root = merkle_root
+        self.nonce = nonce
+        self.bits = bits
+        self.timestamp = timestamp
+        self.height = height
+
+    @classmethod
+    def from_prev_block(cls,prev_block:Block,bits=None,merkle_root=ZERO_HASH):
+        # 以prev_block为父区块生成下一个区块的模板，bits为None时沿用父区块的难度
+        return cls(prev_block.hash(),0,bits or prev_block.bits,int(time.time()),prev_block.height + 1,merkle_root)
+
+    def serialize(self):
+        return struct.pack(BLOCK_BIN_FORMAT,self.prev_hash,self.merkle_root,self.nonce,self.bits,self.timestamp,self.height)
+
+    def pow_target(self):
+        return pow_target_bytes(self.bits)
+
+    def to_block(self,nonce=None,transactions=None):
+        if nonce is None:
+            nonce = self.nonce
+        return Block(self.prev_hash,nonce,self.bits,self.timestamp,self.height,self.merkle_root,transactions)
+
+@lru_cache(maxsize=BITS_CACHE_SIZE)
+def block_work(bits:bytes):
+    # 一个区块的工作量，即平均需要计算的hash次数
+    return (1 << 256) // (compact_to_target(bits) + 1)
+
+def _hash_header_chunk(data:bytes,check_pow=True):
+    """
+        计算一段连续区块头的hash并验证pow，批量导入时在进程池中运行
+    :return: (hash列表, 第一个pow不合格的区块在这段中的下标，全部合格为-1)
+    """
+    view = memoryview(data)
+    sha256 = hashlib.sha256
+    if not check_pow:
+        return [sha256(view[offset:offset + BLOCK_BIN_LEN]).digest() for offset in range(0, len(view), BLOCK_BIN_LEN)], -1
+    hashes = []
+    first_invalid = -1
+    for offset in range(0, len(view), BLOCK_BIN_LEN):
+        digest = sha256(view[offset:offset + BLOCK_BIN_LEN]).digest()
+        if first_invalid < 0 and digest > pow_target_bytes(bytes(view[offset + BITS_OFFSET:offset + BITS_OFFSET + 4])):
+            first_invalid = len(hashes)
+        hashes.append(digest)
+    return hashes, first_invalid
+
+def hash_headers(view:memoryview,workers=None,chunk_blocks=20000,assume_valid_count=0):
+    """
+        计算一段连续区块头的hash并验证pow，区块多时分块交给进程池并行计算
+    :param assume_valid_count: 前面这么多个区块在检查点之前，只计算hash不验证pow
+    :return: (hash列表, 第一个pow不合格的区块下标，全部合格为-1)
+    """
+    if assume_valid_count > 0:
+        split = assume_valid_count * BLOCK_BIN_LEN
+        hashes, _ = _hash_chunks(view[:split],workers,chunk_blocks,False)
+        suffix_hashes, first_invalid = _hash_chunks(view[split:],workers,chunk_blocks,True)
+        return hashes + suffix_hashes, first_invalid + assume_valid_count if first_invalid >= 0 else -1
+    return _hash_chunks(view,workers,chunk_blocks,True)
+
+def _hash_chunks(view:memoryview,workers,chunk_blocks,check_pow):
+    count = len(view) // BLOCK_BIN_LEN
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or count <= chunk_blocks:
+        return _hash_header_chunk(view,check_pow)
+    chunk_bytes = chunk_blocks * BLOCK_BIN_LEN
+    hashes = []
+    first_invalid = -1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunks = (bytes(view[offset:offset + chunk_bytes]) for offset in range(0, len(view), chunk_bytes))
+        for chunk_hashes, chunk_invalid in executor.map(_hash_header_chunk, chunks, itertools.repeat(check_pow)):
+            if first_invalid < 0 and chunk_invalid >= 0:
+                first_invalid = len(hashes) + chunk_invalid
+            hashes.extend(chunk_hashes)
+    return hashes, first_invalid
+
+def retarget_bits(bits:bytes,first_timestamp:int,last_timestamp:int,target_timespan:int):
+    """
+        按上一个周期的实际用时调整难度，用时限制在目标用时的1/4到4倍之间
+    :return: 新的bits
+    """
+    actual_timespan = last_timestamp - first_timestamp
+    actual_timespan = max(target_timespan // 4, min(actual_timespan, target_timespan * 4))
+    new_target = compact_to_target(bits) * actual_timespan // target_timespan
+    return target_to_compact(min(new_target, MAX_TARGET))
+
+def parse_checkpoints(items):
+    """
+        把配置中的检查点列表[{height:..,hash:..}]转换成 高度 -> 区块hash
+    """
+    return {int(item['height']): bytes.fromhex(item['hash']) for item in items or []}
+
+def locator_heights(first_height:int,tip_height:int):
+    """
+        block locator中区块的高度：从tip开始前10个连续，之后间隔每次翻倍，最后一个是创世区块。
+        链长为n时只有O(log n)个，对方用它可以找到和本地链的分叉点
+    """
+    heights = []
+    height, step = tip_height, 1
+    while height > first_height:
+        heights.append(height)
+        if len(heights) >= 10:
+            step *= 2
+        height -= step
+    heights.append(first_height)
+    return heights
+
+class BlockEntry:
+    """
+        区块树中的节点，记录区块、区块状态以及从创世区块到这个区块的累计工作量
+    """
+    __slots__ = ('block','status','chain_work')
+
+    def __init__(self,block:Block,status,chain_work):
+        self.block = block
+        self.status = status
+        self.chain_work = chain_work
+
 class BlockChain:
-    blocks:List[Block]
-    def __init__(self):
+    blocks:List[Block] # 主链
+    block_index:Dict[bytes,BlockEntry] # 区块hash -> 区块树节点，包含主链和侧链
+    height_index:Dict[int,bytes] # 主链区块高度 -> 区块hash
+    def __init__(self,genesis_bits=None,create_genesis=True,adjustment_interval=ADJUSTMENT_INTERVAL,target_timespan=TARGET_TIMESPAN,
+                 checkpoints=None,assume_valid=False):
         self.blocks = []
-        # 增加创世区块
-        self._init_genesis_block()
-    def check_chian(self):
+        self.block_index = {}
+        self.height_index = {}
+        # 创世区块的难度，测试时可以传入更低的难度
+        self.genesis_bits = genesis_bits or Block.DEFAULT_BITS
+        # 每adjustment_interval个区块按实际用时调整一次难度
+        self.adjustment_interval = adjustment_interval
+        self.target_timespan = target_timespan
+        # 本地区块存储(BlockStore)，为None时区块只保存在内存中
+        self.store = None
+        # 主链前validated_count个区块已经被check_chian检查过
+        self.validated_count = 0
+        # 检查点 高度 -> 区块hash，这些高度上只接受这个区块，也不接受从最后一个检查点之前分叉的区块
+        self.checkpoints = checkpoints or {}
+        self.last_checkpoint_height = max(self.checkpoints, default=0)
+        # assume-valid模式下，最后一个检查点及之前的区块只检查hash链接和检查点，不检查pow和难度
+        self.assume_valid_height = self.last_checkpoint_height if assume_valid else 0
+        # 父区块未知的孤块，父区块连接后跟着连接
+        self.orphan_pool = OrphanPool()
+        # 挖矿奖励账本，随主链区块的连接和断开更新
+        self.ledger = RewardLedger()
+        # 增加创世区块，从数据导入整条链时不需要
+        if create_genesis:
+            self._init_genesis_block()
+    def check_chian(self,full=False,workers=None):
         """
-            检查整个区块链条否有效
+            检查区块链条否有效。主链前validated_count个区块已经检查过，默认只检查之后新增的区块。
+            full=True时为审计模式，重新计算整条链的hash再检查，可以用多进程计算
         :return:
         """
-        for index, block in enumerate(self.blocks):
+        if full:
+            return self._audit_chian(workers)
+        for index in range(self.validated_count, len(self.blocks)):
+            block = self.blocks[index]
             if index == 0 :
                 if block.prev_hash != b'\x00' *32:
                     return False
@@ -93,10 +351,37 @@ class BlockChain:
                 prev_block = self.blocks[index - 1]
                 if block.prev_hash != prev_block.hash() :
                     return False
-                if block.bits != prev_block.bits:
-                    return False
-                if not block.is_validate():
-                    return False
+                if block.height > self.assume_valid_height:
+                    if block.bits != self.next_bits(self.block_index[block.prev_hash]):
+                        return False
+                    if not block.is_validate():
+                        return False
+            if not self.check_checkpoint(block):
+                return False
+            self.validated_count = index + 1
+        return True
+
+    def _audit_chian(self,workers=None):
+        """
+            不使用缓存的hash，重新计算主链的hash并检查pow、链接关系、难度和检查点。
+            在线程中运行，只检查开始时主链的快照，之后新增的区块由check_chian增量检查
+        """
+        blocks = list(self.blocks)
+        hashes, first_invalid = self._hash_headers(memoryview(b''.join([block.serialize() for block in blocks])),workers)
+        if first_invalid >= 0:
+            self.validated_count = min(self.validated_count,first_invalid)
+            return False
+        prev_hash = ZERO_HASH
+        for index, (block, block_hash) in enumerate(zip(blocks, hashes)):
+            if block.prev_hash != prev_hash or block.hash() != block_hash \
+                    or (prev_hash != ZERO_HASH and block.bits != self.next_bits(self.block_index[prev_hash])) \
+                    or not self.check_checkpoint(block):
+                self.validated_count = min(self.validated_count,index)
+                return False
+            prev_hash = block_hash
+        # 审计期间发生重组时快照已经不是主链的前缀，不更新
+        if blocks and self.is_main_chain(blocks[-1]):
+            self.validated_count = max(self.validated_count,len(hashes))
         return True
     def _init_genesis_block(self):
         """
@@ -104,138 +389,745 @@ class BlockChain:
         :return:
         """
         if not self.blocks:
-            genesis_block = Block(b"\x00"*32,bits= Block.DEFAULT_BITS,timestamp=int(time.time()),height=1,nonce=0)
+            genesis_template = BlockTemplate(b"\x00"*32,bits= self.genesis_bits,timestamp=int(time.time()),height=1,nonce=0)
             # 这里只是为了测试
-            while not genesis_block.is_validate():
-                genesis_block.nonce += 1
+            nonce = mine_nonce_range(genesis_template)
+            while nonce is None:
+                genesis_template.timestamp += 1
+                nonce = mine_nonce_range(genesis_template)
+            genesis_block = genesis_template.to_block(nonce)
             if not self.add_block(genesis_block):
                 raise Exception('创始区块创建失败')
 
     def block_len(self):
         return len(self.blocks)
 
+    def check_checkpoint(self,block:Block):
+        checkpoint = self.checkpoints.get(block.height)
+        return checkpoint is None or checkpoint == block.hash()
+
+    def get_by_hash(self,block_hash:bytes):
+        entry = self.block_index.get(block_hash)
+        if entry is None:
+            return None
+        return entry.block
+
+    def get_by_height(self,height:int):
+        block_hash = self.height_index.get(height)
+        if block_hash is None:
+            return None
+        return self.block_index[block_hash].block
+
+    def contains(self,block_hash:bytes):
+        # 区块树中是否有这个区块(主链或侧链)
+        return block_hash in self.block_index
+
+    def get_status(self,block_hash:bytes):
+        entry = self.block_index.get(block_hash)
+        if entry is None:
+            return None
+        return entry.status
+
+    def is_main_chain(self,block:Block):
+        return self.height_index.get(block.height) == block.hash()
+
+    def block_locator(self):
+        if not self.blocks:
+            return []
+        return [self.height_index[height] for height in locator_heights(self.blocks[0].height,self.blocks[-1].height)]
+
+    def find_fork_height(self,locator:List[bytes]):
+        # locator中第一个在本地主链上的区块就是分叉点，都不在时返回None
+        for block_hash in locator:
+            entry = self.block_index.get(block_hash)
+            if entry is not None and self.is_main_chain(entry.block):
+                return entry.block.height
+        return None
+
+    def get_ancestor(self,entry:BlockEntry,height:int):
+        # 找entry所在分支上指定高度的区块。只需要沿侧链走到主链，之后用高度索引
+        cursor = entry
+        while cursor.block.height > height and not self.is_main_chain(cursor.block):
+            cursor = self.block_index[cursor.block.prev_hash]
+        if cursor.block.height == height:
+            return cursor.block
+        return self.get_by_height(height)
+
+    def retarget(self,bits:bytes,first_timestamp:int,last_timestamp:int):
+        return retarget_bits(bits,first_timestamp,last_timestamp,self.target_timespan)
+
+    def next_bits(self,parent:BlockEntry):
+        """
+            parent之后下一个区块的难度。高度为adjustment_interval整数倍的区块之后调整难度，
+            周期开始的区块通过高度索引直接取到，不需要遍历链
+        """
+        block = parent.block
+        if block.height % self.adjustment_interval != 0:
+            return block.bits
+        first_block = self.get_ancestor(parent,max(block.height - self.adjustment_interval,1))
+        return self.retarget(block.bits,first_block.timestamp,block.timestamp)
+
+    def next_tip_bits(self):
+        # 主链tip之后下一个区块的难度，挖矿时使用
+        return self.next_bits(self.block_index[self.get_best_tip().hash()])
+
+    def _connect_block(self,block:Block):
+        # 把区块接到主链尾，同时维护hash和高度索引
+        block_hash = block.hash()
+        entry = self.block_index.get(block_hash)
+        if entry is None:
+            parent = self.block_index.get(block.prev_hash)
+            parent_work = parent.chain_work if parent else 0
+            entry = BlockEntry(block,BLOCK_STATUS_FORK,parent_work + block_work(block.bits))
+            self.block_index[block_hash] = entry
+        entry.status = BLOCK_STATUS_VALID
+        self.blocks.append(block)
+        self.height_index[block.height] = block_hash
+        self.ledger.connect_block(block)
+        if self.store:
+            self.store.append(block)
+
+    def _disconnect_tip(self):
+        # 从主链尾断开一个区块，区块还留在区块树中作为侧链
+        block = self.blocks.pop()
+        self.height_index.pop(block.height,None)
+        self.block_index[block.hash()].status = BLOCK_STATUS_FORK
+        self.validated_count = min(self.validated_count, len(self.blocks))
+        self.ledger.disconnect_block(block)
+        if self.store:
+            self.store.truncate(len(self.blocks))
+        return block
+
+    def _reorganize(self,new_tip:BlockEntry):
+        """
+            切换到累计工作量更大的分支。只断开主链上分叉点之后的区块，再连接新分支上的区块，
+            重组的开销和分叉深度成正比，和链的长度无关。
+        """
+        connect_blocks = []
+        cursor = new_tip
+        while not self.is_main_chain(cursor.block):
+            connect_blocks.append(cursor.block)
+            cursor = self.block_index[cursor.block.prev_hash]
+        fork_hash = cursor.block.hash()
+        disconnect_count = 0
+        while self.get_best_tip().hash() != fork_hash:
+            self._disconnect_tip()
+            disconnect_count += 1
+        for block in reversed(connect_blocks):
+            self._connect_block(block)
+        log.debug(f'区块重组完成，分叉高度:{cursor.block.height},断开{disconnect_count}个区块,连接{len(connect_blocks)}个区块')
+
+    def recent_blocks(self,count=10):
+        return self.blocks[-count:]
+
     def get_best_tip(self):
         if not self.blocks:
             return None
         # 返回最后一个元素
         return self.blocks[-1]
     # 区块增加
-    def add_block(self,block:Block):
-        # 区块增加，这里简化重组。只要新区块的prev_hash和当前主链tip hash不一致就不能增加成功
-        # 在网络层，如果其它网络节点通知的新区块和本地不一致时，先判断高度，你高度低直接忽略。
-        # 如果高度比当前的节点更高，那从相关节获取完整的blockchian.这里只是测试p2p挖矿流程，真实的话是不行的。
+    def add_block(self,block:Block,peer_id=None):
+        """
+            增加区块到区块树。父区块是主链tip的直接接到主链上，父区块是其它已知区块的作为侧链保存，
+            侧链的累计工作量超过主链时做增量重组。
+            父区块未知的区块放到孤块池，区块被接受后，等待它的孤块依次连接。
+        :param peer_id: 区块来自哪个节点，孤块池按节点限制数量
+        :return: 区块被接受(主链或侧链)返回True，放入孤块池返回False
+        """
+        if not self._add_block(block,peer_id):
+            return False
+        self._connect_orphans([block.hash()])
+        return True
+
+    def _connect_orphans(self,parent_hashes):
+        # 按层连接等待这些父区块的孤块，不用递归
+        pending = list(parent_hashes)
+        while pending:
+            parent_hash = pending.pop()
+            for orphan in self.orphan_pool.pop_children(parent_hash):
+                if self._add_block(orphan):
+                    log.debug(f'孤块连接成功,height:{orphan.height}')
+                    pending.append(orphan.hash())
+
+    def _add_block(self,block:Block,peer_id=None):
+        block_hash = block.hash()
+        if block_hash in self.block_index:
+            log.debug('add block fail,block already exists')
+            return False
+        if not block.check_size():
+            log.debug('add block fail,block too large')
+            return False
+        if not block.check_merkle_root():
+            log.debug('add block fail,merkle root dont match transactions')
+            return False
         if self.block_len() == 0:
             if block.prev_hash != b'\x00' *32:
                 log.debug('add block fail,block#0 prev hash must be empty ')
                 return False
-        else:
-            prev_block =  self.blocks[self.block_len() - 1]
-            if prev_block.hash() != block.prev_hash:
-                log.debug('add block fail,new block prev_hash dont match prev block hash. ')
-                return False
-            if prev_block.bits != block.bits:
-                log.debug(f'add block fail,new block bits dont match prev block bits.best tip bits:{prev_block.bits} ')
+            if not check_coinbase(block) or not block.is_validate():
+                log.debug('block add fail,block invali')
                 return False
-                return False
-        # block height不需要验证，只要保证new_block.prevhash 和 best_tip.hash一致就行了。
-        # if block.height -1 !=len(self.blocks):
-        #     log.debug(f'new block height not match,need block height:{len(self.blocks) + 1}')
-        #     return False
-        if block.is_validate():
-            log.debug(f'new block add success')
-            self.blocks.append(block)
+            self._connect_block(block)
             return True
-        else:
+        parent = self.block_index.get(block.prev_hash)
+        if parent is None:
+            # 孤块不能按父区块检查难度，要求难度不低于当前主链tip，否则声明很低的难度不做工作量就能放进孤块池
+            if compact_to_target(block.bits) > compact_to_target(self.get_best_tip().bits):
+                log.debug('add block fail,parent block unknown,orphan bits easier than tip')
+                return False
+            if check_coinbase(block) and block.is_validate() and self.orphan_pool.add(block,peer_id):
+                log.debug('add block fail,parent block unknown,add to orphan pool')
+            else:
+                log.debug('add block fail,parent block unknown')
+            return False
+        # 先按父区块检查难度、高度和检查点，不符合的区块直接丢弃，不保存到区块树中。
+        # 难度要先检查，否则区块可以声明一个很低的难度，不做工作量就通过pow检查
+        required_bits = self.next_bits(parent)
+        if block.bits != required_bits:
+            log.debug(f'add block fail,new block bits dont match required bits:{required_bits.hex()} ')
+            return False
+        if parent.block.height + 1 != block.height:
+            log.debug(f'new block height not match,need block height:{parent.block.height + 1}')
+            return False
+        best_tip = self.get_best_tip()
+        if block.height <= self.last_checkpoint_height and block.prev_hash != best_tip.hash():
+            log.debug(f'add block fail,fork before last checkpoint:{self.last_checkpoint_height}')
+            return False
+        if not self.check_checkpoint(block):
+            log.debug(f'add block fail,block hash dont match checkpoint at height {block.height}')
+            return False
+        if not block.is_validate():
             log.debug('block add fail,block invali')
             return False
-    def reset_chian(self):
+        entry = BlockEntry(block,BLOCK_STATUS_FORK,parent.chain_work + block_work(block.bits))
+        # 按要求的难度做了工作量但是不符合其它规则的区块记为无效，以后重复收到可以直接拒绝
+        if parent.status == BLOCK_STATUS_INVALID:
+            log.debug('add block fail,parent block is invalid')
+            entry.status = BLOCK_STATUS_INVALID
+        elif not check_coinbase(block):
+            log.debug('add block fail,coinbase transaction invalid')
+            entry.status = BLOCK_STATUS_INVALID
+        self.block_index[block_hash] = entry
+        if entry.status == BLOCK_STATUS_INVALID:
+            return False
+        if block.prev_hash == best_tip.hash():
+            log.debug(f'new block add success')
+            self._connect_block(block)
+        elif entry.chain_work > self.block_index[best_tip.hash()].chain_work:
+            log.debug(f'侧链累计工作量超过主链，开始重组')
+            self._reorganize(entry)
+        else:
+            log.debug(f'new block add to fork chain,height:{block.height}')
+        return True
+    def reset_chian(self,create_genesis=True):
         self.blocks = []
-        self._init_genesis_block()
+        self.block_index = {}
+        self.height_index = {}
+        self.validated_count = 0
+        self.orphan_pool = OrphanPool()
+        self.ledger.reset()
+        if self.store:
+            self.store.truncate(0)
+        if create_genesis:
+            self._init_genesis_block()
+
+    @classmethod
+    def load(cls,store,genesis_bits=None,checkpoints=None,assume_valid=False):
+        """
+            从本地区块存储启动。存储中的hash直接使用，不重新计算(尾部已经在打开存储时验证过)，
+            存储为空时创建创世区块
+        """
+        block_chian = cls(genesis_bits,create_genesis=False,checkpoints=checkpoints,assume_valid=assume_valid)
+        if store.count:
+            with store.view() as view:
+                if not block_chian.import_headers(view,known_hashes=store.hashes()):
+                    raise Exception(f'区块存储数据无效:{store.data_dir}')
+        block_chian.store = store
+        block_chian._init_genesis_block()
+        log.debug(f'从区块存储加载区块链成功，区块数:{block_chian.block_len()}')
+        return block_chian
     def serialize(self):
         # 序列化 高度在真正的项目是不需要序列化的，因为有hash和位置就能算出高度了。
-        bin_data = b''
-        for item in self.blocks:
-            bin_data += item.serialize()
-        return bin_data
+        return b''.join([item.serialize() for item in self.blocks])
+
+    def _height_range(self,start_height=None,end_height=None):
+        # 主链高度区间[start_height,end_height)转换成self.blocks的下标
+        if not self.blocks:
+            return 0, 0
+        first_height = self.blocks[0].height
+        start = 0 if start_height is None else max(start_height - first_height, 0)
+        end = len(self.blocks) if end_height is None else min(end_height - first_height, len(self.blocks))
+        return start, max(start, end)
+
+    def serialize_into(self,buffer=None,offset=0,start_height=None,end_height=None):
+        """
+            把主链区块按BLOCK_BIN_LEN字节定长记录直接写到预先分配好的bytearray中
+        :return: 写入的buffer
+        """
+        start, end = self._height_range(start_height,end_height)
+        if buffer is None:
+            buffer = bytearray(offset + (end - start) * BLOCK_BIN_LEN)
+        for block in self.blocks[start:end]:
+            buffer[offset:offset + BLOCK_BIN_LEN] = block.serialize()
+            offset += BLOCK_BIN_LEN
+        return buffer
+
+    def iter_chunks(self,start_height=None,end_height=None,chunk_blocks=1024):
+        """
+            按区块高度范围分块输出序列化数据，每块最多chunk_blocks个区块，用于给同步节点分段发送
+        """
+        start, end = self._height_range(start_height,end_height)
+        for chunk_start in range(start, end, chunk_blocks):
+            chunk_end = min(chunk_start + chunk_blocks, end)
+            yield b''.join([block.serialize() for block in self.blocks[chunk_start:chunk_end]])
+
+    def write_to(self,stream,start_height=None,end_height=None,chunk_blocks=1024):
+        """
+            把主链区块流式写到文件或者socket中，额外内存只有一个分块的大小
+        :param stream: 有write方法的对象(文件，asyncio.StreamWriter)或者socket
+        :return: 写入的字节数
+        """
+        write = getattr(stream,'sendall',None) or stream.write
+        total = 0
+        for chunk in self.iter_chunks(start_height,end_height,chunk_blocks):
+            write(chunk)
+            total += len(chunk)
+        return total
 
     @classmethod
-    def deserialize(cls,byte_datas:bytes):
-        io_bytes = io.BytesIO(byte_datas)
-        bin_data = io_bytes.read(Block.BLOCK_BIN_LEN)
-        block_chian = cls()
-        while bin_data:
-            block = Block.deserialize(bin_data)
-            if not block_chian.add_block(block):
-                # 只要一节点没办法添加到元素则返回
-                return None
-            bin_data = io_bytes.read(Block.BLOCK_BIN_LEN)
+    def deserialize(cls,byte_datas:bytes,workers=None):
+        block_chian = cls(create_genesis=False)
+        if not block_chian.import_headers(byte_datas,workers):
+            # 只要一节点没办法添加到元素则返回
+            return None
         return block_chian
 
+    def _hash_headers(self,view:memoryview,workers=None,chunk_blocks=20000,assume_valid_count=0):
+        return hash_headers(view,workers,chunk_blocks,assume_valid_count)
+
+    def _assume_valid_count(self,view:memoryview):
+        # 这一批区块头中在assume-valid高度及之前的区块数，区块高度是连续的
+        count = len(view) // BLOCK_BIN_LEN
+        if not count or not self.assume_valid_height:
+            return 0
+        start_height = struct.unpack_from('<I',view,BLOCK_BIN_LEN - 4)[0]
+        return max(0,min(count,self.assume_valid_height - start_height + 1))
+
+    def import_headers(self,byte_datas,workers=None,known_hashes=None):
+        """
+            批量导入连续的区块头，接在当前主链tip后面(空链时从创世区块开始)。
+            用struct.iter_unpack一次解出所有区块头，pow验证分块交给进程池并行计算，
+            算出的hash直接缓存到区块中，prev_hash链接关系一次遍历检查。
+            assume-valid模式下最后一个检查点及之前的区块只检查hash链接和检查点，不验证pow和难度。
+            有一个区块不合法就整批都不导入，返回False
+        :param known_hashes: 本地存储中已经验证过的hash，传入时不再计算hash和验证pow
+        """
+        view = memoryview(byte_datas)
+        if len(view) % BLOCK_BIN_LEN != 0:
+            log.debug(f'import fail,data length {len(view)} is not a multiple of {BLOCK_BIN_LEN}')
+            return False
+        if known_hashes is not None:
+            hashes = known_hashes
+            if len(hashes) != len(view) // BLOCK_BIN_LEN:
+                log.debug('import fail,known hashes count dont match blocks count')
+                return False
+        else:
+            hashes, first_invalid = self._hash_headers(view,workers,assume_valid_count=self._assume_valid_count(view))
+            if first_invalid >= 0:
+                log.debug(f'import fail,block #{first_invalid} pow invalid')
+                return False
+        best_tip = self.get_best_tip()
+        prev_block = best_tip
+        if best_tip is None:
+            prev_hash, chain_work = ZERO_HASH, 0
+        else:
+            prev_hash = best_tip.hash()
+            chain_work = self.block_index[prev_hash].chain_work
+        blocks = []
+        offset = 0
+        for index, (block_prev_hash, block_merkle_root, nonce, bits, timestamp, height) in enumerate(struct.iter_unpack(BLOCK_BIN_FORMAT, view)):
+            if block_prev_hash != prev_hash:
+                log.debug(f'import fail,block #{index} prev_hash dont match prev block hash')
+                return False
+            checkpoint = self.checkpoints.get(height)
+            if checkpoint is not None and checkpoint != hashes[index]:
+                log.debug(f'import fail,block #{index} hash dont match checkpoint at height {height}')
+                return False
+            if prev_block is not None and height != prev_block.height + 1:
+                log.debug(f'import fail,block #{index} height dont match prev block')
+                return False
+            if prev_block is not None and height > self.assume_valid_height:
+                expected_bits = prev_block.bits
+                if prev_block.height % self.adjustment_interval == 0:
+                    # 难度调整周期开始的区块可能在这一批里，也可能已经在主链上
+                    first_height = max(prev_block.height - self.adjustment_interval,1)
+                    if blocks and first_height >= blocks[0].height:
+                        first_block = blocks[first_height - blocks[0].height]
+                    else:
+                        first_block = self.get_by_height(first_height)
+                    expected_bits = self.retarget(prev_block.bits,first_block.timestamp,prev_block.timestamp)
+                if bits != expected_bits:
+                    log.debug(f'import fail,block #{index} bits dont match prev block')
+                    return False
+            block = Block(block_prev_hash,nonce,bits,timestamp,height,block_merkle_root,_bin=bytes(view[offset:offset + BLOCK_BIN_LEN]))
+            block._hash = hashes[index]
+            blocks.append(block)
+            prev_hash, prev_block = block._hash, block
+            offset += BLOCK_BIN_LEN
+        # 全部验证通过后再连接到主链
+        for block in blocks:
+            chain_work += block_work(block.bits)
+            self.block_index[block._hash] = BlockEntry(block,BLOCK_STATUS_VALID,chain_work)
+            self.height_index[block.height] = block._hash
+            # 区块头没有交易，账本只记下这些区块没有记账
+            self.ledger.connect_block(block)
+            if self.store:
+                self.store.append(block)
+        self.blocks.extend(blocks)
+        # 孤块池中等待这批区块的孤块
+        self._connect_orphans([parent_hash for parent_hash in self.orphan_pool.missing_parents() if parent_hash in self.block_index])
+        return True
+
     def to_b64(self):
         return base64.b64encode(self.serialize()).decode('utf8')
 
     @classmethod
     def from_b64(cls,block_b64):
-        return Block.deserialize(base64.b64decode(block_b64))
+        return cls.deserialize(base64.b64decode(block_b64))
 
     def hash(self):
-        # 计算区块hash
-        return hashlib.sha256(self.serialize()).digest()
+        # 计算整条链的hash，分块更新不复制整条链
+        sha = hashlib.sha256()
+        for chunk in self.iter_chunks():
+            sha.update(chunk)
+        return sha.digest()
 
 import threading
 import asyncio
+import queue
+
+def mine_nonce_range(block:BlockTemplate,start_nonce=0,end_nonce=MAX_NONCE + 1,should_stop=None,check_interval=100000,on_progress=None,
+                     target=None):
+    """
+        挖矿内核，在[start_nonce,end_nonce)中查找满足难度的nonce。
+        区块头的常量字段只打包一次，每个nonce只用pack_into改写nonce的4个字节，
+        sha256对象从预先喂入prev_hash和merkle_root(正好一个分组)的状态copy出来，再和预先算好的目标值比较。
+        每check_interval个nonce调用一次should_stop，返回True时退出。
+        on_progress(完成的nonce数量)也是每check_interval个nonce调用一次，用于统计算力。
+        target为比较用的32字节目标值，默认为区块的难度，矿池worker用更低的份额难度
+    :return: 找到的nonce，没找到或被中止时返回None
+    """
+    # nonce + bits + timestamp + height
+    header = block.serialize()
+    header_tail = bytearray(header[NONCE_OFFSET:])
+    copy_prefix_state = hashlib.sha256(header[:NONCE_OFFSET]).copy
+    pack_nonce = _NONCE_STRUCT.pack_into
+    if target is None:
+        target = block.pow_target()
+    chunk_start = start_nonce
+    while chunk_start < end_nonce:
+        if should_stop is not None and should_stop():
+            return None
+        chunk_end = min(chunk_start + check_interval, end_nonce)
+        for nonce in range(chunk_start, chunk_end):
+            pack_nonce(header_tail, 0, nonce)
+            sha = copy_prefix_state()
+            sha.update(header_tail)
+            if sha.digest() <= target:
+                if on_progress is not None:
+                    on_progress(nonce - chunk_start + 1)
+                return nonce
+        if on_progress is not None:
+            on_progress(chunk_end - chunk_start)
+        chunk_start = chunk_end
+    return None
+
+# 挖矿worker检查任务代数的间隔(nonce数)范围
+MIN_CHECK_INTERVAL = 1000
+MAX_CHECK_INTERVAL = 1000000
+# worker收到这个任务时退出
+_STOP_WORKER = None
+# 挖矿时检查交易池是否变化的间隔(秒)
+TEMPLATE_REFRESH_INTERVAL = 0.1
+_TEMPLATE_CHANGED = object()
+
+def adaptive_check_interval(hashrate,target_switch_ms,min_interval=MIN_CHECK_INTERVAL,max_interval=MAX_CHECK_INTERVAL):
+    # 按测到的hash速度计算检查间隔，使切换任务的延迟在target_switch_ms毫秒左右
+    return max(min_interval,min(int(hashrate * target_switch_ms / 1000),max_interval))
+
+def _mining_worker_loop(worker_index,job_queue,result_queue,generation,abort_time,hashes,busy_time,
+                        check_interval,target_switch_ms):
+    """
+        常驻的挖矿worker，在线程或者子进程中一直运行。从自己的任务队列中取任务，队列中有多个时只做最新的一个。
+        每check_interval个nonce检查一次共享的任务代数，和任务的代数不一致时放弃当前任务去取新任务，
+        check_interval按测到的hash速度调整。结果放到result_queue中:
+        ('found',代数,nonce,worker_index) 找到区块
+        ('exhausted',代数,None,worker_index) nonce范围用完
+        ('aborted',代数,中止延迟秒数,worker_index) 任务被放弃
+    """
+    job = None
+    while True:
+        if job is None:
+            job = job_queue.get()
+        while job is not _STOP_WORKER:
+            try:
+                job = job_queue.get_nowait()
+            except queue.Empty:
+                break
+        if job is _STOP_WORKER:
+            return
+        job_generation, template, nonce, end_nonce = job
+        job = None
+        if generation.value != job_generation:
+            # 已经过期的任务，等下一个
+            continue
+        while True:
+            if generation.value != job_generation:
+                result_queue.put(('aborted',job_generation,time.time() - abort_time.value,worker_index))
+                break
+            if nonce >= end_nonce:
+                result_queue.put(('exhausted',job_generation,None,worker_index))
+                break
+            chunk_end = min(nonce + check_interval,end_nonce)
+            chunk_start_time = time.perf_counter()
+            found = mine_nonce_range(template,nonce,chunk_end)
+            elapsed = time.perf_counter() - chunk_start_time
+            done = chunk_end - nonce if found is None else found - nonce + 1
+            hashes[worker_index] += done
+            busy_time[worker_index] += elapsed
+            if found is not None:
+                result_queue.put(('found',job_generation,found,worker_index))
+                break
+            if elapsed > 0:
+                check_interval = adaptive_check_interval(done / elapsed,target_switch_ms)
+            nonce = chunk_end
+
+class MiningWorkerPool:
+    """
+        常驻的挖矿worker池，workers大于1时worker为子进程，否则为线程。
+        nonce空间按worker数平均切分，新的区块模板通过每个worker自己的任务队列发下去，同时把共享内存中的任务代数加1，
+        worker在下一次检查时换成新任务，不需要重新创建线程或进程。
+        检查间隔按hash速度调整，切换任务的延迟在target_switch_ms毫秒左右，实际延迟记录在telemetry中。
+    """
+    def __init__(self,workers=1,use_processes=None,check_interval=10000,target_switch_ms=50,telemetry:MiningTelemetry=None):
+        self.workers = workers
+        self.use_processes = workers > 1 if use_processes is None else use_processes
+        self.check_interval = check_interval # 开始时的检查间隔，之后按hash速度调整
+        self.target_switch_ms = target_switch_ms
+        self.telemetry = telemetry or MiningTelemetry(workers)
+        self.generation = multiprocessing.RawValue('Q',0)
+        self.abort_time = multiprocessing.RawValue('d',0.0)
+        self.job_queues = []
+        self.worker_handles = []
+        self.result_queue = None
+        self.result_thread = None
+        self.loop = None
+        self.waiter = None # 等待结果的任务 [代数,future,nonce范围用完的worker数]
+
+    @property
+    def last_abort_latency(self):
+        # 最近一次中止时worker切换的延迟(秒)
+        return self.telemetry.last_abort_latency
+
+    @property
+    def max_abort_latency(self):
+        return self.telemetry.max_abort_latency
+
+    def start(self):
+        if self.worker_handles:
+            return
+        queue_cls = multiprocessing.Queue if self.use_processes else queue.Queue
+        worker_cls = multiprocessing.Process if self.use_processes else threading.Thread
+        self.result_queue = queue_cls()
+        for worker_index in range(self.workers):
+            job_queue = queue_cls()
+            worker = worker_cls(target=_mining_worker_loop,
+                                args=(worker_index,job_queue,self.result_queue,self.generation,self.abort_time,
+                                      self.telemetry.hashes,self.telemetry.busy_time,
+                                      self.check_interval,self.target_switch_ms),
+                                daemon=True)
+            worker.start()
+            self.job_queues.append(job_queue)
+            self.worker_handles.append(worker)
+        self.result_thread = threading.Thread(target=self._result_loop,daemon=True)
+        self.result_thread.start()
+        log.debug(f'挖矿worker启动成功,数量:{self.workers},使用子进程:{self.use_processes}')
+
+    def _result_loop(self):
+        # 在单独的线程中读取worker的结果，中止延迟直接记录，其它结果交给event loop
+        while True:
+            result = self.result_queue.get()
+            if result is None:
+                return
+            if result[0] == 'aborted':
+                self.telemetry.record_abort_latency(result[2])
+                continue
+            try:
+                self.loop.call_soon_threadsafe(self._on_result,result)
+            except RuntimeError:
+                # event loop已经关闭
+                pass
+
+    def _on_result(self,result):
+        kind, generation, nonce, _ = result
+        waiter = self.waiter
+        if waiter is None or waiter[0] != generation or waiter[1].done():
+            return
+        if kind == 'found':
+            waiter[1].set_result(nonce)
+        else:
+            waiter[2] += 1
+            if waiter[2] == self.workers:
+                waiter[1].set_result(None)
+
+    def nonce_ranges(self):
+        step = (MAX_NONCE + 1) // self.workers
+        ranges = [(i * step, (i + 1) * step) for i in range(self.workers)]
+        ranges[-1] = (ranges[-1][0], MAX_NONCE + 1)
+        return ranges
+
+    def abort(self):
+        # 通知所有worker放弃当前的任务
+        self.abort_time.value = time.time()
+        self.generation.value += 1
+
+    def _post_job(self,template:BlockTemplate,future):
+        self.abort()
+        generation = self.generation.value
+        self.waiter = [generation,future,0]
+        for job_queue, (start_nonce, end_nonce) in zip(self.job_queues,self.nonce_ranges()):
+            job_queue.put((generation,template,start_nonce,end_nonce))
+
+    async def _wait_nonce(self,future,mempool,revision,refresh_interval):
+        # 没有交易池时直接等结果。有交易池时每refresh_interval秒检查一次交易是否变化，变化时返回_TEMPLATE_CHANGED
+        if mempool is None:
+            return await future
+        while True:
+            done, _ = await asyncio.wait([future],timeout=refresh_interval)
+            if done:
+                return future.result()
+            if mempool.revision != revision:
+                return _TEMPLATE_CHANGED
+
+    async def mine(self,prev_block:Block,bits=None,mempool=None,refresh_interval=TEMPLATE_REFRESH_INTERVAL):
+        """
+            以prev_block为父区块挖矿，直到找到区块。
+            传入交易池时打包交易池中的交易，交易变化后用新的merkle_root生成模板，作为新任务发给worker
+        """
+        self.loop = asyncio.get_running_loop()
+        self.start()
+        transactions, revision = None, None
+        template = BlockTemplate.from_prev_block(prev_block,bits)
+        if mempool is not None:
+            template.merkle_root, transactions, revision = mempool.block_template()
+        try:
+            while True:
+                future = self.loop.create_future()
+                self._post_job(template,future)
+                nonce = await self._wait_nonce(future,mempool,revision,refresh_interval)
+                if nonce is _TEMPLATE_CHANGED:
+                    # 交易池的Merkle树已经增量更新好，直接取树根。线程worker共用模板对象，这里创建新的
+                    merkle_root, transactions, revision = mempool.block_template()
+                    template = BlockTemplate(template.prev_hash,0,template.bits,template.timestamp,template.height,merkle_root)
+                    continue
+                if nonce is not None:
+                    new_block = template.to_block(nonce,transactions)
+                    log.debug(f'[挖矿worker] 找到新的区块，区块信息:{new_block} ')
+                    return new_block
+                # 所有worker的nonce空间都用完了，更新时间戳重新搜索。线程worker共用模板对象，这里创建新的
+                template = BlockTemplate(template.prev_hash,0,template.bits,
+                                         max(int(time.time()),template.timestamp + 1),template.height,template.merkle_root)
+        finally:
+            # 找到区块或者任务被取消，都要让其它worker放弃这次任务
+            self.waiter = None
+            self.abort()
+
+    def close(self):
+        self.abort()
+        for job_queue in self.job_queues:
+            job_queue.put(_STOP_WORKER)
+        for worker in self.worker_handles:
+            worker.join(timeout=5)
+        if self.result_queue is not None:
+            self.result_queue.put(None)
+            self.result_thread.join(timeout=5)
+        self.job_queues = []
+        self.worker_handles = []
 
 class Minner:
-    def __init__(self,block_chain:BlockChain,stop_event:threading.Event):
+    def __init__(self,block_chain:BlockChain,stop_event:threading.Event,workers=1,target_switch_ms=50,mempool=None,
+                 coinbase_address=None):
         """
             写一个简单的挖矿程序的实现
+            挖矿worker常驻运行，workers大于1时使用多进程挖矿
+            有交易池时打包交易池中的交易，有coinbase_address时区块奖励记到这个地址上
         """
         self.stop_mining_event =stop_event
         self.chian = block_chain
+        self.coinbase_address = coinbase_address
+        if mempool is None and coinbase_address:
+            # coinbase交易也通过交易池的Merkle树打包
+            mempool = Mempool()
+        self.mempool = mempool
         self.minner_task = None
-        pass
+        self.worker_pool = MiningWorkerPool(workers,target_switch_ms=target_switch_ms)
+        # 挖矿统计，和worker池共用
+        self.telemetry = self.worker_pool.telemetry
 
     @staticmethod
-    def do_mining_loop(prev_block:Block,event:threading.Event):
+    def do_mining_loop(prev_block:Block,event:threading.Event,bits=None,telemetry:MiningTelemetry=None):
         log.debug(f'[挖矿线程]开始挖矿,prev block{prev_block}')
-        nonce = 0
-        new_block =  Block(prev_block.hash(),0, prev_block.bits, int(time.time()),height=prev_block.height + 1)
+        template = BlockTemplate.from_prev_block(prev_block,bits)
+        on_progress = telemetry.hash_counter(0) if telemetry else None
         while True:
-            new_block.nonce = nonce
-            if nonce % 100000 ==0:
-                if event.is_set():
-                    log.debug('[挖矿线程]收到中止挖矿通知,退出挖矿...')
-                    return None
-            if new_block.is_validate():
+            nonce = mine_nonce_range(template,should_stop=event.is_set,on_progress=on_progress)
+            if nonce is not None:
+                new_block = template.to_block(nonce)
                 log.debug(f'[挖矿线程] 找到新的区块，区块信息:{new_block} ')
                 return new_block
-            nonce += 1
+            if event.is_set():
+                log.debug('[挖矿线程]收到中止挖矿通知,退出挖矿...')
+                return None
+            # nonce空间用完了，更新时间戳重新搜索
+            template.timestamp = max(int(time.time()), template.timestamp + 1)
     async def start(self):
         # 开始挖矿
         await self.restart()
         #这里还有其它操作
-    async def restart(self):
-        # 重新挖矿
-        self.stop_mining_event.set()
-        log.debug('重新开始挖矿程序...')
+    async def _cancel_minner_task(self):
         if self.minner_task and not self.minner_task.done():
-            log.debug('等待挖矿任务结束...')
             self.minner_task.cancel()
             try:
                 await self.minner_task
             except asyncio.CancelledError :
                 log.debug('挖矿任务取消成功...')
-            log.debug('挖矿任务结束')
-        self.stop_mining_event.clear()
+    async def restart(self):
+        # 重新挖矿。只取消等待结果的协程，worker不退出，新的tip作为新任务发给worker，下一次检查时切换
+        log.debug('重新开始挖矿程序...')
+        await self._cancel_minner_task()
         self.minner_task =asyncio.create_task(self.do_minner())
+    async def stop(self):
+        # 停止挖矿并退出所有worker
+        self.stop_mining_event.set()
+        await self._cancel_minner_task()
+        self.worker_pool.close()
+        log.debug('挖矿结束')
     async def do_minner(self):
         # 新区块挖矿'
         log.debug('开始挖矿')
-        while True:
+        while not self.stop_mining_event.is_set():
             prev_block = self.chian.get_best_tip()
-            new_block = await asyncio.to_thread(Minner.do_mining_loop,prev_block,self.stop_mining_event)
+            bits = self.chian.next_tip_bits()
+            if self.coinbase_address:
+                height = prev_block.height + 1
+                self.mempool.set_coinbase(Transaction.coinbase(self.coinbase_address,height,block_reward(height)))
+            new_block = await self.worker_pool.mine(prev_block,bits,self.mempool)
             if new_block:
+                self.telemetry.record_found_block(new_block)
+                old_tip = self.chian.get_best_tip()
                 if self.chian.add_block(new_block):
+                    if self.mempool is not None:
+                        self.mempool.update_main_chain(self.chian,old_tip)
                     log.debug('新区块增加成功...可这可以开始发布消息')
                 else:
                     log.debug('新区块增加失败...')
@@ -243,35 +1135,130 @@ class Minner:
                 log.debug('挖矿结果为空，挖矿终止')
                 break
         log.debug('挖矿结束')
+def parse_tx_args(args):
+    # 控制台tx命令的参数: 发送方 接收方 金额 手续费，参数不正确时抛出ValueError
+    if len(args) != 4:
+        raise ValueError(f'需要4个参数，实际{len(args)}个')
+    sender, receiver, amount, fee = args
+    if not amount.isdigit() or not fee.isdigit() or int(amount) > MAX_AMOUNT or int(fee) > MAX_AMOUNT:
+        raise ValueError('金额和手续费必须是非负整数')
+    for address in (sender, receiver):
+        if len(address.encode('utf8')) > MAX_ADDRESS_LEN:
+            raise ValueError(f'地址超过{MAX_ADDRESS_LEN}字节')
+    return Transaction(sender,receiver,int(amount),int(fee),nonce=int(time.time() * 1000) & 0xFFFFFFFF)
 async def  input_task(minner:Minner):
     while True:
         # 异步等等
         cmd = await asyncio.to_thread(input, '>')
-        if cmd == 'restart':
-            log.debug('restart ming while empty chian blocks...')
-            minner.chian.reset_chian()
-            await minner.restart()
-        elif cmd == 'add':
-            # 增加一个假的 fake
-            current_time = int(time.time())
-            # 这是假的block
-            best_tip = minner.chian.get_best_tip()
-            fake_block = Block(b'\x11'*32,nonce=0,bits=best_tip.bits,timestamp=int(time.time()),height=minner.chian.block_len())
-            # 这里只是测试
-            minner.chian.blocks.append(fake_block)
-            log.debug(f'add fake block.restart mining...')
-            await minner.restart()
-        elif cmd == "status":
-            log.debug(f'block:{"-->".join( [str(block) for block in minner.chian.blocks] )}')
-            log.debug(minner.chian.to_b64())
-            log.debug(f'chian status,len:{minner.chian.block_len()},isvalid:{minner.chian.check_chian()}')
+        try:
+            await handle_input_cmd(minner,cmd)
+        except Exception:
+            # 命令出错不能影响挖矿
+            log.exception(f'处理命令出错:{cmd}')
+async def handle_input_cmd(minner:Minner,cmd:str):
+    if cmd == 'restart':
+        log.debug('restart ming while empty chian blocks...')
+        minner.chian.reset_chian()
+        await minner.restart()
+    elif cmd == 'add':
+        if not isinstance(minner.chian,BlockChain):
+            log.debug('当前区块链后端不支持增加假区块')
+            return
+        # 增加一个假的 fake
+        current_time = int(time.time())
+        # 这是假的block
+        best_tip = minner.chian.get_best_tip()
+        fake_block = Block(b'\x11'*32,nonce=0,bits=best_tip.bits,timestamp=int(time.time()),height=best_tip.height + 1)
+        # 这里只是测试
+        minner.chian._connect_block(fake_block)
+        log.debug(f'add fake block.restart mining...')
+        await minner.restart()
+    elif cmd == "status":
+        # 只显示最近的区块，长链上不再输出整条链
+        log.debug(f'block:{"-->".join( [str(block) for block in minner.chian.recent_blocks(10)] )}')
+        log.debug(f'chian status,len:{minner.chian.block_len()},isvalid:{minner.chian.check_chian()}')
+        log.debug(f'挖矿统计:{minner.telemetry},孤块:{minner.telemetry.orphaned_count(minner.chian)}')
+    elif cmd.startswith("telemetry"):
+        # 输出json格式的挖矿统计，带文件路径时写到文件中
+        snapshot = minner.telemetry.to_json(minner.chian)
+        path = cmd[len("telemetry"):].strip()
+        if path:
+            with open(path,'w',encoding='utf8') as f:
+                f.write(snapshot)
+            log.debug(f'挖矿统计已写入:{path}')
         else:
-            log.debug(f'invalid cmd:{cmd}')
+            log.debug(snapshot)
+    elif cmd.startswith("checkpoints"):
+        # 按间隔输出主链的检查点，确认后可以复制到配置的checkpoints中
+        interval = cmd[len("checkpoints"):].strip() or '1000'
+        if not interval.isdigit() or int(interval) <= 0:
+            log.debug(f'检查点间隔必须是正整数:{interval}')
+            return
+        interval = int(interval)
+        tip_height = minner.chian.get_best_tip().height
+        lines = [f'    - height: {height}\n      hash: "{minner.chian.get_by_height(height).hash().hex()}"'
+                 for height in range(interval,tip_height + 1,interval)]
+        log.debug('checkpoints:\n' + '\n'.join(lines))
+    elif cmd.startswith("tx "):
+        # 增加一个交易到交易池: tx 发送方 接收方 金额 手续费
+        if minner.mempool is None:
+            log.debug('没有启用交易池')
+            return
+        try:
+            tx = parse_tx_args(cmd.split()[1:])
+        except ValueError as e:
+            log.debug(f'交易参数不正确:{e}，格式: tx 发送方 接收方 金额 手续费')
+            return
+        log.debug(f'加入交易池:{minner.mempool.add(tx)},{tx}')
+    elif cmd.startswith("balance"):
+        # 查询地址的余额，不带地址时为本节点的coinbase地址
+        if not isinstance(minner.chian,BlockChain):
+            log.debug('当前区块链后端没有奖励账本')
+            return
+        address = cmd[len("balance"):].strip() or minner.coinbase_address
+        ledger = minner.chian.ledger
+        log.debug(f'地址{address}余额:{ledger.balance(address)},账本:{ledger.stats()}')
+        if not ledger.complete:
+            log.debug(f'账本不完整:主链上{ledger.missing_bodies}个区块只有区块头，余额只包含本次运行中带着交易连接的区块')
+    elif cmd == "mempool":
+        if minner.mempool is not None:
+            log.debug(f'交易池:{minner.mempool.stats()}')
+    elif cmd.startswith("analytics"):
+        # 主链统计: analytics [窗口区块数] [导出文件.csv|.json]
+        # 在event loop线程中取快照，统计在其它线程中计算，计算时挖矿可以继续增加区块
+        columns = ChainColumns.from_chain(minner.chian)
+        report = await asyncio.to_thread(run_analytics_command,columns,cmd.split()[1:])
+        log.debug(f'区块统计:{report}')
+    elif cmd == "audit":
+        # 重新检查整条链，在线程中运行，不阻塞event loop
+        is_valid = await asyncio.to_thread(minner.chian.check_chian,True)
+        log.debug(f'chian audit,len:{minner.chian.block_len()},isvalid:{is_valid}')
+    else:
+        log.debug(f'invalid cmd:{cmd}')
+def load_chian(config):
+    """
+        按配置打开本地区块存储并加载区块链，单机挖矿和p2p节点都用它，重启后从存储继续
+    """
+    from p2p_minner.block_store import BlockStore
+    store = BlockStore(config['p2p']['data_dir'],sync_every=config['p2p'].get('fsync_interval',100))
+    checkpoints = parse_checkpoints(config['p2p'].get('checkpoints'))
+    assume_valid = config['p2p'].get('assume_valid',False)
+    # 创世区块的难度，可以用difficulty_calibration按本机算力生成
+    genesis_bits = bytes.fromhex(config['p2p']['genesis_bits']) if config['p2p'].get('genesis_bits') else None
+    if config['p2p'].get('chain_backend') == 'columnar':
+        # 按列存储的区块链，只保存主链，内存占用小
+        from p2p_minner.columnar_chain import ColumnarBlockChain
+        return ColumnarBlockChain.load(store,genesis_bits,checkpoints=checkpoints,assume_valid=assume_valid)
+    return BlockChain.load(store,genesis_bits,checkpoints=checkpoints,assume_valid=assume_valid)
+
 async def run_main():
+    config = load_app_config()
     stop_mining_event = threading.Event()
-    chian = BlockChain()
+    chian = load_chian(config)
 
-    minner = Minner(block_chain=chian,stop_event=stop_mining_event)
+    mempool = Mempool(config['p2p'].get('mempool_max_bytes',MAX_MEMPOOL_BYTES))
+    minner = Minner(block_chain=chian,stop_event=stop_mining_event,workers=config['p2p'].get('mining_workers',1),mempool=mempool,
+                    coinbase_address=config['p2p'].get('coinbase_address'))
 
     await asyncio.gather(minner.start(),input_task(minner))
 if __name__ == "__main__":
@@ -0,0 +1,312 @@
+"""
+    从多个节点并行下载缺少的区块。
+    缺少的高度区间[本地tip+1, 节点中最高的tip]按chunk_size个区块切成段，每段分配给预计最早完成的节点：
+    按每个节点测得的下载速度(区块/秒)估算，速度越快的节点同时在途的段越多，最多max_in_flight段，
+    还没有测过速度的节点只给一段。超过stall_timeout没有返回的段从这个节点收回重新分配，这个节点的速度减半。
+    收到的段先放在缓冲区，从下一个要连接的高度开始连续的段按顺序接到本地链上。
+    只请求下一个要连接的高度之后max_buffer_chunks段以内的区块，缓冲区的大小有上限，
+    总的下载速度是所有节点速度的和，不会被最慢的节点拖住。
+"""
+import asyncio
+import heapq
+import logging
+import math
+import time
+
+from p2p_minner.block_chain import BLOCK_BIN_LEN
+from p2p_minner.header_sync import MAX_HEADERS_PER_MESSAGE, connect_headers
+
+log = logging.getLogger(__name__)
+
+# 下载速度的指数移动平均系数
+THROUGHPUT_ALPHA = 0.5
+
+
+class DownloadChunk:
+    def __init__(self, start_height, count):
+        self.start_height = start_height
+        self.count = count
+        self.request_id = None
+        self.requested_at = 0
+        self.attempts = 0
+
+    def __lt__(self, other):
+        # 未分配的段按高度排序，收回的段也会先被重新分配
+        return self.start_height < other.start_height
+
+
+class PeerDownloadState:
+    def __init__(self, peer, tip_height):
+        self.peer = peer
+        self.tip_height = tip_height
+        self.in_flight = {}  # request_id -> DownloadChunk
+        self.throughput = None  # 区块/秒，还没有收到过数据时为None
+        self.received_count = 0
+        self.stalls = 0
+
+    def window(self, best_throughput, max_in_flight):
+        # 在途的段数和速度成正比
+        if self.throughput is None or not best_throughput:
+            return 1
+        return max(1, min(max_in_flight, math.ceil(max_in_flight * self.throughput / best_throughput)))
+
+    def stats(self):
+        return {'tip_height': self.tip_height, 'in_flight': len(self.in_flight), 'throughput': self.throughput,
+                'received': self.received_count, 'stalls': self.stalls}
+
+
+class BlockDownloader:
+    def __init__(self, chian, chunk_size=500, max_in_flight=4, max_buffer_chunks=32, stall_timeout=10,
+                 on_fork=None):
+        """
+        :param chian: BlockChain或者ColumnarBlockChain
+        :param chunk_size: 每个请求的区块数量
+        :param max_in_flight: 每个节点最多同时在途的请求数量
+        :param max_buffer_chunks: 下一个要连接的高度之后最多请求多少段
+        :param stall_timeout: 请求超过这个时间(秒)没有返回就重新分配给其它节点
+        :param on_fork: 下载的区块接不上本地链时调用 on_fork(peer)，用locator同步找分叉点
+        """
+        self.chian = chian
+        self.chunk_size = min(chunk_size, MAX_HEADERS_PER_MESSAGE)
+        self.max_in_flight = max_in_flight
+        self.max_buffer_chunks = max_buffer_chunks
+        self.stall_timeout = stall_timeout
+        self.on_fork = on_fork
+        self.peers = {}  # node_id -> PeerDownloadState
+        self.unassigned = []  # 未分配的段，按起始高度的堆
+        self.ready = {}  # 起始高度 -> (区块数据, node_id)，已经收到还没有接到链上的段
+        self.request_seq = 0
+        self.next_height = None  # 下一个要连接的高度
+        self.next_chunk_height = None  # 下一个要切段的高度
+        self.target_height = 0
+        self.connected_count = 0
+        self.started_at = 0
+
+    def is_downloading(self):
+        return self.next_height is not None
+
+    def _local_height(self):
+        tip = self.chian.get_best_tip()
+        return tip.height if tip else 0
+
+    def _peer_state(self, peer):
+        state = self.peers.get(peer.node_id)
+        return state if state is not None and state.peer is peer else None
+
+    async def add_peer(self, peer, tip_height):
+        """
+            新连接的节点，对方的链比本地长时开始下载，返回是否需要从它下载
+        """
+        self.peers[peer.node_id] = PeerDownloadState(peer, tip_height)
+        if tip_height <= self._local_height():
+            return False
+        await self.update_peer_tip(peer, tip_height)
+        return True
+
+    async def update_peer_tip(self, peer, tip_height):
+        state = self._peer_state(peer)
+        if state is None:
+            return
+        state.tip_height = max(state.tip_height, tip_height)
+        if state.tip_height > max(self.target_height, self._local_height()):
+            if self.next_height is None:
+                self.started_at = time.time()
+                self.connected_count = 0
+                self.next_height = self.next_chunk_height = self._local_height() + 1
+                log.debug(f'开始并行下载区块，本地高度:{self.next_height - 1}，目标高度:{state.tip_height}')
+            self.target_height = state.tip_height
+        await self.schedule()
+
+    def remove_peer(self, peer):
+        # 断开的节点在途的段全部收回
+        state = self._peer_state(peer)
+        if state is None:
+            return
+        del self.peers[peer.node_id]
+        for chunk in state.in_flight.values():
+            heapq.heappush(self.unassigned, chunk)
+
+    def reset(self):
+        for state in self.peers.values():
+            state.in_flight.clear()
+        self.unassigned.clear()
+        self.ready.clear()
+        self.next_height = self.next_chunk_height = None
+        self.target_height = 0
+
+    def _split_chunks(self):
+        # 只切滑动窗口内的段
+        window_end = self.next_height + self.max_buffer_chunks * self.chunk_size
+        while self.next_chunk_height <= self.target_height and self.next_chunk_height < window_end:
+            count = min(self.chunk_size, self.target_height - self.next_chunk_height + 1)
+            heapq.heappush(self.unassigned, DownloadChunk(self.next_chunk_height, count))
+            self.next_chunk_height += count
+
+    def _pick_peer(self, chunk, best_throughput):
+        """
+            按速度估算完成时间，选最早完成的节点，没有测过速度的节点按最快的速度估算。
+            预计会超时的慢节点只在没有其它节点可用时使用，有快的节点时等它空出窗口
+        """
+        best, best_finish, has_fast_peer = None, None, False
+        for state in self.peers.values():
+            if state.tip_height < chunk.start_height + chunk.count - 1:
+                continue
+            rate = state.throughput or best_throughput
+            chunk_time = chunk.count / rate if rate else 0
+            has_fast_peer = has_fast_peer or chunk_time <= self.stall_timeout
+            if len(state.in_flight) >= state.window(best_throughput, self.max_in_flight):
+                continue
+            finish = (len(state.in_flight) + 1) * chunk_time
+            if best is None or finish < best_finish:
+                best, best_finish = state, finish
+        if best is not None and has_fast_peer and best_finish > self.stall_timeout * (len(best.in_flight) + 1):
+            return None
+        return best
+
+    async def schedule(self):
+        """
+            切分滑动窗口内的段，分配给有空闲窗口的节点
+        """
+        if self.next_height is None:
+            return
+        local_height = self._local_height()
+        if local_height >= self.target_height and not self.ready:
+            # 已经从其它途径同步到了目标高度
+            self.reset()
+            return
+        if all(state.tip_height <= local_height for state in self.peers.values()):
+            log.debug('没有比本地链更长的节点，停止并行下载')
+            self.reset()
+            return
+        self._split_chunks()
+        best_throughput = max((state.throughput for state in self.peers.values() if state.throughput), default=0)
+        requests = []
+        skipped = []
+        while self.unassigned:
+            chunk = heapq.heappop(self.unassigned)
+            if chunk.start_height + chunk.count - 1 <= local_height:
+                continue  # 已经从其它途径接到链上了
+            state = self._pick_peer(chunk, best_throughput)
+            if state is None:
+                skipped.append(chunk)
+                continue
+            self.request_seq += 1
+            chunk.request_id = self.request_seq
+            chunk.requested_at = time.time()
+            chunk.attempts += 1
+            state.in_flight[chunk.request_id] = chunk
+            requests.append((state.peer, chunk))
+        for chunk in skipped:
+            heapq.heappush(self.unassigned, chunk)
+        # 先分配完再发送，发送失败时节点会被移除，段会被收回
+        for peer, chunk in requests:
+            await peer.send_message('getblocks', {'start_height': chunk.start_height, 'count': chunk.count,
+                                                  'request_id': chunk.request_id})
+
+    async def check_stalls(self, now=None):
+        """
+            收回超时的段重新分配
+        """
+        now = now or time.time()
+        for state in list(self.peers.values()):
+            stalled = [request_id for request_id, chunk in state.in_flight.items()
+                       if now - chunk.requested_at > self.stall_timeout]
+            for request_id in stalled:
+                chunk = state.in_flight.pop(request_id)
+                heapq.heappush(self.unassigned, chunk)
+                log.debug(f'节点{state.peer.node_id}下载高度{chunk.start_height}开始的区块超时，重新分配')
+            if stalled:
+                # 按超时时间内最多下载一段估算速度再减半，有其它节点时不再给它分配
+                state.stalls += 1
+                state.throughput = min(state.throughput or math.inf, self.chunk_size / self.stall_timeout) / 2
+        await self.schedule()
+
+    async def run(self, interval=1):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.check_stalls()
+            except Exception:
+                log.exception('区块下载调度失败')
+
+    async def on_getblocks(self, peer, payload):
+        start_height = int(payload.get('start_height'))
+        count = min(int(payload.get('count') or self.chunk_size), MAX_HEADERS_PER_MESSAGE)
+        data = b''.join(self.chian.iter_chunks(start_height, start_height + count, chunk_blocks=count))
+        await peer.send_binary_message('blocks', data, request_id=payload.get('request_id'),
+                                       start_height=start_height, tip_height=self._local_height())
+
+    async def on_blocks(self, peer, payload):
+        """
+            处理blocks响应，更新节点的速度，连续的段接到链上
+        """
+        state = self._peer_state(peer)
+        chunk = state.in_flight.pop(payload.get('request_id'), None) if state is not None else None
+        if chunk is None:
+            # 已经超时重新分配的请求，或者下载已经结束
+            return
+        data = bytes(payload.get('data', b''))
+        count = len(data) // BLOCK_BIN_LEN
+        if len(data) % BLOCK_BIN_LEN != 0 or payload.get('start_height') != chunk.start_height \
+                or count > chunk.count:
+            log.debug(f'节点{peer.node_id}返回的区块数据不正确')
+            heapq.heappush(self.unassigned, chunk)
+            state.tip_height = 0
+            await self.schedule()
+            return
+        elapsed = max(time.time() - chunk.requested_at, 1e-3)
+        sample = count / elapsed
+        state.throughput = sample if state.throughput is None else \
+            THROUGHPUT_ALPHA * sample + (1 - THROUGHPUT_ALPHA) * state.throughput
+        state.received_count += count
+        # 对方的链比分配时短，剩下的区块重新分配给其它节点
+        state.tip_height = min(payload.get('tip_height', 0), chunk.start_height + count - 1) \
+            if count < chunk.count else max(state.tip_height, payload.get('tip_height', 0))
+        if count < chunk.count:
+            heapq.heappush(self.unassigned, DownloadChunk(chunk.start_height + count, chunk.count - count))
+        if count:
+            self.ready[chunk.start_height] = (data, peer.node_id)
+        failed_peer = self._connect_ready()
+        if failed_peer is not None:
+            state = self.peers.get(failed_peer)
+            log.debug(f'节点{failed_peer}的区块接不上本地链，停止并行下载')
+            self.reset()
+            if state is not None and self.on_fork is not None:
+                await self.on_fork(state.peer)
+            return
+        if self.next_height > self.target_height:
+            log.debug(f'并行下载完成，接入{self.connected_count}个区块，用时{time.time() - self.started_at:.2f}秒，'
+                      f'本地高度:{self._local_height()}')
+            self.reset()
+            return
+        await self.schedule()
+
+    def _connect_ready(self):
+        """
+            按高度顺序连接缓冲区中连续的段，接不上时返回提供数据的节点
+        """
+        self.next_height = max(self.next_height, self._local_height() + 1)
+        for start_height in [height for height in self.ready if height < self.next_height]:
+            # 部分区块已经从其它途径接到链上了，只保留后面的部分
+            data, node_id = self.ready.pop(start_height)
+            skip = self.next_height - start_height
+            if skip * BLOCK_BIN_LEN < len(data):
+                self.ready[self.next_height] = (data[skip * BLOCK_BIN_LEN:], node_id)
+        while self.next_height in self.ready:
+            data, node_id = self.ready.pop(self.next_height)
+            if not connect_headers(self.chian, data):
+                return node_id
+            count = len(data) // BLOCK_BIN_LEN
+            self.next_height += count
+            self.connected_count += count
+        return None
+
+    def stats(self):
+        return {
+            'next_height': self.next_height,
+            'target_height': self.target_height,
+            'unassigned': len(self.unassigned),
+            'ready': len(self.ready),
+            'connected': self.connected_count,
+            'peers': {node_id: state.stats() for node_id, state in self.peers.items()},
+        }
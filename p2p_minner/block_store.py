@@ -0,0 +1,144 @@
+"""
+    主链区块的本地存储。
+    blocks.dat 按高度顺序保存定长(BLOCK_BIN_LEN字节)的区块头，只在尾部追加，重组时从尾部截断。
+    index.dat 每条记录为 高度+区块hash，启动时直接用这里的hash，不需要重新计算整条链。
+    读取用mmap映射文件，不复制数据；启动时只截断不完整的尾部记录并重新验证最后几个区块。
+"""
+import hashlib
+import logging
+import mmap
+import os
+import struct
+
+from p2p_minner.block_chain import Block, BLOCK_BIN_LEN, ZERO_HASH
+
+log = logging.getLogger(__name__)
+
+INDEX_FORMAT = '<I32s' # 高度 + 区块hash
+INDEX_LEN = struct.calcsize(INDEX_FORMAT)
+BLOCK_FILE_NAME = 'blocks.dat'
+INDEX_FILE_NAME = 'index.dat'
+
+
+class BlockStore:
+    def __init__(self, data_dir, sync_every=100, verify_tail=64):
+        """
+        :param data_dir: 数据目录，一般为配置中的p2p.data_dir
+        :param sync_every: 每追加多少个区块fsync一次
+        :param verify_tail: 启动时重新验证最后多少个区块
+        """
+        self.data_dir = data_dir
+        self.sync_every = sync_every
+        self.unsynced = 0
+        os.makedirs(data_dir, exist_ok=True)
+        self.block_path = os.path.join(data_dir, BLOCK_FILE_NAME)
+        self.index_path = os.path.join(data_dir, INDEX_FILE_NAME)
+        for path in (self.block_path, self.index_path):
+            if not os.path.exists(path):
+                open(path, 'wb').close()
+        self.block_file = open(self.block_path, 'r+b')
+        self.index_file = open(self.index_path, 'r+b')
+        self.count = 0
+        self._map = None
+        self._recover(verify_tail)
+
+    def _recover(self, verify_tail):
+        # 进程崩溃时尾部可能只写了一半，先按两个文件都完整的记录数截断
+        block_count = os.path.getsize(self.block_path) // BLOCK_BIN_LEN
+        index_count = os.path.getsize(self.index_path) // INDEX_LEN
+        self._truncate_files(min(block_count, index_count))
+        # 再验证尾部区块的hash、高度和prev_hash链接，从第一个不一致的地方截断
+        start = max(self.count - verify_tail, 0)
+        prev_hash = self.index_record(start - 1)[1] if start > 0 else None
+        with self.view() as view:
+            for index in range(start, self.count):
+                record = bytes(view[index * BLOCK_BIN_LEN:(index + 1) * BLOCK_BIN_LEN])
+                block = Block.deserialize(record)
+                height, block_hash = self.index_record(index)
+                expected_prev = ZERO_HASH if index == 0 else prev_hash
+                if (hashlib.sha256(record).digest() != block_hash or block.height != height
+                        or block.prev_hash != expected_prev or not block.is_validate()):
+                    log.warning(f'区块存储尾部第{index}个区块不一致，截断到{index}个区块')
+                    break
+                prev_hash = block_hash
+            else:
+                index = self.count
+        self._truncate_files(index)
+        log.debug(f'区块存储打开成功，区块数:{self.count}')
+
+    def _truncate_files(self, count):
+        self._close_map()
+        self.block_file.truncate(count * BLOCK_BIN_LEN)
+        self.index_file.truncate(count * INDEX_LEN)
+        self.block_file.seek(0, os.SEEK_END)
+        self.index_file.seek(0, os.SEEK_END)
+        self.count = count
+
+    def _close_map(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def view(self):
+        """
+            返回区块文件的memoryview，通过mmap映射不复制数据。用完后需要release(可以用with)
+        """
+        if self.count == 0:
+            return memoryview(b'')
+        self.block_file.flush()
+        size = self.count * BLOCK_BIN_LEN
+        if self._map is None or len(self._map) != size:
+            self._close_map()
+            self._map = mmap.mmap(self.block_file.fileno(), size, access=mmap.ACCESS_READ)
+        return memoryview(self._map)
+
+    def index_record(self, index):
+        self.index_file.flush()
+        self.index_file.seek(index * INDEX_LEN)
+        record = self.index_file.read(INDEX_LEN)
+        self.index_file.seek(0, os.SEEK_END)
+        return struct.unpack(INDEX_FORMAT, record)
+
+    def hashes(self):
+        # 按高度顺序返回所有区块hash
+        self.index_file.flush()
+        with open(self.index_path, 'rb') as f:
+            data = f.read(self.count * INDEX_LEN)
+        return [block_hash for _, block_hash in struct.iter_unpack(INDEX_FORMAT, data)]
+
+    def append(self, block: Block):
+        self.block_file.write(block.serialize())
+        self.index_file.write(struct.pack(INDEX_FORMAT, block.height, block.hash()))
+        self.count += 1
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self.sync()
+
+    def append_records(self, data, first_height, hashes):
+        # 批量追加连续的区块头，写完后fsync一次
+        self.block_file.write(data)
+        self.index_file.write(b''.join(struct.pack(INDEX_FORMAT, first_height + index, block_hash)
+                                       for index, block_hash in enumerate(hashes)))
+        self.count += len(hashes)
+        self.sync()
+
+    def truncate(self, count):
+        # 重组断开区块时从尾部截断
+        if count < self.count:
+            self.block_file.flush()
+            self.index_file.flush()
+            self._truncate_files(count)
+            self.sync()
+
+    def sync(self):
+        self.block_file.flush()
+        self.index_file.flush()
+        os.fsync(self.block_file.fileno())
+        os.fsync(self.index_file.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        self.sync()
+        self._close_map()
+        self.block_file.close()
+        self.index_file.close()
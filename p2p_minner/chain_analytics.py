@@ -0,0 +1,204 @@
+"""
+    主链统计：出块间隔分布、滑动窗口难度、按难度和出块时间推算的全网算力、孤块率。
+    区块头是定长记录，主链一次序列化到连续内存后用numpy结构化dtype直接取出时间戳、bits、高度列，
+    ColumnarBlockChain直接复制它的列，不需要逐个区块遍历。之后的计算都在numpy数组上向量化完成。
+    ChainColumns.from_chain在event loop线程中取出链的快照(复制的数组)，之后的计算只使用快照，可以放到其它线程，
+    计算过程中链继续增加区块也不受影响。
+    控制台命令: analytics [窗口区块数] [导出文件.csv|.json]
+"""
+import csv
+import json
+import logging
+
+from config import BLOCK_STATUS_INVALID
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger(__name__)
+
+DEFAULT_WINDOW = 144
+DEFAULT_BINS = 20
+
+
+def _header_dtype():
+    # 和BLOCK_BIN_FORMAT一致: prev_hash + merkle_root + nonce + bits + timestamp + height
+    return np.dtype([('prev_hash', 'S32'), ('merkle_root', 'S32'), ('nonce', '<u4'), ('bits', 'u1', (4,)),
+                     ('timestamp', '<u4'), ('height', '<u4')])
+
+
+def _require_numpy():
+    if np is None:
+        raise Exception('区块链统计需要安装numpy')
+
+
+class ChainColumns:
+    """
+        主链的高度、时间戳、bits列和每个区块的工作量(平均需要的hash次数)，
+        tree_heights为区块树中主链和侧链区块的高度(不包括无效的区块)，只保存主链的链为None
+    """
+
+    def __init__(self, heights, timestamps, bits, tree_heights=None):
+        self.heights = heights.astype(np.int64)
+        self.timestamps = timestamps.astype(np.int64)
+        self.bits = bits  # (n, 4) uint8，compact格式的原始字节
+        self.work = bits_to_work(bits)
+        self.tree_heights = tree_heights
+
+    def __len__(self):
+        return len(self.heights)
+
+    @classmethod
+    def from_chain(cls, chian, start_height=None, end_height=None):
+        """
+            取出链的快照，需要在修改链的线程(event loop)中调用，返回的数组不引用链的内存
+        """
+        _require_numpy()
+        if hasattr(chian, 'column'):
+            # 按列存储的链复制它的列，列的视图不能在增加区块时还存在。bits按小端保存的是原始的4个字节
+            start, end = chian._height_range(start_height, end_height)
+            timestamps = np.array(chian.column('timestamps', start_height, end_height), copy=True)
+            bits = np.array(chian.column('bits', start_height, end_height), dtype='<u4', copy=True)
+            heights = np.arange(chian.first_height + start, chian.first_height + end)
+            return cls(heights, timestamps, bits.view(np.uint8).reshape(-1, 4))
+        headers = np.frombuffer(chian.serialize_into(start_height=start_height, end_height=end_height),
+                                dtype=_header_dtype())
+        # 无效的区块不是孤块
+        tree_heights = np.fromiter((entry.block.height for entry in chian.block_index.values()
+                                    if entry.status != BLOCK_STATUS_INVALID), dtype=np.int64)
+        return cls(headers['height'], headers['timestamp'], headers['bits'], tree_heights)
+
+
+def bits_to_work(bits):
+    """
+        向量化的compact_to_target + block_work，结果为float64:
+        target = 尾数 * 256^(指数-3)，work = 2^256 / (target + 1) 取整
+    """
+    exponent = bits[:, 0].astype(np.int64)
+    mantissa = (bits[:, 1].astype(np.int64) << 16) | (bits[:, 2].astype(np.int64) << 8) | bits[:, 3]
+    mantissa = np.where(mantissa & 0x800000, 0, mantissa & 0x7fffff)
+    with np.errstate(divide='ignore'):
+        return np.floor(np.ldexp(1.0 / mantissa, (256 - 8 * (exponent - 3)).astype(np.int32)))
+
+
+def moving_sum(values, window):
+    # 以每个位置结尾的窗口和，前面不足window个时为nan
+    sums = np.full(len(values), np.nan)
+    if len(values) >= window:
+        cumsum = np.concatenate(([0.0], np.cumsum(values, dtype=np.float64)))
+        sums[window - 1:] = cumsum[window:] - cumsum[:-window]
+    return sums
+
+
+def moving_difficulty(columns: ChainColumns, window=DEFAULT_WINDOW):
+    # 滑动窗口内每个区块的平均工作量
+    return moving_sum(columns.work, window) / window
+
+
+def implied_hashrate(columns: ChainColumns, window=DEFAULT_WINDOW):
+    """
+        窗口内后window-1个区块的工作量 / 窗口的时间跨度，第一个区块的工作量在窗口开始之前完成
+    """
+    rates = np.full(len(columns), np.nan)
+    if len(columns) >= window > 1:
+        span = (columns.timestamps[window - 1:] - columns.timestamps[:-window + 1]).astype(np.float64)
+        work = moving_sum(columns.work[1:], window - 1)[window - 2:]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rates[window - 1:] = np.where(span > 0, work / span, np.nan)
+    return rates
+
+
+def interval_stats(columns: ChainColumns, bins=DEFAULT_BINS):
+    intervals = np.diff(columns.timestamps)
+    if not len(intervals):
+        return {'count': 0}
+    counts, edges = np.histogram(intervals, bins=bins)
+    p50, p90, p99 = np.percentile(intervals, [50, 90, 99])
+    return {
+        'count': int(len(intervals)),
+        'mean': float(intervals.mean()),
+        'std': float(intervals.std()),
+        'min': int(intervals.min()),
+        'max': int(intervals.max()),
+        'p50': float(p50),
+        'p90': float(p90),
+        'p99': float(p99),
+        'histogram': {'edges': edges.tolist(), 'counts': counts.tolist()},
+    }
+
+
+def orphan_stats(columns: ChainColumns, window=DEFAULT_WINDOW):
+    """
+        区块树中不在主链上的区块数，按高度分成window个区块一段统计孤块率。
+        每段区块树中的区块数减去主链的区块数就是孤块数。只保存主链的链没有孤块信息
+    """
+    if columns.tree_heights is None or not len(columns):
+        return None
+    first_height, last_height = columns.heights[0], columns.heights[-1]
+    tree_heights = columns.tree_heights[(columns.tree_heights >= first_height) & (columns.tree_heights <= last_height)]
+    segments = (len(columns) + window - 1) // window
+    main_per_segment = np.bincount((columns.heights - first_height) // window, minlength=segments)
+    orphans_per_segment = np.bincount((tree_heights - first_height) // window, minlength=segments) - main_per_segment
+    orphans = int(orphans_per_segment.sum())
+    return {
+        'orphans': orphans,
+        'orphan_rate': orphans / (orphans + len(columns)),
+        'segment_rates': (orphans_per_segment / (orphans_per_segment + main_per_segment)).tolist(),
+    }
+
+
+def analyze(columns: ChainColumns, window=DEFAULT_WINDOW, bins=DEFAULT_BINS):
+    # 只使用快照，可以在其它线程中运行
+    hashrate = implied_hashrate(columns, window)
+    difficulty = moving_difficulty(columns, window)
+    report = {
+        'blocks': len(columns),
+        'window': window,
+        'intervals': interval_stats(columns, bins),
+        'difficulty': float(difficulty[-1]) if len(columns) >= window else None,
+        'hashrate': float(hashrate[-1]) if len(columns) >= window > 1 else None,
+        'orphans': orphan_stats(columns, window),
+    }
+    return report
+
+
+def export_csv(path, columns: ChainColumns, window=DEFAULT_WINDOW):
+    # 每个区块一行
+    intervals = np.concatenate(([np.nan], np.diff(columns.timestamps).astype(np.float64)))
+    rows = np.column_stack((columns.heights, columns.timestamps, intervals, columns.work,
+                            moving_difficulty(columns, window), implied_hashrate(columns, window)))
+    bits_hex = [bytes(row).hex() for row in columns.bits]
+    with open(path, 'w', newline='', encoding='utf8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['height', 'timestamp', 'interval', 'bits', 'work', 'moving_difficulty', 'hashrate'])
+        for row, bits in zip(rows.tolist(), bits_hex):
+            writer.writerow([int(row[0]), int(row[1]), '' if np.isnan(row[2]) else int(row[2]), bits, row[3],
+                             '' if np.isnan(row[4]) else row[4], '' if np.isnan(row[5]) else row[5]])
+
+
+def export_json(path, report):
+    with open(path, 'w', encoding='utf8') as f:
+        json.dump(report, f, indent=2)
+
+
+def run_analytics_command(columns: ChainColumns, args):
+    """
+        控制台命令: analytics [窗口区块数] [导出文件]，导出文件按扩展名导出csv或json。
+        columns是在event loop线程中取出的快照，这个函数在其它线程中运行
+    """
+    window, path = DEFAULT_WINDOW, None
+    for arg in args:
+        if arg.isdigit():
+            window = int(arg)
+        else:
+            path = arg
+    report = analyze(columns, window)
+    if path and path.endswith('.csv'):
+        export_csv(path, columns, window)
+        log.debug(f'区块统计已导出:{path}')
+    elif path:
+        export_json(path, report)
+        log.debug(f'区块统计已导出:{path}')
+    return report
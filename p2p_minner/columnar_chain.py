@@ -0,0 +1,442 @@
+"""
+    按列存储区块头的区块链，只保存主链，用于在内存中保存几千万个区块头。
+    区块hash和merkle_root放在连续的bytearray中，nonce、bits、timestamp放在array('I')中，
+    prev_hash就是上一个区块的hash，高度是起始高度加下标，这两列不需要单独保存。
+    只有调用方要区块的时候才临时创建Block对象。安装了numpy时区间统计直接在列上做向量化计算。
+"""
+import logging
+import operator
+import struct
+import sys
+import time
+from array import array
+
+from config import ADJUSTMENT_INTERVAL, TARGET_TIMESPAN
+from p2p_minner.ledger import check_coinbase
+from p2p_minner.block_chain import Block, BlockTemplate, BLOCK_BIN_FORMAT, BLOCK_BIN_LEN, MERKLE_ROOT_OFFSET, \
+    ZERO_HASH, hash_headers, retarget_bits, mine_nonce_range, locator_heights
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger(__name__)
+
+HASH_LEN = 32
+# 区块头按4字节一个字拆开后，nonce,bits,timestamp,height所在的字
+_WORDS_PER_HEADER = BLOCK_BIN_LEN // 4
+_NONCE_WORD, _BITS_WORD, _TIMESTAMP_WORD, _HEIGHT_WORD = 16, 17, 18, 19
+# bits是4个原始字节，按小端整数保存在array中
+_BITS_STRUCT = struct.Struct('<I')
+_HEADER_STRUCT = struct.Struct(BLOCK_BIN_FORMAT)
+
+
+def _bits_to_word(bits: bytes):
+    return _BITS_STRUCT.unpack(bits)[0]
+
+
+def _word_to_bits(word: int):
+    return _BITS_STRUCT.pack(word)
+
+
+def _column(words: memoryview, word_index):
+    # 从按字拆开的区块头中取出一列，strided memoryview直接复制到array，不经过python对象
+    column = array('I')
+    column.frombytes(words[word_index::_WORDS_PER_HEADER].tobytes())
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column
+
+
+class HashIndexTable:
+    """
+        区块hash -> 区块下标的开放寻址哈希表。槽位放在array('q')中，每个区块平均只占十几个字节，
+        不为每个区块创建dict条目。hash前面是pow产生的0，所以用hash最后8个字节做key
+    """
+
+    def __init__(self, hashes: bytearray, capacity=1024):
+        self.hashes = hashes  # 和ColumnarBlockChain共享的hash列
+        self.slots = array('q', [0]) * capacity  # 值为下标+1，0表示空槽
+        self.mask = capacity - 1
+        self.size = 0
+
+    @staticmethod
+    def _key(block_hash):
+        return int.from_bytes(block_hash[HASH_LEN - 8:HASH_LEN], byteorder='little')
+
+    def insert(self, block_hash, index):
+        if (self.size + 1) * 2 > len(self.slots):
+            self._grow()
+        slot = self._key(block_hash) & self.mask
+        while self.slots[slot]:
+            slot = (slot + 1) & self.mask
+        self.slots[slot] = index + 1
+        self.size += 1
+
+    def find(self, block_hash):
+        slot = self._key(block_hash) & self.mask
+        while True:
+            value = self.slots[slot]
+            if value == 0:
+                return -1
+            offset = (value - 1) * HASH_LEN
+            if self.hashes[offset:offset + HASH_LEN] == block_hash:
+                return value - 1
+            slot = (slot + 1) & self.mask
+
+    def _grow(self):
+        capacity = len(self.slots) * 2
+        self.slots = array('q', [0]) * capacity
+        self.mask = capacity - 1
+        count, self.size = self.size, 0
+        for index in range(count):
+            self.insert(bytes(self.hashes[index * HASH_LEN:(index + 1) * HASH_LEN]), index)
+
+
+class ColumnarBlockChain:
+    def __init__(self, genesis_bits=None, create_genesis=True, adjustment_interval=ADJUSTMENT_INTERVAL,
+                 target_timespan=TARGET_TIMESPAN, checkpoints=None, assume_valid=False):
+        self.hashes = bytearray()
+        self.merkle_roots = bytearray()
+        self.nonces = array('I')
+        self.bits = array('I')
+        self.timestamps = array('I')
+        self.first_height = 1
+        self.hash_table = HashIndexTable(self.hashes)
+        self.genesis_bits = genesis_bits or Block.DEFAULT_BITS
+        self.adjustment_interval = adjustment_interval
+        self.target_timespan = target_timespan
+        # 本地区块存储(BlockStore)，为None时区块只保存在内存中
+        self.store = None
+        # 检查点和assume-valid高度，和BlockChain一样
+        self.checkpoints = checkpoints or {}
+        self.assume_valid_height = max(self.checkpoints, default=0) if assume_valid else 0
+        if create_genesis:
+            self._init_genesis_block()
+
+    def _init_genesis_block(self):
+        if self.block_len():
+            return
+        genesis_template = BlockTemplate(ZERO_HASH, 0, self.genesis_bits, int(time.time()), height=1)
+        nonce = mine_nonce_range(genesis_template)
+        while nonce is None:
+            genesis_template.timestamp += 1
+            nonce = mine_nonce_range(genesis_template)
+        if not self.add_block(genesis_template.to_block(nonce)):
+            raise Exception('创始区块创建失败')
+
+    @classmethod
+    def load(cls, store, genesis_bits=None, checkpoints=None, assume_valid=False):
+        # 从本地区块存储启动，存储中的hash直接使用
+        block_chian = cls(genesis_bits, create_genesis=False, checkpoints=checkpoints, assume_valid=assume_valid)
+        if store.count:
+            with store.view() as view:
+                if not block_chian.import_headers(view, known_hashes=store.hashes()):
+                    raise Exception(f'区块存储数据无效:{store.data_dir}')
+        block_chian.store = store
+        block_chian._init_genesis_block()
+        return block_chian
+
+    def block_len(self):
+        return len(self.nonces)
+
+    def reset_chian(self, create_genesis=True):
+        self.hashes = bytearray()
+        self.merkle_roots = bytearray()
+        self.nonces = array('I')
+        self.bits = array('I')
+        self.timestamps = array('I')
+        self.hash_table = HashIndexTable(self.hashes)
+        if self.store:
+            self.store.truncate(0)
+        if create_genesis:
+            self._init_genesis_block()
+
+    def _hash_at(self, index):
+        return bytes(self.hashes[index * HASH_LEN:(index + 1) * HASH_LEN])
+
+    def _merkle_root_at(self, index):
+        return bytes(self.merkle_roots[index * HASH_LEN:(index + 1) * HASH_LEN])
+
+    def _block_at(self, index):
+        # 按需创建Block视图，只有区块头
+        prev_hash = self._hash_at(index - 1) if index > 0 else ZERO_HASH
+        block = Block(prev_hash, self.nonces[index], _word_to_bits(self.bits[index]), self.timestamps[index],
+                      self.first_height + index, self._merkle_root_at(index))
+        block._hash = self._hash_at(index)
+        return block
+
+    def get_best_tip(self):
+        if not self.block_len():
+            return None
+        return self._block_at(self.block_len() - 1)
+
+    def get_by_height(self, height: int):
+        index = height - self.first_height
+        if index < 0 or index >= self.block_len():
+            return None
+        return self._block_at(index)
+
+    def get_by_hash(self, block_hash: bytes):
+        index = self.hash_table.find(block_hash)
+        if index < 0:
+            return None
+        return self._block_at(index)
+
+    def contains(self, block_hash: bytes):
+        return self.hash_table.find(block_hash) >= 0
+
+    def is_main_chain(self, block: Block):
+        return self.contains(block.hash())
+
+    def block_locator(self):
+        if not self.block_len():
+            return []
+        tip_height = self.first_height + self.block_len() - 1
+        return [self._hash_at(height - self.first_height) for height in locator_heights(self.first_height, tip_height)]
+
+    def find_fork_height(self, locator):
+        for block_hash in locator:
+            index = self.hash_table.find(block_hash)
+            if index >= 0:
+                return self.first_height + index
+        return None
+
+    def recent_blocks(self, count=10):
+        return [self._block_at(index) for index in range(max(self.block_len() - count, 0), self.block_len())]
+
+    def _timestamp_at_height(self, height):
+        return self.timestamps[height - self.first_height]
+
+    def next_tip_bits(self):
+        # 主链tip之后下一个区块的难度，周期开始区块的时间戳直接按高度从列中取
+        tip_index = self.block_len() - 1
+        tip_height = self.first_height + tip_index
+        tip_bits = _word_to_bits(self.bits[tip_index])
+        if tip_height % self.adjustment_interval != 0:
+            return tip_bits
+        first_height = max(tip_height - self.adjustment_interval, 1)
+        return retarget_bits(tip_bits, self._timestamp_at_height(first_height), self.timestamps[tip_index],
+                             self.target_timespan)
+
+    def add_block(self, block: Block, peer_id=None):
+        """
+            增加区块，这里只保存主链，新区块必须接在tip后面，没有孤块池
+        """
+        if not self.block_len():
+            if block.prev_hash != ZERO_HASH:
+                log.debug('add block fail,block#0 prev hash must be empty ')
+                return False
+            self.first_height = block.height
+        else:
+            tip_index = self.block_len() - 1
+            if block.prev_hash != self._hash_at(tip_index):
+                log.debug('add block fail,new block prev_hash dont match prev block hash. ')
+                return False
+            if block.height != self.first_height + tip_index + 1:
+                log.debug('new block height not match')
+                return False
+            if block.bits != self.next_tip_bits():
+                log.debug('add block fail,new block bits dont match required bits')
+                return False
+        if not block.is_validate():
+            log.debug('block add fail,block invali')
+            return False
+        if not block.check_size() or not block.check_merkle_root() or not check_coinbase(block):
+            log.debug('add block fail,block transactions invalid')
+            return False
+        if self.checkpoints.get(block.height, block.hash()) != block.hash():
+            log.debug(f'add block fail,block hash dont match checkpoint at height {block.height}')
+            return False
+        index = self.block_len()
+        self.hashes += block.hash()
+        self.merkle_roots += block.merkle_root
+        self.nonces.append(block.nonce)
+        self.bits.append(_bits_to_word(block.bits))
+        self.timestamps.append(block.timestamp)
+        self.hash_table.insert(block.hash(), index)
+        if self.store:
+            self.store.append(block)
+        return True
+
+    def import_headers(self, byte_datas, workers=None, known_hashes=None):
+        """
+            批量导入连续的区块头，接在tip后面。nonce、bits、timestamp、height列直接从按字拆开的
+            memoryview中切出来，高度和难度按列整体比较，不为每个区块创建对象。
+            assume-valid模式下最后一个检查点及之前的区块不验证pow和难度，只检查hash链接和检查点。
+            有一个区块不合法就整批都不导入，返回False
+        """
+        view = memoryview(byte_datas).cast('B')
+        if len(view) % BLOCK_BIN_LEN != 0:
+            log.debug(f'import fail,data length {len(view)} is not a multiple of {BLOCK_BIN_LEN}')
+            return False
+        count = len(view) // BLOCK_BIN_LEN
+        if not count:
+            return True
+        if known_hashes is not None:
+            hashes = known_hashes
+            if len(hashes) != count:
+                log.debug('import fail,known hashes count dont match blocks count')
+                return False
+        else:
+            first_height = _HEADER_STRUCT.unpack_from(view)[5]
+            assume_valid_count = max(0, min(count, self.assume_valid_height - first_height + 1))
+            hashes, first_invalid = hash_headers(view, workers, assume_valid_count=assume_valid_count)
+            if first_invalid >= 0:
+                log.debug(f'import fail,block #{first_invalid} pow invalid')
+                return False
+        words = view.cast('I')
+        nonces = _column(words, _NONCE_WORD)
+        bits = _column(words, _BITS_WORD)
+        timestamps = _column(words, _TIMESTAMP_WORD)
+        heights = _column(words, _HEIGHT_WORD)
+        words.release()
+        start_height = heights[0] if not self.block_len() else self.first_height + self.block_len()
+        if heights != array('I', range(start_height, start_height + count)):
+            log.debug('import fail,block heights are not continuous')
+            return False
+        # prev_hash链接关系
+        prev_hash = self._hash_at(self.block_len() - 1) if self.block_len() else ZERO_HASH
+        for index in range(count):
+            offset = index * BLOCK_BIN_LEN
+            if view[offset:offset + HASH_LEN] != prev_hash:
+                log.debug(f'import fail,block #{index} prev_hash dont match prev block hash')
+                return False
+            prev_hash = hashes[index]
+        for height, checkpoint in self.checkpoints.items():
+            if start_height <= height < start_height + count and hashes[height - start_height] != checkpoint:
+                log.debug(f'import fail,block hash dont match checkpoint at height {height}')
+                return False
+        if not self._check_bits_column(bits, timestamps, start_height,
+                                       max(0, min(count, self.assume_valid_height - start_height + 1))):
+            return False
+        if not self.block_len():
+            self.first_height = start_height
+        first_index = self.block_len()
+        self.hashes += b''.join(hashes)
+        self.merkle_roots += b''.join(view[offset + MERKLE_ROOT_OFFSET:offset + MERKLE_ROOT_OFFSET + HASH_LEN]
+                                      for offset in range(0, len(view), BLOCK_BIN_LEN))
+        self.nonces.extend(nonces)
+        self.bits.extend(bits)
+        self.timestamps.extend(timestamps)
+        for index, block_hash in enumerate(hashes):
+            self.hash_table.insert(block_hash, first_index + index)
+        if self.store:
+            self.store.append_records(view, start_height, hashes)
+        return True
+
+    def _check_bits_column(self, bits: array, timestamps: array, start_height, check_from=0):
+        """
+            按难度调整周期分段检查bits列：同一周期内bits必须相同，周期开始时等于按上个周期用时调整后的难度。
+            从下标check_from开始检查，前面是assume-valid不检查难度的区块
+        """
+
+        def timestamp_at(height):
+            if height < start_height:
+                return self._timestamp_at_height(height)
+            return timestamps[height - start_height]
+
+        count = len(bits)
+        if check_from > 0:
+            prev_word = bits[check_from - 1]
+        else:
+            prev_word = self.bits[-1] if self.block_len() else None
+        pos = check_from
+        while pos < count:
+            height = start_height + pos
+            if prev_word is None:
+                # 创世区块
+                segment_word = bits[0]
+            elif (height - 1) % self.adjustment_interval == 0:
+                first_height = max(height - 1 - self.adjustment_interval, 1)
+                segment_word = _bits_to_word(retarget_bits(_word_to_bits(prev_word), timestamp_at(first_height),
+                                                           timestamp_at(height - 1), self.target_timespan))
+            else:
+                segment_word = prev_word
+            # 这一段到下一个需要调整难度的区块之前结束
+            segment_end = min(((height - 1) // self.adjustment_interval + 1) * self.adjustment_interval + 1
+                              - start_height, count)
+            segment = bits[pos:segment_end]
+            if segment.count(segment_word) != len(segment):
+                log.debug(f'import fail,block bits dont match required bits near height {height}')
+                return False
+            prev_word = segment_word
+            pos = segment_end
+        return True
+
+    def _height_range(self, start_height=None, end_height=None):
+        start = 0 if start_height is None else max(start_height - self.first_height, 0)
+        end = self.block_len() if end_height is None else min(end_height - self.first_height, self.block_len())
+        return start, max(start, end)
+
+    def iter_chunks(self, start_height=None, end_height=None, chunk_blocks=1024):
+        # 从列重新拼出定长区块头，每块最多chunk_blocks个区块
+        start, end = self._height_range(start_height, end_height)
+        pack_into = _HEADER_STRUCT.pack_into
+        for chunk_start in range(start, end, chunk_blocks):
+            chunk_end = min(chunk_start + chunk_blocks, end)
+            buffer = bytearray((chunk_end - chunk_start) * BLOCK_BIN_LEN)
+            for index in range(chunk_start, chunk_end):
+                prev_hash = self.hashes[(index - 1) * HASH_LEN:index * HASH_LEN] if index > 0 else ZERO_HASH
+                pack_into(buffer, (index - chunk_start) * BLOCK_BIN_LEN, bytes(prev_hash),
+                          self._merkle_root_at(index), self.nonces[index],
+                          _word_to_bits(self.bits[index]), self.timestamps[index], self.first_height + index)
+            yield bytes(buffer)
+
+    def serialize(self):
+        return b''.join(self.iter_chunks())
+
+    def write_to(self, stream, start_height=None, end_height=None, chunk_blocks=1024):
+        write = getattr(stream, 'sendall', None) or stream.write
+        total = 0
+        for chunk in self.iter_chunks(start_height, end_height, chunk_blocks):
+            write(chunk)
+            total += len(chunk)
+        return total
+
+    def check_chian(self, full=False, workers=None):
+        """
+            区块在增加和导入时已经验证过，默认直接返回。
+            full=True时为审计模式，重新计算所有区块头的hash，和hash列比较并验证pow
+        """
+        if not full:
+            return True
+        hashes, first_invalid = hash_headers(memoryview(self.serialize()), workers)
+        return first_invalid < 0 and b''.join(hashes) == self.hashes
+
+    def column(self, name, start_height=None, end_height=None):
+        """
+            按高度区间取一列(nonces, bits, timestamps)，有numpy时返回不复制数据的numpy数组。
+            返回的数组引用着列的内存，释放之前不能再增加区块
+        """
+        start, end = self._height_range(start_height, end_height)
+        data = getattr(self, name)
+        if np is not None:
+            return np.frombuffer(data, dtype=np.uint32)[start:end]
+        return memoryview(data)[start:end]
+
+    def timestamp_stats(self, start_height=None, end_height=None):
+        """
+            区间内的时间戳统计：区块数、最早最晚时间、平均/最小/最大出块间隔(秒)
+        """
+        timestamps = self.column('timestamps', start_height, end_height)
+        count = len(timestamps)
+        if count == 0:
+            return {'count': 0}
+        stats = {
+            'count': count,
+            'min_timestamp': int(min(timestamps)) if np is None else int(timestamps.min()),
+            'max_timestamp': int(max(timestamps)) if np is None else int(timestamps.max()),
+            'mean_interval': (int(timestamps[-1]) - int(timestamps[0])) / (count - 1) if count > 1 else 0,
+        }
+        if count > 1:
+            if np is not None:
+                intervals = np.diff(timestamps.astype(np.int64))
+                stats['min_interval'] = int(intervals.min())
+                stats['max_interval'] = int(intervals.max())
+            else:
+                intervals = list(map(operator.sub, timestamps[1:], timestamps[:-1]))
+                stats['min_interval'] = min(intervals)
+                stats['max_interval'] = max(intervals)
+        return stats
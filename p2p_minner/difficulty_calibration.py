@@ -0,0 +1,109 @@
+"""
+    难度校准：在本机上运行真实的挖矿内核(mine_nonce_range)测出单个挖矿worker的hash速度，
+    按目标出块间隔和全网挖矿worker数量算出创世区块的bits，可以直接写到yaml配置的genesis_bits中。
+    python -m p2p_minner.difficulty_calibration --interval 60 --miners 4
+    python -m p2p_minner.difficulty_calibration --interval 10 --miners 2 --write config/node11_config.yaml
+"""
+import argparse
+import json
+import re
+import statistics
+import time
+
+import yaml
+
+from p2p_minner.block_chain import Block, BlockTemplate, MAX_TARGET, block_work, mine_nonce_range, target_to_compact
+
+# 用不可能满足的目标值，挖矿内核一直跑到测量时间结束
+_IMPOSSIBLE_TARGET = b'\x00' * 32
+_GENESIS_BITS_LINE = re.compile(r'^(\s+)genesis_bits:.*$', re.MULTILINE)
+
+
+def measure_hashrate(seconds=1.0, rounds=3, check_interval=10000):
+    """
+        运行挖矿内核rounds轮，每轮seconds秒，返回每轮的hash速度(hash/秒)
+    """
+    template = BlockTemplate(b'\x11' * 32, 0, Block.DEFAULT_BITS, int(time.time()), 2)
+    rates = []
+    for _ in range(rounds):
+        hashes = 0
+
+        def on_progress(count):
+            nonlocal hashes
+            hashes += count
+
+        start = time.perf_counter()
+        deadline = start + seconds
+        mine_nonce_range(template, should_stop=lambda: time.perf_counter() >= deadline,
+                         check_interval=check_interval, on_progress=on_progress, target=_IMPOSSIBLE_TARGET)
+        rates.append(hashes / (time.perf_counter() - start))
+    return rates
+
+
+def bits_for_interval(hashrate, interval, miners=1):
+    """
+        全网算力为hashrate * miners时，平均interval秒出一个区块的bits。
+        一个区块平均需要 2^256 / (target + 1) 次hash
+    """
+    expected_hashes = max(hashrate * miners * interval, 1)
+    target = min((1 << 256) // int(expected_hashes) - 1, MAX_TARGET)
+    return target_to_compact(target)
+
+
+def expected_interval(bits, hashrate, miners=1):
+    # 按bits的实际工作量算出的平均出块间隔(秒)，compact格式会丢掉一些精度
+    return block_work(bits) / (hashrate * miners)
+
+
+def calibrate(interval, miners=1, seconds=1.0, rounds=3):
+    rates = measure_hashrate(seconds, rounds)
+    # 取中位数，避免某一轮被其它进程干扰
+    hashrate = statistics.median(rates)
+    bits = bits_for_interval(hashrate, interval, miners)
+    return {
+        'hashrate': hashrate,
+        'rounds': rates,
+        'miners': miners,
+        'target_interval': interval,
+        'bits': bits.hex(),
+        'expected_interval': expected_interval(bits, hashrate, miners),
+        'default_bits_interval': expected_interval(Block.DEFAULT_BITS, hashrate, miners),
+    }
+
+
+def write_genesis_bits(config_path, bits: bytes):
+    """
+        把genesis_bits写到yaml配置的p2p节点下，只改这一行，保留文件中的注释
+    """
+    with open(config_path, 'r', encoding='utf8') as f:
+        text = f.read()
+    value = f'genesis_bits: "{bits.hex()}" # 由difficulty_calibration生成'
+    if _GENESIS_BITS_LINE.search(text):
+        text = _GENESIS_BITS_LINE.sub(lambda match: match.group(1) + value, text, count=1)
+    else:
+        match = re.search(r'^p2p:[^\n]*\n', text, re.MULTILINE)
+        if match is None:
+            text = text.rstrip('\n') + f'\np2p:\n  {value}\n'
+        else:
+            text = text[:match.end()] + f'  {value}\n' + text[match.end():]
+    # 写入之前确认还是合法的yaml
+    if yaml.safe_load(text)['p2p']['genesis_bits'] != bits.hex():
+        raise Exception(f'写入genesis_bits失败:{config_path}')
+    with open(config_path, 'w', encoding='utf8') as f:
+        f.write(text)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='按本机挖矿速度计算难度')
+    parser.add_argument('--interval', type=float, default=60, help='目标出块间隔(秒)')
+    parser.add_argument('--miners', type=int, default=1, help='全网挖矿worker数量(每个worker一个cpu核)')
+    parser.add_argument('--seconds', type=float, default=1.0, help='每轮测量时间(秒)')
+    parser.add_argument('--rounds', type=int, default=3, help='测量轮数，取中位数')
+    parser.add_argument('--write', type=str, help='把genesis_bits写到这个yaml配置中')
+    args = parser.parse_args()
+
+    result = calibrate(args.interval, args.miners, args.seconds, args.rounds)
+    print(json.dumps(result, indent=2))
+    if args.write:
+        write_genesis_bits(args.write, bytes.fromhex(result['bits']))
+        print(f"genesis_bits {result['bits']} 已写入:{args.write}")
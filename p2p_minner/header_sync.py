@@ -0,0 +1,177 @@
+"""
+    区块头优先(headers-first)同步。
+    第一个getheaders请求带上block locator(从tip开始间隔指数增长的区块hash)，对方用它找到分叉点，从分叉点之后开始返回区块头。
+    之后按高度分批请求，保持pipeline_depth个请求在途，收到的批次按请求顺序接到本地链上。
+    内存中最多只有pipeline_depth批区块头，同步的时间和缺少的区块数成正比，和链的总长度无关。
+"""
+import logging
+import time
+from collections import deque
+
+from p2p_minner.block_chain import Block, BLOCK_BIN_LEN, ZERO_HASH
+
+log = logging.getLogger(__name__)
+
+# 一个headers消息最多包含的区块头数量
+MAX_HEADERS_PER_MESSAGE = 2000
+GENESIS_HEIGHT = 1
+
+
+class HeaderSync:
+    def __init__(self, chian, batch_size=MAX_HEADERS_PER_MESSAGE, pipeline_depth=4, max_restarts=3):
+        """
+        :param chian: BlockChain或者ColumnarBlockChain
+        :param batch_size: 每个请求的区块头数量
+        :param pipeline_depth: 同时在途的请求数量
+        :param max_restarts: 批次接不上本地链时(一般是对方在同步过程中重组了)重新用locator请求的次数
+        """
+        self.chian = chian
+        self.batch_size = min(batch_size, MAX_HEADERS_PER_MESSAGE)
+        self.pipeline_depth = pipeline_depth
+        self.max_restarts = max_restarts
+        self.sync_peer = None  # 当前正在同步的节点，同一时间只从一个节点同步
+        self.pending = deque()  # 在途请求 (request_id, 起始高度)，locator请求的起始高度为None
+        self.request_seq = 0
+        self.next_height = None  # 下一个要请求的高度
+        self.peer_tip_height = 0
+        self.restarts = 0
+        self.received_count = 0
+        self.started_at = 0
+
+    def is_syncing(self):
+        return self.sync_peer is not None
+
+    async def start(self, peer):
+        """
+            开始从peer同步，已经在同步时返回False
+        """
+        if self.sync_peer is not None:
+            return False
+        self.sync_peer = peer
+        self.restarts = 0
+        self.received_count = 0
+        self.started_at = time.time()
+        log.debug(f'开始从节点{peer.node_id}同步区块头')
+        await self._request_locator()
+        return True
+
+    def stop(self, peer=None):
+        # 同步结束或者同步节点断开
+        if peer is not None and peer is not self.sync_peer:
+            return
+        self.sync_peer = None
+        self.pending.clear()
+        self.next_height = None
+
+    async def _send_getheaders(self, start_height, payload):
+        self.request_seq += 1
+        self.pending.append((self.request_seq, start_height))
+        payload['request_id'] = self.request_seq
+        await self.sync_peer.send_message('getheaders', payload)
+
+    async def _request_locator(self):
+        self.pending.clear()
+        self.next_height = None
+        locator = [block_hash.hex() for block_hash in self.chian.block_locator()]
+        await self._send_getheaders(None, {'locator': locator, 'count': self.batch_size})
+
+    async def _fill_pipeline(self):
+        # 已经知道对方tip的高度，后面的批次直接按高度请求，不需要等前一批返回
+        while self.sync_peer is not None and len(self.pending) < self.pipeline_depth \
+                and self.next_height <= self.peer_tip_height:
+            count = min(self.batch_size, self.peer_tip_height - self.next_height + 1)
+            start_height = self.next_height
+            self.next_height += count
+            await self._send_getheaders(start_height, {'start_height': start_height, 'count': count})
+
+    async def _restart(self, reason):
+        self.restarts += 1
+        if self.restarts > self.max_restarts:
+            log.debug(f'区块头同步失败:{reason}，已经重试{self.max_restarts}次，停止同步')
+            self.stop()
+            return
+        log.debug(f'区块头同步中断:{reason}，重新用locator请求')
+        await self._request_locator()
+
+    async def on_getheaders(self, peer, payload):
+        """
+            处理对方的getheaders请求。有start_height时直接按高度返回，否则用locator找分叉点
+        """
+        count = min(int(payload.get('count') or self.batch_size), MAX_HEADERS_PER_MESSAGE)
+        start_height = payload.get('start_height')
+        if start_height is None:
+            locator = [bytes.fromhex(block_hash) for block_hash in payload.get('locator', [])]
+            fork_height = self.chian.find_fork_height(locator)
+            start_height = GENESIS_HEIGHT if fork_height is None else fork_height + 1
+        data = b''.join(self.chian.iter_chunks(start_height, start_height + count, chunk_blocks=count))
+        tip = self.chian.get_best_tip()
+        # 区块头用二进制消息直接发送
+        await peer.send_binary_message('headers', data, request_id=payload.get('request_id'),
+                                       start_height=start_height, tip_height=tip.height if tip else 0)
+
+    async def on_headers(self, peer, payload):
+        """
+            处理headers响应(二进制消息，区块头在data字段中)，按请求顺序接到本地链上，再补充新的请求
+        """
+        if peer is not self.sync_peer or not self.pending or self.pending[0][0] != payload.get('request_id'):
+            log.debug('收到不在同步中的headers消息，忽略')
+            return
+        _, expected_height = self.pending.popleft()
+        start_height = payload.get('start_height')
+        if expected_height is not None and start_height != expected_height:
+            await self._restart(f'返回的起始高度{start_height}和请求的{expected_height}不一致')
+            return
+        self.peer_tip_height = payload.get('tip_height', 0)
+        data = bytes(payload.get('data', b''))
+        count = len(data) // BLOCK_BIN_LEN
+        if len(data) % BLOCK_BIN_LEN != 0:
+            await self._restart('区块头数据长度不正确')
+            return
+        if count == 0 and expected_height is not None:
+            await self._restart(f'对方没有高度{expected_height}的区块')
+            return
+        if count and not connect_headers(self.chian, data):
+            await self._restart(f'高度{start_height}开始的区块头接不上本地链')
+            return
+        self.received_count += count
+        if expected_height is None:
+            # locator请求返回后才知道分叉点，开始流水线请求
+            self.next_height = start_height + count
+        await self._fill_pipeline()
+        if self.sync_peer is not None and not self.pending:
+            log.debug(f'区块头同步完成，收到{self.received_count}个区块头，'
+                      f'用时{time.time() - self.started_at:.2f}秒，本地高度:{self.chian.get_best_tip().height}')
+            self.stop()
+
+
+def connect_headers(chian, data):
+    """
+        把一段连续的区块头接到本地链上，也用于多节点并行下载的区块
+    """
+    first_block = Block.deserialize(data[:BLOCK_BIN_LEN])
+    tip = chian.get_best_tip()
+    if tip is not None and first_block.prev_hash == tip.hash():
+        # 直接接在主链tip后面，批量导入
+        return chian.import_headers(data)
+    if first_block.prev_hash == ZERO_HASH and chian.block_len() <= 1 \
+            and not chian.contains(first_block.hash()):
+        # 本地只有自己创建的创世区块，没有和对方共同的区块，使用对方的链
+        log.debug('本地只有创世区块，使用同步节点的创世区块')
+        original = chian.serialize()
+        chian.reset_chian(create_genesis=False)
+        if chian.import_headers(data):
+            return True
+        # 对方的区块头无效，恢复本地的创世区块，本地链不能为空
+        log.debug('同步节点的区块头无效，恢复本地创世区块')
+        chian.reset_chian(create_genesis=False)
+        if original:
+            chian.import_headers(original)
+        return False
+    # 分叉点在主链tip之前，逐个加到区块树上，侧链累计工作量超过主链时会重组
+    for offset in range(0, len(data), BLOCK_BIN_LEN):
+        block = Block.deserialize(data[offset:offset + BLOCK_BIN_LEN])
+        if chian.contains(block.hash()):
+            continue
+        if not chian.add_block(block):
+            return False
+    return True
@@ -0,0 +1,108 @@
+"""
+    挖矿奖励账本。区块连接到主链时把区块奖励记到coinbase交易的接收地址上，同时为这个区块写一条撤销记录，
+    区块从主链断开时按撤销记录把余额改回去，重组的开销和分叉深度成正比。
+    余额直接保存在dict中，查询不需要重放整条链。只保存主链的ColumnarBlockChain没有账本。
+    账本只在内存中，不写入区块存储。区块存储和区块头同步只有区块头，从存储启动或者同步区块头得到的区块不知道交易，
+    这些区块的奖励不会记账，余额只包含本次运行中带着交易连接到主链的区块。
+    这样的区块数记在missing_bodies中，不为0时账本不完整(complete为False)，余额比实际的少。
+"""
+import logging
+
+from config import INITIAL_BLOCK_REWARD, REWARD_CUTOFF_BLOCKS
+from p2p_minner.transaction import ZERO_HASH
+
+log = logging.getLogger(__name__)
+
+# 奖励右移64次以后一定是0
+_MAX_HALVINGS = 64
+
+
+def block_reward(height: int):
+    # 创世区块高度为1，每REWARD_CUTOFF_BLOCKS个区块奖励减半
+    halvings = (height - 1) // REWARD_CUTOFF_BLOCKS
+    if halvings >= _MAX_HALVINGS:
+        return 0
+    return INITIAL_BLOCK_REWARD >> halvings
+
+
+def check_coinbase(block):
+    """
+        有交易的区块：coinbase交易只能是第一个，金额不能超过这个高度的区块奖励
+    """
+    if not block.transactions:
+        return True
+    if any(tx.is_coinbase() for tx in block.transactions[1:]):
+        return False
+    coinbase = block.transactions[0]
+    return not coinbase.is_coinbase() or coinbase.amount <= block_reward(block.height)
+
+
+class RewardLedger:
+    def __init__(self):
+        self.balances = {}  # 地址 -> 余额
+        self.undo_records = {}  # 区块hash -> ((地址, 变化量), ...)，只保存有变化的地址
+        self.total_issued = 0
+        # 主链上不知道交易的区块数(只有区块头，merkle_root不为空)
+        self.missing_bodies = 0
+
+    @property
+    def complete(self):
+        # 主链上所有区块的交易都记过账
+        return self.missing_bodies == 0
+
+    def balance(self, address):
+        return self.balances.get(address, 0)
+
+    def connect_block(self, block):
+        # 区块接到主链尾
+        if _missing_body(block):
+            self.missing_bodies += 1
+            return
+        changes = []
+        if block.transactions and block.transactions[0].is_coinbase():
+            coinbase = block.transactions[0]
+            changes.append((coinbase.receiver, coinbase.amount))
+        for address, delta in changes:
+            self._apply(address, delta)
+        if changes:
+            self.undo_records[block.hash()] = tuple(changes)
+
+    def disconnect_block(self, block):
+        # 区块从主链尾断开，按撤销记录反向修改余额
+        if _missing_body(block):
+            self.missing_bodies -= 1
+            return
+        for address, delta in reversed(self.undo_records.pop(block.hash(), ())):
+            self._apply(address, -delta)
+
+    def _apply(self, address, delta):
+        balance = self.balances.get(address, 0) + delta
+        if balance:
+            self.balances[address] = balance
+        else:
+            self.balances.pop(address, None)
+        self.total_issued += delta
+
+    def reset(self):
+        self.balances.clear()
+        self.undo_records.clear()
+        self.total_issued = 0
+        self.missing_bodies = 0
+
+    def top(self, count=10):
+        # 余额最多的地址
+        return sorted(self.balances.items(), key=lambda item: item[1], reverse=True)[:count]
+
+    def stats(self):
+        return {
+            'addresses': len(self.balances),
+            'total_issued': self.total_issued,
+            'undo_records': len(self.undo_records),
+            'complete': self.complete,
+            'missing_bodies': self.missing_bodies,
+        }
+
+
+def _missing_body(block):
+    # 只有区块头，区块头中的merkle_root说明区块有交易
+    return block.transactions is None and block.merkle_root != ZERO_HASH
@@ -4,10 +4,18 @@
 """
 import asyncio
 import logging
-import sys
+import struct
 from protocol import Protocol
 
-from config import setup_logging
+from config import setup_logging, load_app_config
+from p2p_minner.block_chain import Block, BlockChain, BLOCK_BIN_LEN, load_chian
+from p2p_minner.block_download import BlockDownloader
+from p2p_minner.chain_analytics import ChainColumns, run_analytics_command
+from p2p_minner.header_sync import HeaderSync
+from p2p_minner.mempool import Mempool, MAX_BLOCK_BYTES
+from p2p_minner.mining_pool import PoolCoordinator
+from p2p_minner.transaction import Transaction
+from p2p_minner.seen_block_cache import SeenBlockCache, SEEN_VALID, SEEN_INVALID, SEEN_CONNECTED
 
 setup_logging()
 log = logging.getLogger(__name__)
@@ -30,6 +38,15 @@ class Peer:
         except Exception as e :
             log.exception(f"消息发送失败:{self.node_id}")
             await self.node.remove_node(self)
+    async def send_binary_message(self,msgtype,data,**fields):
+        # 发送二进制消息，区块头直接放在消息中
+        try:
+            log.debug(f'给节点发送二进制消息:{msgtype},{fields},数据长度:{len(data)}')
+            self.writer.write(Protocol.serialize_binary_message(msgtype,data,**fields))
+            await self.writer.drain()
+        except Exception as e :
+            log.exception(f"消息发送失败:{self.node_id}")
+            await self.node.remove_node(self)
     async def handler_msg_notify_new_node(self,payload):
         #处理通知新用户
         log.debug(f'开始处理消息notify_new_node')
@@ -62,6 +79,34 @@ class Peer:
             await self.writer.drain()
         except Exception as e:
             log.debug("节点keepalive回复失败")
+    async def handler_msg_getheaders(self,payload):
+        await self.node.header_sync.on_getheaders(self,payload)
+    async def handler_msg_headers(self,payload):
+        await self.node.header_sync.on_headers(self,payload)
+    async def handler_msg_getblocks(self,payload):
+        await self.node.block_download.on_getblocks(self,payload)
+    async def handler_msg_blocks(self,payload):
+        await self.node.block_download.on_blocks(self,payload)
+    async def handler_msg_block(self,payload):
+        # 其它节点转发的新区块，只有区块头时没有交易
+        data = bytes(payload.get('data'))
+        if len(data) < BLOCK_BIN_LEN or len(data) > MAX_BLOCK_BYTES:
+            log.debug(f'区块数据长度不正确:{len(data)}')
+            return
+        try:
+            block = Block.deserialize(data) if len(data) == BLOCK_BIN_LEN else Block.deserialize_full(data)
+        except (ValueError,struct.error):
+            log.debug('区块交易数据不正确')
+            return
+        await self.node.on_block(block,self)
+    async def handler_msg_tx(self,payload):
+        # 其它节点转发的交易
+        try:
+            tx = Transaction.deserialize(bytes(payload.get('data')))
+        except (ValueError,struct.error):
+            log.debug('交易数据不正确')
+            return
+        await self.node.on_transaction(tx,self)
     async def handler_msg_unkown(self,payload):
         log.debug(f'未实现的消息处理，payload:{payload}')
     async def on_recv_message_loop(self):
@@ -74,7 +119,10 @@ class Peer:
                 if message is None:
                     log.debug(f'节点通信失败:{self.node_id},{self.connect_info}')
                     break
-                log.debug(f"接收到{self.node_id}消息:{message}")
+                if message.get('binary'):
+                    log.debug(f"接收到{self.node_id}二进制消息:{message.get('type')},数据长度:{len(message['payload']['data'])}")
+                else:
+                    log.debug(f"接收到{self.node_id}消息:{message}")
                 # 这里处理节点消息，现在都写在一起
                 msg_type = message.get("type")
                 invoke_handler = getattr(self,f"handler_msg_{msg_type}",self.handler_msg_unkown)
@@ -97,12 +145,22 @@ class Peer:
         self.connect_info = connect_info
 
 class P2PNode:
-    def __init__(self):
+    def __init__(self,chian=None):
         self.server= None
         # 在本机测试node id 就是监听端口
         self.node_id = 0
         #所有的节点
         self.peers = {}
+        # 本地区块链和区块头同步
+        self.chian = chian if chian is not None else BlockChain()
+        self.header_sync = HeaderSync(self.chian)
+        # 落后较多时从所有节点并行下载区块，接不上本地链时改用locator同步找分叉点
+        self.block_download = BlockDownloader(self.chian,on_fork=self.header_sync.start)
+        # 已经处理过的区块，多个节点转发的同一个区块只验证一次
+        self.seen_blocks = SeenBlockCache()
+        self.mempool = Mempool()
+        # 本地矿池，外部的挖矿worker通过它挖矿
+        self.pool = None
     async def start(self,host,port):
         """
             运行主程序
@@ -113,6 +171,7 @@ class P2PNode:
         )
         # keep alive
         asyncio.create_task(self.keep_alive())
+        asyncio.create_task(self.block_download.run())
         log.debug(f'本地服务启动成功，监听端口：{port}')
         async with self.server:
             await self.server.serve_forever()
@@ -162,8 +221,73 @@ class P2PNode:
         ]
         await asyncio.gather(*tasks)
 
+    async def broadcast_binary(self,message_type,data,exclude=None,**fields):
+        tasks = [
+            peer.send_binary_message(message_type,data,**fields)
+            for peer in self.peers.values() if not exclude or peer.node_id != exclude.node_id
+        ]
+        await asyncio.gather(*tasks)
+
+    async def on_block(self,block:Block,from_peer=None):
+        # 收到新区块，加到本地链上后转发给其它节点。接不上时可能缺少前面的区块，从这个节点同步。
+        # 返回区块是否被接受(主链或侧链)
+        block_hash = block.hash()
+        if self.seen_blocks.get(block_hash) is not None:
+            return False
+        if self.chian.contains(block_hash):
+            self.seen_blocks.put(block_hash,SEEN_CONNECTED)
+            return False
+        if not block.check_size():
+            # 超过上限的区块不保存也不转发，同一个区块头的真实区块不会超过上限
+            log.debug(f'区块交易数或大小超过上限，丢弃:{block_hash.hex()}')
+            return False
+        if not block.check_merkle_root():
+            # 交易和区块头不匹配，可能是转发时被篡改的副本，区块头本身可能有效。
+            # 不记录到已见区块缓存，否则同一个区块头的真实区块以后也会被丢弃。
+            # merkle_root匹配之后交易由区块头确定，之后的失败(包括coinbase无效)可以按区块hash记录
+            log.debug(f'区块交易和merkle_root不匹配，丢弃这个副本:{block_hash.hex()}')
+            return False
+        old_tip = self.chian.get_best_tip()
+        if self.chian.add_block(block,peer_id=from_peer.node_id if from_peer else None):
+            self.seen_blocks.put(block_hash,SEEN_VALID)
+            # 比较加入前后的tip，孤块连接和重组引起的tip变化也能发现
+            if self.chian.get_best_tip().hash() != old_tip.hash():
+                # 只有主链变化时更新交易池，重组断开的区块中的交易回到池中
+                self.mempool.update_main_chain(self.chian,old_tip)
+                if self.pool is not None:
+                    # 矿池的worker同时换成新任务
+                    await self.pool.new_tip()
+            log.debug(f'收到新区块并加入本地链:{block}')
+            await self.broadcast_binary("block",block.serialize_full() if block.transactions is not None else block.serialize(),
+                                        exclude=from_peer)
+            return True
+        elif not self.chian.contains(block.prev_hash):
+            # 缺少父区块不是区块无效，不记录。区块已经放入孤块池，从这个节点同步缺少的区块
+            if from_peer is not None:
+                await self.block_download.update_peer_tip(from_peer,block.height)
+                if not self.block_download.is_downloading():
+                    await self.header_sync.start(from_peer)
+        else:
+            self.seen_blocks.put(block_hash,SEEN_INVALID)
+        return False
+
+    async def start_pool(self,address,coinbase_address='pool'):
+        # 启动本地矿池，找到的区块和收到的区块一样加到链上并转发
+        if self.pool is not None:
+            log.debug('矿池已经启动')
+            return
+        self.pool = PoolCoordinator(self.chian,self.mempool,coinbase_address,on_block=self.on_block)
+        await self.pool.start(address)
+
+    async def on_transaction(self,tx:Transaction,from_peer=None):
+        # 新交易加入交易池后转发，已经有的或者手续费不够的不转发
+        if self.mempool.add(tx):
+            await self.broadcast_binary("tx",tx.serialize(),exclude=from_peer)
+
     async def remove_node(self,peer:Peer):
         ready_close_node = self.peers.pop(peer.node_id,None)
+        self.header_sync.stop(peer)
+        self.block_download.remove_peer(peer)
         if ready_close_node:
             await peer.close()
     async  def start_node_handshake(self,reader,writer,is_initiative):
@@ -174,7 +298,8 @@ class P2PNode:
             frist_message = {
                 "type":"hello",
                 'node_id':self.node_id,
-                "listen_port":self.node_id
+                "listen_port":self.node_id,
+                "tip_height":self.chian.get_best_tip().height
             }
             # 主动发送消息
             writer.write(Protocol.serialize_message("hello",frist_message))
@@ -213,6 +338,10 @@ class P2PNode:
             self.peers[remote_node_id] = peer
             # 开始通知其它节点有新的节点到了
             await self.broadcast("notify_new_node", peer.connect_info,  exclude=peer)
+            # 新连接的节点的链更长时加入并行下载，否则(包括没有发送tip高度的旧节点)从它同步区块头
+            tip_height = remote_payload.get("tip_height")
+            if tip_height is None or not await self.block_download.add_peer(peer,int(tip_height)):
+                await self.header_sync.start(peer)
             return peer
         except Exception as e:
             log.exception('握手失败') #连接
@@ -234,19 +363,42 @@ async def run_input_task(node:P2PNode):
                 for item in node.peers.values():
                     log.debug(item.connect_info)
                 log.debug(f"维护节点数：{len(node.peers)}")
+                log.debug(f"本地区块高度：{node.chian.get_best_tip().height},是否在同步:{node.header_sync.is_syncing()}")
+                log.debug(f"已见区块缓存：{node.seen_blocks.stats()}")
+                if node.block_download.is_downloading():
+                    log.debug(f"并行下载：{node.block_download.stats()}")
+                log.debug(f"交易池：{node.mempool.stats()}")
+                if hasattr(node.chian,'orphan_pool'):
+                    log.debug(f"孤块池：{node.chian.orphan_pool.stats()}")
+                if node.pool is not None:
+                    log.debug(f"矿池：{node.pool.stats()}")
+            elif cmd == "pool":
+                # 启动本地矿池: pool 127.0.0.1:3333 [coinbase地址] 或 pool unix:/tmp/p2p_pool.sock
+                params = input_txt.split()[1:]
+                await node.start_pool(*params[:2])
+            elif cmd == "analytics":
+                # 主链统计: analytics [窗口区块数] [导出文件.csv|.json]
+                # 在event loop线程中取快照，统计在其它线程中计算，计算时可以继续接收区块
+                columns = ChainColumns.from_chain(node.chian)
+                report = await asyncio.to_thread(run_analytics_command,columns,input_txt.split()[1:])
+                log.debug(f"区块统计：{report}")
+            elif cmd == "sync":
+                # 从所有节点重新同步区块头，同一时间只和一个节点同步
+                for item in list(node.peers.values()):
+                    if await node.header_sync.start(item):
+                        break
             else:
                 log.debug(f'不支持的命令:{cmd}')
         except (Exception):
             log.exception("处理出错")
 async  def run_main():
-    # 运行主方法
-    args = sys.argv
+    # 运行主方法，监听端口、数据目录等从配置读取，可以用--port、--data-dir覆盖
+    config = load_app_config()
     host= '127.0.0.1'
-    listen_port = 17890
-    default_peers = [["127.0.0.1",17890]]
-    if len(args) > 1:
-        listen_port = int(args[-1])
-    node = P2PNode()
+    listen_port = config['p2p']['listen_port']
+    default_peers = [[peer['host'],peer['port']] for peer in config['p2p'].get('peer_nodes') or []]
+    # 从本地区块存储加载，使用配置中的检查点和创世区块难度
+    node = P2PNode(chian=load_chian(config))
     node.node_id = listen_port
     for peer_addr in default_peers:
         log.debug(f'尝试连接到节点:{peer_addr}')
@@ -0,0 +1,230 @@
+"""
+    交易池。等待打包的交易按每字节手续费放在最大堆中，总大小超过max_bytes时淘汰每字节手续费最低的交易。
+    交易池同时维护下一个区块要打包的交易和它们的Merkle树：
+    加入交易时区块还有空间就直接追加，区块满了时替换掉区块中手续费最低的交易；
+    交易被淘汰或者被打包进区块时从区块中删除，再补上池中手续费最高的交易。
+    每次变化只更新Merkle树的一条路径，挖矿程序可以频繁取新的模板，不需要重新计算所有交易的hash。
+    设置了coinbase交易后它固定在区块的第一个位置，换新的高度时只修改第一个叶子。
+"""
+import heapq
+import itertools
+import logging
+
+from p2p_minner.transaction import MerkleTree, Transaction
+
+log = logging.getLogger(__name__)
+
+MAX_MEMPOOL_BYTES = 32 * 1024 * 1024
+MAX_BLOCK_TXS = 2000
+# 区块头加交易序列化后的大小上限，MAX_BLOCK_TXS个最长的交易也放得下
+MAX_BLOCK_BYTES = 2 * 1024 * 1024
+# 堆中过期的条目超过有效条目这么多倍时重建堆
+_HEAP_COMPACT_RATIO = 2
+
+
+def main_chain_changes(chian, old_tip):
+    """
+        主链tip从old_tip变化后，旧主链上被断开的区块(从tip往回)和新接上主链的区块(按高度)
+    """
+    disconnected = []
+    cursor = old_tip
+    while cursor is not None and not chian.is_main_chain(cursor):
+        disconnected.append(cursor)
+        cursor = chian.get_by_hash(cursor.prev_hash)
+    fork_height = cursor.height if cursor is not None else 0
+    tip = chian.get_best_tip()
+    connected = [chian.get_by_height(height) for height in range(fork_height + 1, tip.height + 1)] if tip else []
+    return disconnected, connected
+
+
+class Mempool:
+    def __init__(self, max_bytes=MAX_MEMPOOL_BYTES, max_block_txs=MAX_BLOCK_TXS):
+        self.max_bytes = max_bytes
+        self.max_block_txs = max_block_txs
+        self.txs = {}  # 交易hash -> Transaction
+        self.total_bytes = 0
+        self.seq = itertools.count()
+        # 堆中的条目删除交易时不立即删除，取出时发现交易已经不在对应的集合中就跳过
+        self.waiting_heap = []  # 不在区块中的交易 (-每字节手续费, 序号, 交易hash)，手续费最高的在最前
+        self.block_heap = []  # 区块中的交易 (每字节手续费, 序号, 交易hash)，手续费最低的在最前
+        self.evict_heap = []  # 所有交易 (每字节手续费, 序号, 交易hash)，淘汰时用
+        # 下一个区块的交易，下标和Merkle树的叶子一一对应
+        self.block_txs = []
+        self.block_positions = {}  # 交易hash -> 在block_txs中的下标
+        self.merkle = MerkleTree()
+        self.coinbase = None
+        self.revision = 0  # 区块中的交易每变化一次加1，挖矿程序用来判断是否需要更新模板
+        self.evicted_count = 0
+
+    def __len__(self):
+        return len(self.txs)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.txs
+
+    def add(self, tx: Transaction):
+        """
+            加入交易，已经在池中或者交易池满了且手续费不够高时返回False
+        """
+        tx_hash = tx.hash()
+        if tx_hash in self.txs or tx.is_coinbase():
+            return False
+        size = tx.size()
+        if size > self.max_bytes:
+            return False
+        fee_rate = tx.fee_rate()
+        while self.total_bytes + size > self.max_bytes:
+            lowest = self._peek(self.evict_heap, self.txs)
+            if lowest is None or self.txs[lowest].fee_rate() >= fee_rate:
+                log.debug(f'交易池已满，手续费太低:{tx}')
+                return False
+            self.remove(lowest)
+            self.evicted_count += 1
+        seq = next(self.seq)
+        self.txs[tx_hash] = tx
+        self.total_bytes += size
+        heapq.heappush(self.evict_heap, (fee_rate, seq, tx_hash))
+        if len(self.block_txs) < self.max_block_txs:
+            self._add_to_block(tx, seq)
+        else:
+            lowest = self._peek(self.block_heap, self.block_positions)
+            if lowest is not None and self.txs[lowest].fee_rate() < fee_rate:
+                # 替换掉区块中手续费最低的交易，被替换的交易回到等待的堆中
+                self._replace_in_block(lowest, tx, seq)
+            else:
+                heapq.heappush(self.waiting_heap, (-fee_rate, seq, tx_hash))
+        self._compact()
+        return True
+
+    def remove(self, tx_hash):
+        """
+            删除交易，在区块中时用等待中手续费最高的交易补上
+        """
+        tx = self.txs.pop(tx_hash, None)
+        if tx is None:
+            return None
+        self.total_bytes -= tx.size()
+        if tx_hash in self.block_positions:
+            self._remove_from_block(tx_hash)
+            best = self._pop(self.waiting_heap, self.txs)
+            if best is not None:
+                self._add_to_block(self.txs[best], next(self.seq))
+        return tx
+
+    def remove_for_block(self, block):
+        # 新区块中的交易已经打包，从池中删除
+        for tx in block.transactions or ():
+            self.remove(tx.hash())
+
+    def update_main_chain(self, chian, old_tip):
+        """
+            主链变化后调用：重组断开的区块中的交易回到池中，新接上主链的区块中的交易从池中删除。
+            只接到侧链上的区块不影响交易池
+        """
+        disconnected, connected = main_chain_changes(chian, old_tip)
+        for block in disconnected:
+            for tx in block.transactions or ():
+                self.add(tx)
+        for block in connected:
+            self.remove_for_block(block)
+
+    def set_coinbase(self, tx: Transaction):
+        """
+            设置区块的coinbase交易，放在第一个位置，coinbase也占区块的一个交易数量。
+            第一次设置时原来第一个交易移到最后，区块已满时和区块中手续费最低的交易比较，低的回到等待的堆中
+        """
+        if self.coinbase is not None:
+            self.block_txs[0] = tx
+            self.merkle.set(0, tx.hash())
+        elif len(self.block_txs) >= self.max_block_txs:
+            first = self.block_txs[0]
+            first_hash = first.hash()
+            del self.block_positions[first_hash]
+            self.block_txs[0] = tx
+            self.merkle.set(0, tx.hash())
+            lowest = self._peek(self.block_heap, self.block_positions)
+            if lowest is not None and self.txs[lowest].fee_rate() < first.fee_rate():
+                self._replace_in_block(lowest, first, next(self.seq))
+            else:
+                heapq.heappush(self.waiting_heap, (-first.fee_rate(), next(self.seq), first_hash))
+        elif self.block_txs:
+            first = self.block_txs[0]
+            self.block_positions[first.hash()] = self.merkle.append(first.hash())
+            self.block_txs.append(first)
+            self.block_txs[0] = tx
+            self.merkle.set(0, tx.hash())
+        else:
+            self.block_txs.append(tx)
+            self.merkle.append(tx.hash())
+        self.coinbase = tx
+        self.revision += 1
+
+    def block_template(self):
+        """
+            下一个区块的交易和Merkle树根，树根已经增量算好，这里不计算hash
+        :return: (merkle_root, 交易列表, revision)
+        """
+        return self.merkle.root(), list(self.block_txs), self.revision
+
+    def _add_to_block(self, tx, seq):
+        tx_hash = tx.hash()
+        self.block_positions[tx_hash] = self.merkle.append(tx_hash)
+        self.block_txs.append(tx)
+        heapq.heappush(self.block_heap, (tx.fee_rate(), seq, tx_hash))
+        self.revision += 1
+
+    def _remove_from_block(self, tx_hash):
+        index = self.block_positions.pop(tx_hash)
+        moved = self.merkle.remove(index)
+        last = self.block_txs.pop()
+        if moved is not None:
+            self.block_txs[index] = last
+            self.block_positions[last.hash()] = index
+        self.revision += 1
+
+    def _replace_in_block(self, old_hash, tx, seq):
+        # 替换同一个位置的叶子，只更新一条路径
+        index = self.block_positions.pop(old_hash)
+        old_tx = self.txs[old_hash]
+        tx_hash = tx.hash()
+        self.block_txs[index] = tx
+        self.block_positions[tx_hash] = index
+        self.merkle.set(index, tx_hash)
+        heapq.heappush(self.block_heap, (tx.fee_rate(), seq, tx_hash))
+        heapq.heappush(self.waiting_heap, (-old_tx.fee_rate(), next(self.seq), old_hash))
+        self.revision += 1
+
+    def _peek(self, heap, members):
+        # 去掉堆顶已经不在members中的条目，返回堆顶的交易hash
+        while heap and heap[0][2] not in members:
+            heapq.heappop(heap)
+        return heap[0][2] if heap else None
+
+    def _pop(self, heap, members):
+        tx_hash = self._peek(heap, members)
+        if tx_hash is not None:
+            heapq.heappop(heap)
+        return tx_hash
+
+    def _compact(self):
+        # 过期条目太多时重建堆，堆的大小和交易数量成正比
+        if len(self.evict_heap) > _HEAP_COMPACT_RATIO * len(self.txs) + 64:
+            self.evict_heap = [item for item in self.evict_heap if item[2] in self.txs]
+            heapq.heapify(self.evict_heap)
+        if len(self.block_heap) > _HEAP_COMPACT_RATIO * len(self.block_positions) + 64:
+            self.block_heap = [item for item in self.block_heap if item[2] in self.block_positions]
+            heapq.heapify(self.block_heap)
+        waiting_count = len(self.txs) - len(self.block_positions)
+        if len(self.waiting_heap) > _HEAP_COMPACT_RATIO * waiting_count + 64:
+            self.waiting_heap = [item for item in self.waiting_heap
+                                 if item[2] in self.txs and item[2] not in self.block_positions]
+            heapq.heapify(self.waiting_heap)
+
+    def stats(self):
+        return {
+            'size': len(self.txs),
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'block_txs': len(self.block_txs),
+            'evicted': self.evicted_count,
+        }
@@ -0,0 +1,441 @@
+"""
+    本地矿池，类似stratum：挖矿worker进程通过TCP或者Unix socket连到一个节点上，不需要运行完整的p2p节点。
+    节点(PoolCoordinator)把区块模板作为任务发给worker，每个worker分到不同的extranonce，
+    extranonce写在coinbase交易中，每个worker的merkle_root不同，nonce空间也就互不重叠。
+    worker按份额难度(比区块难度低)提交nonce，节点按提交的份额数估算每个worker的算力，
+    份额同时满足区块难度时就是新区块。主链tip变化时同时给所有worker发新任务(clean)，worker放弃旧任务。
+
+    消息使用p2p的json消息格式:
+    worker -> 节点: subscribe {name}, submit {job_id, nonce}, exhausted {job_id}
+    节点 -> worker: job {job_id, prev_hash, merkle_root, bits, timestamp, height, share_target, extranonce, clean},
+                    share_result {job_id, nonce, accepted, block, reason}
+
+    python -m p2p_minner.mining_pool worker 127.0.0.1:3333 --name w1
+    python -m p2p_minner.mining_pool worker unix:/tmp/p2p_pool.sock
+    sha256计算时不释放GIL，一个worker进程只用一个挖矿线程，多核时启动多个worker进程。
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+from p2p_minner.block_chain import BlockTemplate, MAX_NONCE, MAX_TARGET, compact_to_target, mine_nonce_range
+from p2p_minner.ledger import block_reward
+from p2p_minner.protocol import Protocol
+from p2p_minner.transaction import Transaction, merkle_root_from_branch
+
+log = logging.getLogger(__name__)
+
+# 份额目标值 = 区块目标值 << SHARE_TARGET_SHIFT，即平均2^SHARE_TARGET_SHIFT个份额出一个区块
+SHARE_TARGET_SHIFT = 6
+# 计算算力的时间窗口(秒)
+HASHRATE_WINDOW = 60
+# 检查交易池是否变化的间隔(秒)，变化时给worker发新任务，旧任务的份额仍然有效
+JOB_REFRESH_INTERVAL = 1.0
+# 每个worker保留的旧任务数，晚到的份额还能验证
+MAX_JOBS_PER_WORKER = 4
+UNIX_PREFIX = 'unix:'
+
+
+def parse_address(address: str):
+    """
+        'host:port' 或者 'unix:/path/to/socket'
+    :return: (host, port) 或者 (None, path)
+    """
+    if address.startswith(UNIX_PREFIX):
+        return None, address[len(UNIX_PREFIX):]
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def share_target_for(bits: bytes, shift=SHARE_TARGET_SHIFT):
+    # 份额目标值，不会比区块目标值更难
+    return min(compact_to_target(bits) << shift, MAX_TARGET).to_bytes(32, byteorder='big')
+
+
+class PoolJob:
+    __slots__ = ('job_id', 'template', 'transactions', 'share_target', 'extranonce', 'submitted')
+
+    def __init__(self, job_id, template: BlockTemplate, transactions, share_target, extranonce):
+        self.job_id = job_id
+        self.template = template
+        self.transactions = transactions
+        self.share_target = share_target
+        self.extranonce = extranonce
+        self.submitted = set()  # 已经提交过的nonce，重复的份额不计
+
+    def to_payload(self, clean):
+        template = self.template
+        return {
+            'job_id': self.job_id,
+            'prev_hash': template.prev_hash.hex(),
+            'merkle_root': template.merkle_root.hex(),
+            'bits': template.bits.hex(),
+            'timestamp': template.timestamp,
+            'height': template.height,
+            'share_target': self.share_target.hex(),
+            'extranonce': self.extranonce,
+            'clean': clean,
+        }
+
+
+class PoolWorkerSession:
+    """
+        节点上的一个worker连接
+    """
+
+    def __init__(self, worker_id, reader, writer):
+        self.worker_id = worker_id
+        self.reader = reader
+        self.writer = writer
+        self.name = str(worker_id)
+        self.jobs = {}  # job_id -> PoolJob，最近的几个任务
+        self.connected_at = time.time()
+        self.share_times = deque()  # 时间窗口内接受的份额的时间
+        self.accepted_shares = 0
+        self.rejected_shares = 0
+        self.blocks_found = 0
+
+    async def send(self, msgtype, payload):
+        self.writer.write(Protocol.serialize_message(msgtype, payload))
+        await self.writer.drain()
+
+    def record_share(self, now):
+        self.accepted_shares += 1
+        self.share_times.append(now)
+
+    def hashrate(self, share_work, now=None, window=HASHRATE_WINDOW):
+        # 时间窗口内的份额数 * 每个份额的平均hash数 / 时间
+        now = time.time() if now is None else now
+        while self.share_times and self.share_times[0] < now - window:
+            self.share_times.popleft()
+        elapsed = min(window, now - self.connected_at)
+        return len(self.share_times) * share_work / elapsed if elapsed > 0 else 0.0
+
+
+class PoolCoordinator:
+    def __init__(self, chian, mempool=None, coinbase_address='pool', share_shift=SHARE_TARGET_SHIFT,
+                 on_block=None, refresh_interval=JOB_REFRESH_INTERVAL):
+        """
+        :param chian: 本地区块链，任务的父区块为主链tip
+        :param mempool: 交易池，为None时区块中只有coinbase交易
+        :param on_block: 找到区块时调用的协程函数on_block(block)，返回区块是否被接受，为None时直接加到chian上。
+            p2p节点传入自己的on_block，加到链上后转发给其它节点，同时更新交易池和推送新任务
+        """
+        self.chian = chian
+        self.mempool = mempool
+        self.coinbase_address = coinbase_address
+        self.share_shift = share_shift
+        self.on_block = on_block
+        self.refresh_interval = refresh_interval
+        self.sessions = {}  # worker_id -> PoolWorkerSession
+        self.worker_ids = itertools.count(1)
+        self.job_ids = itertools.count(1)
+        self.extranonces = itertools.count(1)  # 0留给交易池中的coinbase交易
+        self.server = None
+        self.refresh_task = None
+        # 当前任务的公共部分，worker之间只有coinbase交易不同
+        self.base_template = None
+        self.base_transactions = None
+        self.branch = None
+        self.revision = None
+        self.share_target = None
+        self.share_work = 0
+        self.blocks_found = 0
+
+    async def start(self, address):
+        host, port = parse_address(address)
+        self.refresh_base()
+        if host is None:
+            self.server = await asyncio.start_unix_server(self.handle_worker, port)
+        else:
+            self.server = await asyncio.start_server(self.handle_worker, host, port)
+        self.refresh_task = asyncio.create_task(self.refresh_loop())
+        log.debug(f'矿池启动成功，监听:{address}')
+        return self.server
+
+    async def close(self):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+        if self.server is not None:
+            self.server.close()
+        for session in list(self.sessions.values()):
+            session.writer.close()
+        self.sessions.clear()
+
+    def listen_address(self):
+        # 监听端口为0时实际的地址
+        sockname = self.server.sockets[0].getsockname()
+        if isinstance(sockname, str):
+            return UNIX_PREFIX + sockname
+        return f'{sockname[0]}:{sockname[1]}'
+
+    def refresh_base(self):
+        """
+            按主链tip和交易池生成任务的公共部分。coinbase交易固定在第一个位置，
+            只保存它到树根的路径，每个worker用自己的extranonce算出merkle_root只需要log2(n)次hash
+        """
+        tip = self.chian.get_best_tip()
+        height = tip.height + 1
+        bits = self.chian.next_tip_bits()
+        coinbase = Transaction.coinbase(self.coinbase_address, height, block_reward(height))
+        if self.mempool is not None:
+            self.mempool.set_coinbase(coinbase)
+            _, self.base_transactions, self.revision = self.mempool.block_template()
+            self.branch = self.mempool.merkle.branch(0)
+        else:
+            self.base_transactions, self.branch = [coinbase], []
+        self.base_template = BlockTemplate(tip.hash(), 0, bits, max(int(time.time()), tip.timestamp + 1), height)
+        self.share_target = share_target_for(bits, self.share_shift)
+        self.share_work = (1 << 256) // (int.from_bytes(self.share_target, byteorder='big') + 1)
+
+    def make_job(self, session: PoolWorkerSession, clean):
+        base = self.base_template
+        extranonce = next(self.extranonces)
+        coinbase = self.base_transactions[0]
+        coinbase = Transaction.coinbase(coinbase.receiver, base.height, coinbase.amount, extranonce)
+        merkle_root = merkle_root_from_branch(coinbase.hash(), 0, self.branch)
+        template = BlockTemplate(base.prev_hash, 0, base.bits, base.timestamp, base.height, merkle_root)
+        job = PoolJob(next(self.job_ids), template, [coinbase] + self.base_transactions[1:], self.share_target,
+                      extranonce)
+        if clean:
+            session.jobs.clear()
+        session.jobs[job.job_id] = job
+        while len(session.jobs) > MAX_JOBS_PER_WORKER:
+            del session.jobs[next(iter(session.jobs))]
+        return job
+
+    async def send_job(self, session: PoolWorkerSession, clean):
+        job = self.make_job(session, clean)
+        try:
+            await session.send('job', job.to_payload(clean))
+        except Exception:
+            log.debug(f'矿池任务发送失败:{session.name}', exc_info=True)
+
+    async def push_jobs(self, clean):
+        await asyncio.gather(*[self.send_job(session, clean) for session in list(self.sessions.values())])
+
+    async def new_tip(self):
+        # 主链tip变化，所有worker同时换成新任务
+        self.refresh_base()
+        await self.push_jobs(clean=True)
+
+    async def refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            tip = self.chian.get_best_tip()
+            if tip.hash() != self.base_template.prev_hash:
+                await self.new_tip()
+            elif self.mempool is not None and self.mempool.revision != self.revision:
+                self.refresh_base()
+                await self.push_jobs(clean=False)
+
+    async def handle_worker(self, reader, writer):
+        session = PoolWorkerSession(next(self.worker_ids), reader, writer)
+        buffer = b''
+        try:
+            while True:
+                message, buffer = await Protocol.deserialize_stream(reader, buffer)
+                if message is None:
+                    break
+                payload = message.get('payload') or {}
+                msg_type = message.get('type')
+                if msg_type == 'subscribe':
+                    session.name = payload.get('name') or session.name
+                    self.sessions[session.worker_id] = session
+                    log.debug(f'矿池worker连接:{session.name}')
+                    await self.send_job(session, clean=True)
+                elif msg_type == 'submit':
+                    await self.on_submit(session, payload)
+                elif msg_type == 'exhausted':
+                    # nonce空间用完，换一个extranonce
+                    await self.send_job(session, clean=False)
+                else:
+                    log.debug(f'矿池不支持的消息:{msg_type}')
+        except Exception:
+            log.debug(f'矿池worker处理失败:{session.name}', exc_info=True)
+        finally:
+            self.sessions.pop(session.worker_id, None)
+            writer.close()
+            log.debug(f'矿池worker断开:{session.name}')
+
+    async def on_submit(self, session: PoolWorkerSession, payload):
+        job = session.jobs.get(payload.get('job_id'))
+        nonce = payload.get('nonce')
+        result = {'job_id': payload.get('job_id'), 'nonce': nonce, 'accepted': False, 'block': False}
+        if job is None:
+            result['reason'] = 'stale'
+        elif not isinstance(nonce, int) or not 0 <= nonce <= MAX_NONCE or nonce in job.submitted:
+            result['reason'] = 'duplicate or invalid nonce'
+        else:
+            job.submitted.add(nonce)
+            block = job.template.to_block(nonce, job.transactions)
+            if block.hash() > job.share_target:
+                result['reason'] = 'low difficulty'
+            else:
+                result['accepted'] = True
+                session.record_share(time.time())
+                if block.is_validate():
+                    result['block'] = True
+                    await self.on_block_found(session, block)
+        if not result['accepted']:
+            session.rejected_shares += 1
+        await session.send('share_result', result)
+
+    async def on_block_found(self, session, block):
+        log.debug(f'矿池worker {session.name} 找到区块:{block}')
+        old_tip = self.chian.get_best_tip()
+        if self.on_block is not None:
+            accepted = await self.on_block(block)
+        else:
+            accepted = self.chian.add_block(block)
+            if accepted and self.mempool is not None:
+                self.mempool.update_main_chain(self.chian, old_tip)
+        if not accepted:
+            log.debug('矿池找到的区块增加失败')
+            return
+        session.blocks_found += 1
+        self.blocks_found += 1
+        if self.chian.get_best_tip().hash() != self.base_template.prev_hash:
+            # on_block中可能已经推送过新任务
+            await self.new_tip()
+
+    def stats(self):
+        now = time.time()
+        workers = {session.name: {'hashrate': session.hashrate(self.share_work, now),
+                                  'accepted': session.accepted_shares,
+                                  'rejected': session.rejected_shares,
+                                  'blocks': session.blocks_found}
+                   for session in self.sessions.values()}
+        return {
+            'workers': workers,
+            'hashrate': sum(worker['hashrate'] for worker in workers.values()),
+            'blocks_found': self.blocks_found,
+            'height': self.base_template.height if self.base_template else None,
+        }
+
+
+class PoolWorker:
+    """
+        连接到矿池的挖矿worker。挖矿线程调用mine_nonce_range，用份额目标值比较，
+        找到份额就提交，然后从下一个nonce继续。收到新任务时任务代数加1，挖矿线程在下一次检查时换成新任务
+    """
+
+    def __init__(self, address, name=None, check_interval=10000):
+        self.address = address
+        self.name = name
+        self.check_interval = check_interval
+        self.reader = None
+        self.writer = None
+        self.loop = None
+        self.job = None
+        self.generation = 0
+        self.job_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.mining_thread = None
+        self.accepted_shares = 0
+        self.rejected_shares = 0
+        self.blocks_found = 0
+
+    async def connect(self):
+        host, port = parse_address(self.address)
+        if host is None:
+            self.reader, self.writer = await asyncio.open_unix_connection(port)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+        await self.send('subscribe', {'name': self.name})
+
+    async def send(self, msgtype, payload):
+        self.writer.write(Protocol.serialize_message(msgtype, payload))
+        await self.writer.drain()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        await self.connect()
+        self.mining_thread = threading.Thread(target=self._mining_loop, daemon=True)
+        self.mining_thread.start()
+        buffer = b''
+        try:
+            while True:
+                message, buffer = await Protocol.deserialize_stream(self.reader, buffer)
+                if message is None:
+                    log.debug('和矿池的连接断开')
+                    break
+                payload = message.get('payload') or {}
+                if message.get('type') == 'job':
+                    self.on_job(payload)
+                elif message.get('type') == 'share_result':
+                    self.on_share_result(payload)
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.stop_event.set()
+        self.job_event.set()
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.close()
+
+    def on_job(self, payload):
+        template = BlockTemplate(bytes.fromhex(payload['prev_hash']), 0, bytes.fromhex(payload['bits']),
+                                 payload['timestamp'], payload['height'], bytes.fromhex(payload['merkle_root']))
+        self.job = (payload['job_id'], template, bytes.fromhex(payload['share_target']))
+        self.generation += 1
+        self.job_event.set()
+        log.debug(f"收到矿池任务:{payload['job_id']},高度:{payload['height']},clean:{payload['clean']}")
+
+    def on_share_result(self, payload):
+        if payload.get('accepted'):
+            self.accepted_shares += 1
+            if payload.get('block'):
+                self.blocks_found += 1
+                log.debug(f"份额找到了区块:{payload}")
+        else:
+            self.rejected_shares += 1
+            log.debug(f"份额被拒绝:{payload}")
+
+    def _submit(self, message):
+        coro = self.send(*message)
+        try:
+            asyncio.run_coroutine_threadsafe(coro, self.loop)
+        except RuntimeError:
+            # event loop已经关闭
+            coro.close()
+
+    def _mining_loop(self):
+        # extranonce不同的任务nonce空间不重叠，每个任务都从0开始搜索整个nonce空间
+        while not self.stop_event.is_set():
+            self.job_event.wait()
+            if self.stop_event.is_set():
+                return
+            generation = self.generation
+            job_id, template, share_target = self.job
+            nonce = 0
+            while nonce <= MAX_NONCE and generation == self.generation:
+                found = mine_nonce_range(template, nonce, should_stop=lambda: generation != self.generation,
+                                         check_interval=self.check_interval, target=share_target)
+                if found is None:
+                    break
+                self._submit(('submit', {'job_id': job_id, 'nonce': found}))
+                nonce = found + 1
+            if generation == self.generation:
+                # nonce空间用完，等新任务。清除之后再检查一次，避免丢掉刚到的新任务
+                self.job_event.clear()
+                if generation != self.generation:
+                    self.job_event.set()
+                else:
+                    self._submit(('exhausted', {'job_id': job_id}))
+
+
+if __name__ == "__main__":
+    from config import setup_logging
+
+    setup_logging()
+    parser = argparse.ArgumentParser(description='矿池挖矿worker')
+    parser.add_argument('command', choices=['worker'])
+    parser.add_argument('address', type=str, help='矿池地址 host:port 或 unix:/path')
+    parser.add_argument('--name', type=str, help='worker名称')
+    args = parser.parse_args()
+    asyncio.run(PoolWorker(args.address, args.name).run())
@@ -0,0 +1,97 @@
+"""
+    挖矿的统计数据：每个挖矿worker的hash速度，中止信号发出到worker真正停下的延迟，挖到的区块数和孤块数。
+    hash数量和挖矿时间放在共享内存(RawArray)中，多进程挖矿时子进程直接累加自己那一格，
+    每check_interval个nonce才更新一次，对挖矿速度没有影响。
+"""
+import json
+import multiprocessing
+import time
+from collections import deque
+
+# 计算孤块数时只检查最近挖到的这么多个区块，长时间运行内存不会一直增长
+MAX_RECENT_FOUND_BLOCKS = 1000
+
+
+def make_hash_counter(hashes, busy_time, worker_index):
+    """
+        返回给mine_nonce_range用的进度回调，把完成的hash数量和用时累加到worker_index那一格。
+        每个worker只写自己的格子，不需要加锁
+    """
+    last_time = time.perf_counter()
+
+    def on_progress(count):
+        nonlocal last_time
+        now = time.perf_counter()
+        hashes[worker_index] += count
+        busy_time[worker_index] += now - last_time
+        last_time = now
+
+    return on_progress
+
+
+class MiningTelemetry:
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.hashes = multiprocessing.RawArray('Q', workers)  # 每个worker完成的hash数量
+        self.busy_time = multiprocessing.RawArray('d', workers)  # 每个worker的挖矿时间(秒)
+        self.started_at = time.time()
+        self.abort_count = 0
+        self.last_abort_latency = None
+        self.max_abort_latency = 0.0
+        self.total_abort_latency = 0.0
+        self.found_count = 0
+        self.found_blocks = deque(maxlen=MAX_RECENT_FOUND_BLOCKS)  # 本节点最近挖到的区块，计算孤块数时用
+
+    def hash_counter(self, worker_index=0):
+        return make_hash_counter(self.hashes, self.busy_time, worker_index)
+
+    def record_abort_latency(self, latency):
+        self.abort_count += 1
+        self.last_abort_latency = latency
+        self.max_abort_latency = max(self.max_abort_latency, latency)
+        self.total_abort_latency += latency
+
+    def record_found_block(self, block):
+        self.found_count += 1
+        self.found_blocks.append(block)
+
+    def hashrates(self):
+        # 每个worker的hash速度(hash/秒)
+        return [hashes / busy if busy > 0 else 0.0 for hashes, busy in zip(self.hashes, self.busy_time)]
+
+    def orphaned_count(self, chian):
+        # 最近挖到但是现在不在主链上的区块(没加上或者被重组掉)
+        return sum(1 for block in self.found_blocks if not chian.is_main_chain(block))
+
+    def snapshot(self, chian=None):
+        """
+            返回可以直接json序列化的统计数据
+        """
+        hashrates = self.hashrates()
+        return {
+            'timestamp': int(time.time()),
+            'uptime': time.time() - self.started_at,
+            'workers': self.workers,
+            'hashes': list(self.hashes),
+            'hashrate': sum(hashrates),
+            'worker_hashrates': hashrates,
+            'abort_count': self.abort_count,
+            'last_abort_latency': self.last_abort_latency,
+            'max_abort_latency': self.max_abort_latency,
+            'mean_abort_latency': self.total_abort_latency / self.abort_count if self.abort_count else None,
+            'blocks_found': self.found_count,
+            'blocks_orphaned': self.orphaned_count(chian) if chian is not None else None,
+        }
+
+    def to_json(self, chian=None):
+        return json.dumps(self.snapshot(chian))
+
+    def __str__(self):
+        snapshot = self.snapshot()
+        worker_rates = ','.join(f'{rate / 1000:.1f}' for rate in snapshot['worker_hashrates'])
+        mean_latency = snapshot['mean_abort_latency']
+        return (f"算力:{snapshot['hashrate'] / 1000:.1f}kH/s(每个worker:{worker_rates}),"
+                f"中止次数:{snapshot['abort_count']},"
+                f"平均中止延迟:{mean_latency * 1000 if mean_latency is not None else 0:.1f}ms,"
+                f"最大中止延迟:{snapshot['max_abort_latency'] * 1000:.1f}ms,"
+                f"挖到区块:{snapshot['blocks_found']}")
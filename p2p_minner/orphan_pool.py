@@ -0,0 +1,118 @@
+"""
+    孤块池：父区块还不知道的区块先放在这里，按缺少的父区块hash建索引，父区块连接后子区块跟着连接。
+    总数量和总字节数有上限，每个节点有配额，超过时先淘汰最早放入的，超过max_age秒的孤块也会被淘汰。
+"""
+import logging
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+MAX_ORPHAN_BLOCKS = 200
+# 转发的区块带着交易，一个区块最大MAX_BLOCK_BYTES，按数量限制不够
+MAX_ORPHAN_BYTES = 16 * 1024 * 1024
+MAX_ORPHANS_PER_PEER = 50
+MAX_ORPHAN_AGE = 600  # 秒
+
+
+class OrphanEntry:
+    __slots__ = ('block', 'peer_id', 'added_at', 'size')
+
+    def __init__(self, block, peer_id, added_at, size):
+        self.block = block
+        self.peer_id = peer_id
+        self.added_at = added_at
+        self.size = size
+
+
+class OrphanPool:
+    def __init__(self, max_blocks=MAX_ORPHAN_BLOCKS, max_per_peer=MAX_ORPHANS_PER_PEER, max_age=MAX_ORPHAN_AGE,
+                 max_bytes=MAX_ORPHAN_BYTES):
+        self.max_blocks = max_blocks
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.max_per_peer = max_per_peer
+        self.max_age = max_age
+        self.orphans = OrderedDict()  # 区块hash -> OrphanEntry，按放入时间排序
+        self.by_parent = {}  # 缺少的父区块hash -> {子区块hash}
+        self.by_peer = {}  # 节点id -> OrderedDict(区块hash)，按放入时间排序
+        self.evicted_count = 0
+
+    def __len__(self):
+        return len(self.orphans)
+
+    def __contains__(self, block_hash):
+        return block_hash in self.orphans
+
+    def add(self, block, peer_id=None, now=None):
+        """
+            放入一个孤块，已经在池中或者比max_bytes还大时返回False
+        """
+        block_hash = block.hash()
+        if block_hash in self.orphans:
+            return False
+        size = block.size()
+        if size > self.max_bytes:
+            return False
+        now = time.time() if now is None else now
+        self.expire(now)
+        peer_orphans = self.by_peer.setdefault(peer_id, OrderedDict())
+        if len(peer_orphans) >= self.max_per_peer:
+            self._evict(next(iter(peer_orphans)))
+        if len(self.orphans) >= self.max_blocks:
+            self._evict(next(iter(self.orphans)))
+        while self.total_bytes + size > self.max_bytes:
+            self._evict(next(iter(self.orphans)))
+        self.orphans[block_hash] = OrphanEntry(block, peer_id, now, size)
+        self.total_bytes += size
+        self.by_parent.setdefault(block.prev_hash, set()).add(block_hash)
+        self.by_peer.setdefault(peer_id, OrderedDict())[block_hash] = None
+        return True
+
+    def remove(self, block_hash):
+        entry = self.orphans.pop(block_hash, None)
+        if entry is None:
+            return None
+        self.total_bytes -= entry.size
+        children = self.by_parent.get(entry.block.prev_hash)
+        if children is not None:
+            children.discard(block_hash)
+            if not children:
+                del self.by_parent[entry.block.prev_hash]
+        peer_orphans = self.by_peer.get(entry.peer_id)
+        if peer_orphans is not None:
+            peer_orphans.pop(block_hash, None)
+            if not peer_orphans:
+                del self.by_peer[entry.peer_id]
+        return entry
+
+    def _evict(self, block_hash):
+        self.remove(block_hash)
+        self.evicted_count += 1
+
+    def expire(self, now=None):
+        # 最早放入的在最前面，遇到没过期的就可以停止
+        now = time.time() if now is None else now
+        while self.orphans:
+            block_hash, entry = next(iter(self.orphans.items()))
+            if now - entry.added_at <= self.max_age:
+                break
+            self._evict(block_hash)
+
+    def pop_children(self, parent_hash):
+        # 取出等待parent_hash的所有孤块
+        return [self.remove(block_hash).block for block_hash in list(self.by_parent.get(parent_hash, ()))]
+
+    def missing_parents(self):
+        return list(self.by_parent)
+
+    def stats(self):
+        return {
+            'size': len(self.orphans),
+            'max_blocks': self.max_blocks,
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'missing_parents': len(self.by_parent),
+            'peers': {peer_id: len(orphans) for peer_id, orphans in self.by_peer.items()},
+            'evicted': self.evicted_count,
+        }
@@ -6,10 +6,28 @@ import time
 from operator import index
 
 NETWORK_MAGIC_HEADER = b'\xab\xcd\xef\x88'
-# 定义进制的头 MAGIC +PAYLOADLEN+CHECKSUM+PAYLOAD
+# 定义进制的头 MAGIC +CHECKSUM+PAYLOADLEN+PAYLOAD
 # 头部有14个 len(MAGI4C_HEADER)  + 4 + 4
+# CHECKSUM一直没有使用，现在用来区分帧类型：全0为json消息，FRAME_TYPE_BINARY为二进制消息
 HEADER_FORMAT = '<4s4sI'
 HEADER_LEN = struct.calcsize(HEADER_FORMAT)
+FRAME_TYPE_JSON = b'\x00\x00\x00\x00'
+FRAME_TYPE_BINARY = b'\x00\x00\x00\x01'
+
+# 二进制消息的PAYLOAD为 消息类型(12字节，不足补0) + 类型头 + 原始数据(区块头直接拼接，不做base64和json)
+BINARY_TYPE_FORMAT = '<12s'
+BINARY_TYPE_LEN = struct.calcsize(BINARY_TYPE_FORMAT)
+# 二进制消息类型 -> (类型头的struct格式, 字段名)
+BINARY_MESSAGES = {
+    # 同步时的一批区块头
+    'headers': (struct.Struct('<III'), ('request_id', 'start_height', 'tip_height')),
+    # 并行下载时按高度请求的一段区块
+    'blocks': (struct.Struct('<III'), ('request_id', 'start_height', 'tip_height')),
+    # 转发一个新区块，区块头后面是区块中的交易
+    'block': (struct.Struct('<'), ()),
+    # 转发一个交易
+    'tx': (struct.Struct('<'), ()),
+}
 
 
 
@@ -26,6 +44,28 @@ class Protocol():
         message_header = struct.pack(HEADER_FORMAT, NETWORK_MAGIC_HEADER, b'\x00\x00\x00\x00', len(payload_bytes))
         return message_header+payload_bytes
 
+    @staticmethod
+    def serialize_binary_message(msgtype,data=b'',**fields):
+        """
+            二进制消息，fields为类型头中的整数字段，data为原始数据
+        """
+        fields_struct, field_names = BINARY_MESSAGES[msgtype]
+        type_header = struct.pack(BINARY_TYPE_FORMAT, msgtype.encode('utf8')) + \
+            fields_struct.pack(*[fields.get(name) or 0 for name in field_names])
+        message_header = struct.pack(HEADER_FORMAT, NETWORK_MAGIC_HEADER, FRAME_TYPE_BINARY, len(type_header) + len(data))
+        return message_header + type_header + data
+
+    @staticmethod
+    def deserialize_binary_payload(payload:bytes):
+        # 二进制消息解析成和json消息一样的格式，原始数据放在payload的data字段中
+        msgtype = struct.unpack_from(BINARY_TYPE_FORMAT, payload)[0].rstrip(b'\x00').decode('utf8')
+        if msgtype not in BINARY_MESSAGES:
+            raise Exception(f'未知的二进制消息类型:{msgtype}')
+        fields_struct, field_names = BINARY_MESSAGES[msgtype]
+        message_payload = dict(zip(field_names, fields_struct.unpack_from(payload, BINARY_TYPE_LEN)))
+        message_payload['data'] = payload[BINARY_TYPE_LEN + fields_struct.size:]
+        return {'type': msgtype, 'binary': True, 'payload': message_payload}
+
     @staticmethod
     async def deserialize_stream(io_stream,buffer=b''):
         # 这里反序列化的核心逻辑。
@@ -40,15 +80,17 @@ class Protocol():
             if not chuck:
                 return None,b''
             buffer += chuck
-        _, check_sum, payload_len = struct.unpack(HEADER_FORMAT, buffer[:HEADER_LEN])
+        _, frame_type, payload_len = struct.unpack(HEADER_FORMAT, buffer[:HEADER_LEN])
         buffer = buffer[HEADER_LEN:]
         while len(buffer) < payload_len:
             chuck = await io_stream.read(payload_len - len(buffer))
             if not chuck:
                 raise Exception('连接失败未获取到数据')
             buffer += chuck
-        payload = (buffer[:payload_len]).decode('utf8')
         remaing_data = buffer[payload_len:]
+        if frame_type == FRAME_TYPE_BINARY:
+            return Protocol.deserialize_binary_payload(buffer[:payload_len]), remaing_data
+        payload = (buffer[:payload_len]).decode('utf8')
         return json.loads(payload), remaing_data
 
 
@@ -0,0 +1,46 @@
+"""
+    已经见过的区块的LRU缓存。网状网络中同一个新区块会从多个节点收到，
+    第一次验证后按区块hash记录结果，后面重复收到的只需要一次dict查询就可以丢掉，
+    转发新区块的开销和区块数成正比，和节点数无关。
+"""
+from collections import OrderedDict
+
+SEEN_VALID = 'valid'  # 验证通过并加入了本地链(主链或侧链)
+SEEN_INVALID = 'invalid'  # 验证失败
+SEEN_CONNECTED = 'connected'  # 收到时已经在本地链上
+
+
+class SeenBlockCache:
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.entries = OrderedDict()  # 区块hash -> 验证结果，按最近使用排序
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, block_hash: bytes):
+        result = self.entries.get(block_hash)
+        if result is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(block_hash)
+        self.hits += 1
+        return result
+
+    def put(self, block_hash: bytes, result):
+        self.entries[block_hash] = result
+        self.entries.move_to_end(block_hash)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
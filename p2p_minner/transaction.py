@@ -0,0 +1,216 @@
+"""
+    交易和Merkle树。交易只做最简单的转账：发送方、接收方、金额、手续费和发送方的序号，不做签名和余额检查。
+    区块头中的merkle_root是区块中所有交易hash的Merkle树根，算法同比特币：每层两两拼接后sha256，
+    这一层是奇数个时最后一个和自己拼接。
+    MerkleTree保存每一层的节点，增加、修改、删除一个叶子只重新计算从这个叶子到树根的一条路径。
+"""
+import hashlib
+import struct
+
+ZERO_HASH = b'\x00' * 32
+# coinbase交易没有发送方，序号为区块高度，保证每个区块的coinbase交易hash不同。
+# coinbase交易没有手续费，fee字段用作extranonce，矿池给每个worker不同的extranonce，区块的merkle_root也就不同
+COINBASE_SENDER = ''
+
+# 金额,手续费,序号,发送方长度,接收方长度，后面是发送方和接收方地址(utf8)
+TX_HEADER_FORMAT = '<QQIBB'
+TX_HEADER_LEN = struct.calcsize(TX_HEADER_FORMAT)
+_TX_HEADER_STRUCT = struct.Struct(TX_HEADER_FORMAT)
+_TX_COUNT_STRUCT = struct.Struct('<I')
+TX_COUNT_LEN = _TX_COUNT_STRUCT.size
+# 地址长度用1个字节保存，金额和手续费为8字节无符号整数
+MAX_ADDRESS_LEN = 255
+MAX_AMOUNT = (1 << 64) - 1
+
+
+class Transaction:
+    """
+        创建后不要再修改字段，序列化结果和hash只计算一次
+    """
+    __slots__ = ('sender', 'receiver', 'amount', 'fee', 'nonce', '_bin', '_hash')
+
+    def __init__(self, sender: str, receiver: str, amount: int, fee: int = 0, nonce: int = 0, _bin=None):
+        self.sender = sender
+        self.receiver = receiver
+        self.amount = amount
+        self.fee = fee
+        self.nonce = nonce
+        self._bin = _bin
+        self._hash = None
+
+    def serialize(self):
+        if self._bin is None:
+            sender = self.sender.encode('utf8')
+            receiver = self.receiver.encode('utf8')
+            self._bin = _TX_HEADER_STRUCT.pack(self.amount, self.fee, self.nonce, len(sender), len(receiver)) \
+                + sender + receiver
+        return self._bin
+
+    @classmethod
+    def deserialize_from(cls, data, offset=0):
+        """
+            从data的offset处解出一个交易
+        :return: (交易, 交易之后的偏移)
+        """
+        amount, fee, nonce, sender_len, receiver_len = _TX_HEADER_STRUCT.unpack_from(data, offset)
+        sender_start = offset + TX_HEADER_LEN
+        receiver_start = sender_start + sender_len
+        end = receiver_start + receiver_len
+        if end > len(data):
+            raise ValueError('交易数据长度不正确')
+        tx = cls(bytes(data[sender_start:receiver_start]).decode('utf8'),
+                 bytes(data[receiver_start:end]).decode('utf8'), amount, fee, nonce, _bin=bytes(data[offset:end]))
+        return tx, end
+
+    @classmethod
+    def deserialize(cls, data):
+        tx, end = cls.deserialize_from(data)
+        if end != len(data):
+            raise ValueError('交易数据长度不正确')
+        return tx
+
+    @classmethod
+    def coinbase(cls, receiver: str, height: int, amount: int, extranonce: int = 0):
+        return cls(COINBASE_SENDER, receiver, amount, extranonce, height)
+
+    def is_coinbase(self):
+        return self.sender == COINBASE_SENDER
+
+    def hash(self):
+        if self._hash is None:
+            self._hash = hashlib.sha256(self.serialize()).digest()
+        return self._hash
+
+    def size(self):
+        return len(self.serialize())
+
+    def fee_rate(self):
+        # 每字节的手续费，交易池按这个排序
+        return self.fee / self.size()
+
+    def __str__(self):
+        return f"tx:{self.hash().hex()}, {self.sender}->{self.receiver},amount:{self.amount},fee:{self.fee},nonce:{self.nonce}"
+
+
+def serialize_transactions(txs):
+    # 交易数量 + 依次拼接的交易
+    return _TX_COUNT_STRUCT.pack(len(txs)) + b''.join(tx.serialize() for tx in txs)
+
+
+def deserialize_transactions(data, offset=0):
+    count = _TX_COUNT_STRUCT.unpack_from(data, offset)[0]
+    offset += _TX_COUNT_STRUCT.size
+    txs = []
+    for _ in range(count):
+        tx, offset = Transaction.deserialize_from(data, offset)
+        txs.append(tx)
+    if offset != len(data):
+        raise ValueError('交易数据长度不正确')
+    return txs
+
+
+def _hash_pair(left, right):
+    return hashlib.sha256(left + right).digest()
+
+
+def merkle_root(hashes):
+    """
+        一次算出整棵树的树根，没有交易时为全0
+    """
+    level = list(hashes)
+    if not level:
+        return ZERO_HASH
+    while len(level) > 1:
+        level = [_hash_pair(level[i], level[i + 1] if i + 1 < len(level) else level[i])
+                 for i in range(0, len(level), 2)]
+    return level[0]
+
+
+def merkle_root_from_branch(leaf_hash, index, branch):
+    # 只替换一个叶子时，用这个叶子的兄弟节点算出新的树根，不需要整棵树
+    value = leaf_hash
+    for sibling in branch:
+        value = _hash_pair(sibling, value) if index & 1 else _hash_pair(value, sibling)
+        index >>= 1
+    return value
+
+
+class MerkleTree:
+    """
+        保存每一层节点的Merkle树，levels[0]是叶子(交易hash)，最后一层只有树根。
+        叶子的增加、修改、删除都只重新计算一条路径，n个交易时为log2(n)次sha256
+    """
+
+    def __init__(self, hashes=()):
+        self.levels = [list(hashes)]
+        for index in range(0, len(self.levels[0]), 2):
+            self._update_path(index)
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def root(self):
+        if not self.levels[0]:
+            return ZERO_HASH
+        return self.levels[-1][0]
+
+    def _update_path(self, index):
+        # 从叶子index向上重新计算父节点，直到只有一个节点的那一层
+        k = 0
+        while len(self.levels[k]) > 1:
+            level = self.levels[k]
+            left = index & ~1
+            value = _hash_pair(level[left], level[left + 1] if left + 1 < len(level) else level[left])
+            if k + 1 == len(self.levels):
+                self.levels.append([])
+            parent_level = self.levels[k + 1]
+            index >>= 1
+            if index == len(parent_level):
+                parent_level.append(value)
+            else:
+                parent_level[index] = value
+            k += 1
+        # 删除叶子后树变矮了，去掉上面多余的层
+        del self.levels[k + 1:]
+
+    def append(self, leaf_hash):
+        self.levels[0].append(leaf_hash)
+        self._update_path(len(self.levels[0]) - 1)
+        return len(self.levels[0]) - 1
+
+    def set(self, index, leaf_hash):
+        self.levels[0][index] = leaf_hash
+        self._update_path(index)
+
+    def branch(self, index):
+        """
+            叶子index到树根路径上的兄弟节点，没有兄弟节点时是自己
+        """
+        branch = []
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            branch.append(level[sibling] if sibling < len(level) else level[index])
+            index >>= 1
+        return branch
+
+    def remove(self, index):
+        """
+            删除叶子index，最后一个叶子移到index的位置上，返回被移动的叶子原来的下标(没有移动时为None)
+        """
+        leaves = self.levels[0]
+        last = leaves.pop()
+        moved = None
+        if index < len(leaves):
+            leaves[index] = last
+            moved = len(leaves)
+        # 每一层的节点数是下一层的一半(向上取整)
+        for k in range(1, len(self.levels)):
+            del self.levels[k][(len(self.levels[k - 1]) + 1) // 2:]
+        if not leaves:
+            del self.levels[1:]
+            return moved
+        # 新的最后一个叶子可能失去了兄弟节点
+        self._update_path(len(leaves) - 1)
+        if moved is not None:
+            self._update_path(index)
+        return moved
@@ -0,0 +1,180 @@
+"""
+    区块链和挖矿基本操作的基准测试，结果输出为json，可以和上一次的结果对比。
+    python -m tests.block_minner.bench_chain --out bench.json
+    python -m tests.block_minner.bench_chain --lengths 1000,10000 --compare bench.json
+
+    每项重复repeat次取最快的一次，结果单位为每个操作的秒数和每秒操作数。
+    链相关的测试用低难度(EASY_BITS)提前挖好区块，挖矿时间不计入结果。
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+from p2p_minner.block_chain import Block, BlockChain, BlockTemplate, Minner, mine_nonce_range
+from p2p_minner.mining_telemetry import MiningTelemetry
+
+EASY_BITS = bytes.fromhex("2000ffff")
+# 用不可能满足的难度，挖矿测试一直跑到被中止
+IMPOSSIBLE_BITS = b'\x00' * 4
+DEFAULT_LENGTHS = [1000, 10000]
+SINGLE_BLOCK_OPS = 100000
+
+
+def measure(func, setup=None, number=1, repeat=5):
+    """
+        运行repeat次func(setup())，每次包含number个操作，返回最快一次的每操作秒数。
+        setup的时间不计入
+    """
+    best = None
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        func(arg)
+        cost = (time.perf_counter() - start) / number
+        best = cost if best is None else min(best, cost)
+    return {'seconds_per_op': best, 'ops_per_sec': 1 / best if best > 0 else None, 'number': number,
+            'repeat': repeat}
+
+
+def new_blocks(count):
+    # 新创建的区块没有缓存序列化结果和hash
+    return [Block(b'\x11' * 32, nonce, EASY_BITS, 1700000000, 2) for nonce in range(count)]
+
+
+def build_chain(length):
+    chain = BlockChain(EASY_BITS)
+    genesis = chain.get_best_tip()
+    blocks = []
+    for _ in range(length - 1):
+        tip = chain.get_best_tip()
+        template = BlockTemplate(tip.hash(), 0, chain.next_tip_bits(), tip.timestamp + 60, tip.height + 1)
+        block = template.to_block(mine_nonce_range(template))
+        chain.add_block(block)
+        blocks.append(block)
+    return chain, genesis, blocks
+
+
+def bench_block(results, ops):
+    results['block.serialize'] = measure(lambda blocks: [block.serialize() for block in blocks],
+                                         lambda: new_blocks(ops), ops)
+    results['block.hash'] = measure(lambda blocks: [block.hash() for block in blocks],
+                                    lambda: new_blocks(ops), ops)
+    results['block.hash_cached'] = measure(lambda block: [block.hash() for _ in range(ops)],
+                                           lambda: new_blocks(1)[0], ops)
+    results['block.is_validate'] = measure(lambda blocks: [block.is_validate() for block in blocks],
+                                           lambda: new_blocks(ops), ops)
+
+
+def bench_mining(results, seconds):
+    # do_mining_loop跑seconds秒后中止，用挖矿统计算出每秒nonce数
+    def run(_):
+        telemetry = MiningTelemetry(1)
+        event = threading.Event()
+        prev_block = Block(b'\x22' * 32, 0, IMPOSSIBLE_BITS, 1700000000, 1)
+        timer = threading.Timer(seconds, event.set)
+        timer.start()
+        Minner.do_mining_loop(prev_block, event, telemetry=telemetry)
+        timer.join()
+        return telemetry
+
+    telemetry = run(None)
+    hashes, busy = telemetry.hashes[0], telemetry.busy_time[0]
+    results['minner.do_mining_loop'] = {'nonces_per_sec': hashes / busy if busy else None, 'nonces': hashes,
+                                        'seconds': busy}
+
+
+def bench_chain(results, length, repeat):
+    chain, genesis, blocks = build_chain(length)
+    data = chain.serialize()
+    prefix = f'chain[{length}]'
+
+    def fresh_chain():
+        new_chain = BlockChain(create_genesis=False)
+        new_chain.add_block(genesis)
+        return new_chain
+
+    def add_blocks(new_chain):
+        for block in blocks:
+            new_chain.add_block(block)
+
+    results[f'{prefix}.add_block'] = measure(add_blocks, fresh_chain, len(blocks), repeat)
+    results[f'{prefix}.serialize'] = measure(lambda _: chain.serialize(), number=length, repeat=repeat)
+    results[f'{prefix}.deserialize'] = measure(lambda _: BlockChain.deserialize(data, workers=1), number=length,
+                                               repeat=repeat)
+
+    def reset_watermark():
+        chain.validated_count = 0
+
+    results[f'{prefix}.check_chian'] = measure(lambda _: chain.check_chian(), reset_watermark, length, repeat)
+    results[f'{prefix}.check_chian_incremental'] = measure(lambda _: chain.check_chian(), number=1, repeat=repeat)
+    results[f'{prefix}.check_chian_full'] = measure(lambda _: chain.check_chian(full=True, workers=1),
+                                                    number=length, repeat=repeat)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       text=True).strip()
+    except Exception:
+        return None
+
+
+def run_suite(lengths=None, ops=SINGLE_BLOCK_OPS, mining_seconds=2.0, repeat=5):
+    results = {}
+    bench_block(results, ops)
+    bench_mining(results, mining_seconds)
+    for length in lengths or DEFAULT_LENGTHS:
+        bench_chain(results, length, repeat)
+    return {
+        'meta': {
+            'timestamp': int(time.time()),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'revision': git_revision(),
+        },
+        'results': results,
+    }
+
+
+def rate_of(result):
+    return result.get('ops_per_sec') or result.get('nonces_per_sec')
+
+
+def compare(current, baseline):
+    # 和上一次的结果对比，>1表示变快
+    lines = []
+    for name, result in current['results'].items():
+        base = baseline.get('results', {}).get(name)
+        if not base or not rate_of(base) or not rate_of(result):
+            lines.append(f'{name:<40} {rate_of(result) or 0:>16,.0f}/s   (new)')
+            continue
+        lines.append(f'{name:<40} {rate_of(result):>16,.0f}/s   {rate_of(result) / rate_of(base):.2f}x')
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='区块链和挖矿基准测试')
+    parser.add_argument('--lengths', type=str, default=','.join(map(str, DEFAULT_LENGTHS)), help='测试的链长度,逗号分隔')
+    parser.add_argument('--ops', type=int, default=SINGLE_BLOCK_OPS, help='单个区块操作的次数')
+    parser.add_argument('--mining-seconds', type=float, default=2.0, help='挖矿测试的时间')
+    parser.add_argument('--repeat', type=int, default=5, help='每项重复次数，取最快的一次')
+    parser.add_argument('--out', type=str, help='结果写入的json文件')
+    parser.add_argument('--compare', type=str, help='对比的上一次结果json文件')
+    args = parser.parse_args()
+
+    report = run_suite([int(length) for length in args.lengths.split(',')], args.ops, args.mining_seconds,
+                       args.repeat)
+    if args.out:
+        with open(args.out, 'w', encoding='utf8') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf8') as f:
+            print(compare(report, json.load(f)))
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,44 @@
+"""
+    对比原来逐个nonce调用is_validate的挖矿循环和mine_nonce_range挖矿内核的速度(nonce/秒)
+    python -m tests.block_minner.bench_mining_kernel
+"""
+import hashlib
+import struct
+import time
+
+from p2p_minner.block_chain import BlockTemplate, mine_nonce_range, BLOCK_BIN_FORMAT
+
+# 用不可能满足的难度，保证两边都跑满同样的nonce数
+BENCH_BITS = b'\x00' * 4
+BENCH_NONCES = 1_000_000
+
+
+def legacy_loop(template: BlockTemplate, count: int):
+    # 原来do_mining_loop + is_validate的写法，每个nonce打包整个区块头再计算hash
+    nonce = 0
+    while nonce < count:
+        template.nonce = nonce
+        if nonce % 100000 == 0:
+            pass
+        header = struct.pack(BLOCK_BIN_FORMAT, template.prev_hash, template.merkle_root, template.nonce, template.bits,
+                             template.timestamp, template.height)
+        if not hashlib.sha256(header).digest() > template.bits:
+            return nonce
+        nonce += 1
+    return None
+
+
+def bench(name, func, block, count):
+    start = time.perf_counter()
+    func(block, count)
+    cost = time.perf_counter() - start
+    rate = count / cost
+    print(f'{name:<10} {count} nonces, {cost:.3f}s, {rate:,.0f} nonce/s')
+    return rate
+
+
+if __name__ == "__main__":
+    block = BlockTemplate(b'\x11' * 32, 0, BENCH_BITS, int(time.time()), height=2)
+    legacy_rate = bench('legacy', legacy_loop, block, BENCH_NONCES)
+    kernel_rate = bench('kernel', lambda b, n: mine_nonce_range(b, 0, n), block, BENCH_NONCES)
+    print(f'speedup: {kernel_rate / legacy_rate:.2f}x')
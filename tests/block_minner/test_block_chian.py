@@ -1,10 +1,349 @@
+import asyncio
+import hashlib
+import io
+import json
+import pickle
+import threading
+import time
 import unittest
-from p2p_minner.block_chain import Block,BlockChain,BLOCK_BIN_FORMAT,int_to_bytes
+from p2p_minner.block_chain import Block,BlockChain,BLOCK_BIN_FORMAT,int_to_bytes,mine_nonce_range,Minner,MiningWorkerPool,BlockTemplate,adaptive_check_interval,\
+    compact_to_target,target_to_compact,handle_input_cmd,block_work,BITS_CACHE_SIZE
+
+from p2p_minner.ledger import block_reward
+from p2p_minner.mempool import Mempool
+from p2p_minner.transaction import Transaction, merkle_root
+from p2p_minner.mining_telemetry import MiningTelemetry, MAX_RECENT_FOUND_BLOCKS
+from config import BLOCK_STATUS_VALID, BLOCK_STATUS_FORK, BLOCK_STATUS_INVALID
+
+# 测试用的低难度，目标值为0xffff << 232，大约256次hash就能找到一个区块
+EASY_BITS = bytes.fromhex("2000ffff")
+
+def mine_block(prev_block, timestamp=1700000000, bits=None):
+    # 测试用，在prev_block后面挖一个区块，不同的timestamp得到不同的区块
+    template = BlockTemplate(prev_block.hash(), 0, bits or prev_block.bits, timestamp, prev_block.height + 1)
+    return template.to_block(mine_nonce_range(template))
 
 class testTestBlockChian(unittest.TestCase):
 
     def setUp(self):
-        pass
+        self.prev_block = Block(b'\x22' * 32, nonce=0, bits=EASY_BITS, timestamp=1700000000, height=1)
 
     def testBlockSerialize(self):
-        pass
+        block = Block(b'\x11' * 32, nonce=7, bits=EASY_BITS, timestamp=1700000000, height=3)
+        data = block.serialize()
+        self.assertEqual(len(data), Block.BLOCK_BIN_LEN)
+        self.assertEqual(Block.deserialize(data).hash(), block.hash())
+
+    def testBlockCachedHash(self):
+        block = Block(b'\x11' * 32, nonce=7, bits=EASY_BITS, timestamp=1700000000, height=3)
+        self.assertFalse(hasattr(block, '__dict__'))
+        # hash只计算一次
+        self.assertIs(block.hash(), block.hash())
+        copied = pickle.loads(pickle.dumps(block))
+        self.assertEqual(copied.hash(), block.hash())
+        self.assertEqual(copied.nonce, 7)
+
+    def testMiningKernelMatchesLegacyLoop(self):
+        template = BlockTemplate.from_prev_block(self.prev_block)
+        # 原来的逐个nonce调用is_validate的方式
+        legacy_nonce = 0
+        while not template.to_block(legacy_nonce).is_validate():
+            legacy_nonce += 1
+        self.assertEqual(mine_nonce_range(template), legacy_nonce)
+        self.assertIsNone(mine_nonce_range(template, 0, legacy_nonce))
+
+    def testMiningKernelStop(self):
+        template = BlockTemplate(self.prev_block.hash(), 0, b'\x00' * 4, 1700000000, height=2)
+        self.assertIsNone(mine_nonce_range(template, should_stop=lambda: True))
+
+    def testDoMiningLoop(self):
+        new_block = Minner.do_mining_loop(self.prev_block, threading.Event())
+        self.assertTrue(new_block.is_validate())
+        self.assertEqual(new_block.prev_hash, self.prev_block.hash())
+        self.assertEqual(new_block.height, 2)
+
+    def testMiningTelemetry(self):
+        chain = BlockChain(EASY_BITS)
+        telemetry = MiningTelemetry(1)
+        new_block = Minner.do_mining_loop(chain.get_best_tip(), threading.Event(), telemetry=telemetry)
+        self.assertGreater(telemetry.hashes[0], 0)
+        telemetry.record_found_block(new_block)
+        self.assertTrue(chain.add_block(new_block))
+        # 没接上主链的区块算孤块
+        telemetry.record_found_block(mine_block(self.prev_block))
+        # 中止后挖矿线程退出，中止延迟只由worker池记录
+        impossible_block = Block(b'\x22' * 32, nonce=0, bits=b'\x00' * 4, timestamp=1700000000, height=1)
+        event = threading.Event()
+        event.set()
+        self.assertIsNone(Minner.do_mining_loop(impossible_block, event, telemetry=telemetry))
+        snapshot = telemetry.snapshot(chain)
+        self.assertEqual(snapshot['blocks_found'], 2)
+        self.assertEqual(snapshot['blocks_orphaned'], 1)
+        self.assertEqual(snapshot['abort_count'], 0)
+        self.assertGreater(snapshot['hashrate'], 0)
+        self.assertEqual(json.loads(telemetry.to_json(chain))['workers'], 1)
+        # 只保留最近挖到的区块，总数另外计数
+        for _ in range(MAX_RECENT_FOUND_BLOCKS):
+            telemetry.record_found_block(new_block)
+        self.assertEqual(len(telemetry.found_blocks), MAX_RECENT_FOUND_BLOCKS)
+        self.assertEqual(telemetry.snapshot(chain)['blocks_found'], MAX_RECENT_FOUND_BLOCKS + 2)
+        self.assertEqual(telemetry.snapshot(chain)['blocks_orphaned'], 0)
+    def testChainIndexes(self):
+        chain = BlockChain(EASY_BITS)
+        genesis = chain.get_best_tip()
+        new_block = Minner.do_mining_loop(genesis, threading.Event())
+        self.assertTrue(chain.add_block(new_block))
+        self.assertTrue(chain.contains(new_block.hash()))
+        self.assertIs(chain.get_by_hash(genesis.hash()), genesis)
+        self.assertIs(chain.get_by_height(new_block.height), new_block)
+        self.assertIsNone(chain.get_by_height(new_block.height + 1))
+        chain.reset_chian()
+        self.assertFalse(chain.contains(new_block.hash()))
+        self.assertEqual(len(chain.block_index), 1)
+    def testForkAndReorg(self):
+        chain = BlockChain(EASY_BITS)
+        genesis = chain.get_best_tip()
+        a1 = mine_block(genesis, 1)
+        a2 = mine_block(a1, 2)
+        self.assertTrue(chain.add_block(a1))
+        self.assertTrue(chain.add_block(a2))
+        self.assertFalse(chain.add_block(a2))
+        # 侧链工作量没有超过主链，不切换
+        b1 = mine_block(genesis, 11)
+        b2 = mine_block(b1, 12)
+        self.assertTrue(chain.add_block(b1))
+        self.assertTrue(chain.add_block(b2))
+        self.assertIs(chain.get_best_tip(), a2)
+        self.assertEqual(chain.get_status(b1.hash()), BLOCK_STATUS_FORK)
+        # 侧链更长，重组
+        b3 = mine_block(b2, 13)
+        self.assertTrue(chain.add_block(b3))
+        self.assertEqual(chain.blocks, [genesis, b1, b2, b3])
+        self.assertEqual(chain.get_status(a1.hash()), BLOCK_STATUS_FORK)
+        self.assertEqual(chain.get_status(b3.hash()), BLOCK_STATUS_VALID)
+        self.assertIs(chain.get_by_height(2), b1)
+        self.assertTrue(chain.check_chian())
+        # 主链切回原来的分支
+        a3 = mine_block(a2, 3)
+        a4 = mine_block(a3, 4)
+        chain.add_block(a3)
+        chain.add_block(a4)
+        self.assertEqual(chain.blocks, [genesis, a1, a2, a3, a4])
+
+    def testInvalidBlockStatus(self):
+        chain = BlockChain(EASY_BITS)
+        genesis = chain.get_best_tip()
+        # 难度和父区块不一致，直接丢弃，不保存到区块树
+        for timestamp in range(1, 20):
+            easy = BlockTemplate(genesis.hash(), 0, bytes.fromhex("207fffff"), timestamp, genesis.height + 1)
+            self.assertFalse(chain.add_block(easy.to_block(mine_nonce_range(easy))))
+        bad_bits = mine_block(genesis, 1, bits=bytes.fromhex("2000fffe"))
+        self.assertFalse(chain.add_block(bad_bits))
+        self.assertIsNone(chain.get_status(bad_bits.hash()))
+        self.assertEqual(len(chain.block_index), 1)
+        # 按要求的难度做了工作量但是coinbase金额超过奖励，记为无效
+        txs = [Transaction.coinbase('alice', 2, block_reward(2) + 1)]
+        template = BlockTemplate(genesis.hash(), 0, EASY_BITS, 1, 2, merkle_root([tx.hash() for tx in txs]))
+        bad = template.to_block(mine_nonce_range(template), txs)
+        self.assertFalse(chain.add_block(bad))
+        self.assertEqual(chain.get_status(bad.hash()), BLOCK_STATUS_INVALID)
+        child = mine_block(bad, 2)
+        self.assertFalse(chain.add_block(child))
+        self.assertEqual(chain.get_status(child.hash()), BLOCK_STATUS_INVALID)
+        self.assertEqual(chain.block_len(), 1)
+    def testStreamingSerialize(self):
+        chain = BlockChain(EASY_BITS)
+        for timestamp in range(1, 6):
+            chain.add_block(mine_block(chain.get_best_tip(), timestamp))
+        expected = b''.join(block.serialize() for block in chain.blocks)
+        self.assertEqual(chain.serialize(), expected)
+        self.assertEqual(bytes(chain.serialize_into()), expected)
+        self.assertEqual(b''.join(chain.iter_chunks(chunk_blocks=4)), expected)
+        # 高度范围[2,4)
+        self.assertEqual(b''.join(chain.iter_chunks(2, 4)), expected[Block.BLOCK_BIN_LEN:3 * Block.BLOCK_BIN_LEN])
+        stream = io.BytesIO()
+        self.assertEqual(chain.write_to(stream, chunk_blocks=2), len(expected))
+        self.assertEqual(stream.getvalue(), expected)
+        self.assertEqual(chain.hash(), hashlib.sha256(expected).digest())
+    def testBulkImport(self):
+        chain = BlockChain(EASY_BITS)
+        for timestamp in range(1, 8):
+            chain.add_block(mine_block(chain.get_best_tip(), timestamp))
+        data = chain.serialize()
+        imported = BlockChain.deserialize(data, workers=1)
+        self.assertEqual([block.hash() for block in imported.blocks], [block.hash() for block in chain.blocks])
+        self.assertTrue(imported.check_chian())
+        self.assertEqual(imported.block_index[imported.get_best_tip().hash()].chain_work,
+                         chain.block_index[chain.get_best_tip().hash()].chain_work)
+        self.assertEqual(BlockChain.from_b64(chain.to_b64()).hash(), chain.hash())
+        # 并行计算hash的结果和单进程一致
+        self.assertEqual(imported._hash_headers(memoryview(data), workers=2, chunk_blocks=3),
+                         imported._hash_headers(memoryview(data), workers=1))
+        # 链接断开或者pow不合格都整批拒绝
+        broken = data[:Block.BLOCK_BIN_LEN * 3] + data[Block.BLOCK_BIN_LEN * 4:]
+        self.assertIsNone(BlockChain.deserialize(broken, workers=1))
+        tampered = bytearray(data)
+        tampered[Block.BLOCK_BIN_LEN * 2 + 32] ^= 0xff
+        self.assertIsNone(BlockChain.deserialize(bytes(tampered), workers=1))
+    def testIncrementalCheck(self):
+        chain = BlockChain(EASY_BITS)
+        for timestamp in range(1, 5):
+            chain.add_block(mine_block(chain.get_best_tip(), timestamp))
+        self.assertTrue(chain.check_chian())
+        self.assertEqual(chain.validated_count, 5)
+        chain.add_block(mine_block(chain.get_best_tip(), 5))
+        self.assertTrue(chain.check_chian())
+        self.assertEqual(chain.validated_count, 6)
+        self.assertTrue(chain.check_chian(full=True, workers=1))
+        # 审计同样检查检查点，失败时从不匹配的区块开始重新检查
+        chain.checkpoints = {3: b'\x11' * 32}
+        self.assertFalse(chain.check_chian(full=True, workers=1))
+        self.assertEqual(chain.validated_count, 2)
+        chain.checkpoints = {}
+        # 伪造的区块接到主链后，增量检查和审计都能发现
+        best_tip = chain.get_best_tip()
+        chain._connect_block(Block(b'\x11' * 32, 0, EASY_BITS, 6, best_tip.height + 1))
+        self.assertFalse(chain.check_chian())
+        self.assertEqual(chain.validated_count, 6)
+        self.assertFalse(chain.check_chian(full=True, workers=1))
+    def testCompactBits(self):
+        self.assertEqual(compact_to_target(Block.DEFAULT_BITS), 0xa8 << 224)
+        self.assertEqual(compact_to_target(bytes.fromhex("1d00ffff")), 0xffff << 208)
+        self.assertEqual(target_to_compact(0xffff << 208).hex(), "1d00ffff")
+        self.assertEqual(target_to_compact(0x12345678 << 100), target_to_compact(0x123456 << 108))
+        # 符号位为1的bits无效
+        self.assertEqual(compact_to_target(bytes.fromhex("1d80ffff")), 0)
+        # 其它节点发来的bits再多，缓存也不超过上限
+        for mantissa in range(5000):
+            block_work(bytes([0x1d]) + mantissa.to_bytes(3, 'big'))
+        self.assertLessEqual(compact_to_target.cache_info().currsize, BITS_CACHE_SIZE)
+        self.assertLessEqual(block_work.cache_info().currsize, BITS_CACHE_SIZE)
+
+    def testRetarget(self):
+        chain = BlockChain(EASY_BITS, adjustment_interval=4, target_timespan=4 * 60)
+        genesis = chain.get_best_tip()
+        # 每30秒一个区块，比目标快。第一个周期从创世区块算起，高度1到4用了90秒
+        timestamp = genesis.timestamp
+        for _ in range(4):
+            timestamp += 30
+            parent = chain.block_index[chain.get_best_tip().hash()]
+            self.assertTrue(chain.add_block(mine_block(chain.get_best_tip(), timestamp, chain.next_bits(parent))))
+        self.assertEqual(chain.get_by_height(4).bits, EASY_BITS)
+        self.assertEqual(chain.get_by_height(5).bits, target_to_compact(compact_to_target(EASY_BITS) * 90 // 240))
+        tip = chain.get_best_tip()
+        self.assertEqual(chain.next_bits(chain.block_index[tip.hash()]), tip.bits)
+        self.assertTrue(chain.check_chian(full=True, workers=1))
+        imported = BlockChain(create_genesis=False, adjustment_interval=4, target_timespan=4 * 60)
+        self.assertTrue(imported.import_headers(chain.serialize(), workers=1))
+        stale = BlockChain(create_genesis=False, adjustment_interval=8, target_timespan=8 * 60)
+        self.assertFalse(stale.import_headers(chain.serialize(), workers=1))
+
+    def testCheckpointsAssumeValid(self):
+        # 没有挖过的区块头，pow都不合格，只有hash链接是正确的
+        hard_bits = bytes.fromhex("03000001")
+        headers, prev_hash = [], b'\x00' * 32
+        for height in range(1, 11):
+            block = Block(prev_hash, 0, hard_bits, 1700000000 + height, height)
+            headers.append(block)
+            prev_hash = block.hash()
+        data = b''.join(block.serialize() for block in headers)
+        checkpoints = {5: headers[4].hash(), 10: headers[9].hash()}
+        self.assertFalse(BlockChain(create_genesis=False, checkpoints=checkpoints).import_headers(data, workers=1))
+        chain = BlockChain(create_genesis=False, checkpoints=checkpoints, assume_valid=True)
+        self.assertTrue(chain.import_headers(data, workers=1))
+        self.assertTrue(chain.check_chian())
+        # 最后一个检查点之后还要验证pow
+        self.assertFalse(chain.add_block(Block(prev_hash, 0, hard_bits, 1700000011, 11)))
+        # 和检查点不一致时整批拒绝
+        wrong = BlockChain(create_genesis=False, checkpoints={5: b'\x11' * 32, 10: headers[9].hash()}, assume_valid=True)
+        self.assertFalse(wrong.import_headers(data, workers=1))
+
+    def testRejectForkBeforeCheckpoint(self):
+        chain = BlockChain(EASY_BITS)
+        for timestamp in range(1, 6):
+            chain.add_block(mine_block(chain.get_best_tip(), timestamp))
+        chain.checkpoints = {4: chain.get_by_height(4).hash()}
+        chain.last_checkpoint_height = 4
+        fork_block = mine_block(chain.get_by_height(2), 999)
+        self.assertFalse(chain.add_block(fork_block))
+        self.assertFalse(chain.contains(fork_block.hash()))
+        self.assertTrue(chain.add_block(mine_block(chain.get_by_height(5), 999)))
+
+    def testInputCommandErrors(self):
+        # 控制台输入错误只输出日志，不抛出异常
+        minner = Minner(BlockChain(EASY_BITS), threading.Event(), mempool=Mempool())
+
+        async def run():
+            with self.assertLogs('p2p_minner.block_chain', 'DEBUG') as logs:
+                await handle_input_cmd(minner, 'checkpoints abc')
+            self.assertIn('检查点间隔必须是正整数', logs.output[0])
+            for cmd in ('tx alice', 'tx alice bob x 1', 'tx alice bob 1 -1', 'tx ' + 'a' * 256 + ' bob 1 1'):
+                with self.assertLogs('p2p_minner.block_chain', 'DEBUG') as logs:
+                    await handle_input_cmd(minner, cmd)
+                self.assertIn('交易参数不正确', logs.output[0])
+            await handle_input_cmd(minner, 'tx alice bob 10 2')
+            self.assertEqual(len(minner.mempool), 1)
+
+        asyncio.run(run())
+
+
+class testMiningWorkerPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = MiningWorkerPool(2, check_interval=10000)
+        self.prev_block = Block(b'\x22' * 32, nonce=0, bits=EASY_BITS, timestamp=1700000000, height=1)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def testMineFindsBlock(self):
+        new_block = asyncio.run(self.pool.mine(self.prev_block))
+        self.assertTrue(new_block.is_validate())
+        self.assertEqual(new_block.prev_hash, self.prev_block.hash())
+        self.assertGreater(sum(self.pool.telemetry.hashes), 0)
+
+    def testAbortStaleWork(self):
+        impossible_block = Block(b'\x22' * 32, nonce=0, bits=b'\x00' * 4, timestamp=1700000000, height=1)
+
+        async def mine_then_cancel():
+            task = asyncio.create_task(self.pool.mine(impossible_block))
+            await asyncio.sleep(0.3)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(mine_then_cancel())
+        deadline = time.time() + 5
+        while self.pool.last_abort_latency is None and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertIsNotNone(self.pool.last_abort_latency)
+        self.assertLess(self.pool.max_abort_latency, 1)
+
+    def testSwitchTemplateWithoutRestartingWorkers(self):
+        pool = MiningWorkerPool(1, use_processes=False, check_interval=1000, target_switch_ms=10)
+        impossible_block = Block(b'\x22' * 32, nonce=0, bits=b'\x00' * 4, timestamp=1700000000, height=1)
+
+        async def switch():
+            task = asyncio.create_task(pool.mine(impossible_block))
+            await asyncio.sleep(0.2)
+            workers = list(pool.worker_handles)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            new_block = await pool.mine(self.prev_block)
+            self.assertEqual(pool.worker_handles, workers)
+            return new_block
+
+        try:
+            new_block = asyncio.run(switch())
+        finally:
+            pool.close()
+        self.assertTrue(new_block.is_validate())
+        self.assertEqual(new_block.prev_hash, self.prev_block.hash())
+        self.assertIsNotNone(pool.last_abort_latency)
+        self.assertLess(pool.max_abort_latency, 0.5)
+
+    def testAdaptiveCheckInterval(self):
+        self.assertEqual(adaptive_check_interval(1_000_000, 50), 50000)
+        self.assertEqual(adaptive_check_interval(10, 50), 1000)
+        self.assertEqual(adaptive_check_interval(1e12, 50), 1000000)
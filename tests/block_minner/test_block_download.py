@@ -0,0 +1,113 @@
+import asyncio
+import json
+import random
+import time
+import unittest
+
+from p2p_minner.block_chain import BLOCK_BIN_LEN
+from p2p_minner.block_download import BlockDownloader
+from p2p_minner.protocol import Protocol, HEADER_LEN
+from test_header_sync import new_chain, extend_chain
+
+
+class FakePeer:
+    # 发给对方的消息经过一次编码放进共享的队列，drop为True时不返回数据，模拟卡住的节点
+    def __init__(self, node_id, outbox, remote_download=None, local_peer=None):
+        self.node_id = node_id
+        self.outbox = outbox
+        self.remote_download = remote_download
+        self.local_peer = local_peer
+        self.drop = False
+
+    async def send_message(self, msgtype, payload=None):
+        if not self.drop:
+            self.outbox.append((self.remote_download, self.local_peer, msgtype, json.loads(json.dumps(payload))))
+
+    async def send_binary_message(self, msgtype, data, **fields):
+        frame = Protocol.serialize_binary_message(msgtype, data, **fields)
+        message = Protocol.deserialize_binary_payload(frame[HEADER_LEN:])
+        self.outbox.append((self.remote_download, self.local_peer, msgtype, message['payload']))
+
+
+class testBlockDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.remote = new_chain()
+        extend_chain(self.remote, 60)
+        self.local = new_chain(create_genesis=False)
+        self.local.import_headers(self.remote.serialize()[:10 * BLOCK_BIN_LEN])
+        self.forks = []
+
+        async def on_fork(peer):
+            self.forks.append(peer)
+
+        self.download = BlockDownloader(self.local, chunk_size=5, max_in_flight=3, max_buffer_chunks=4,
+                                        stall_timeout=5, on_fork=on_fork)
+        self.outbox = []
+
+    def connect(self, node_id, chain):
+        peer = FakePeer(node_id, self.outbox)
+        # 对方的回复交给本地的下载器处理
+        peer.remote_download = BlockDownloader(chain)
+        peer.local_peer = FakePeer(node_id, self.outbox, self.download, peer)
+        return peer
+
+    async def pump(self, rng):
+        # 随机顺序处理消息，回复不按请求顺序到达
+        max_ready = 0
+        while self.outbox:
+            max_ready = max(max_ready, len(self.download.ready))
+            for state in self.download.peers.values():
+                self.assertLessEqual(len(state.in_flight), self.download.max_in_flight)
+            target, peer, msgtype, payload = self.outbox.pop(rng.randrange(len(self.outbox)))
+            await getattr(target, f'on_{msgtype}')(peer, payload)
+        return max_ready
+
+    def testParallelDownload(self):
+        peers = [self.connect(node_id, self.remote) for node_id in range(3)]
+
+        async def run():
+            for peer in peers:
+                await self.download.add_peer(peer, self.remote.get_best_tip().height)
+            return await self.pump(random.Random(1))
+
+        max_ready = asyncio.run(run())
+        self.assertLessEqual(max_ready, self.download.max_buffer_chunks)
+        self.assertFalse(self.download.is_downloading())
+        self.assertEqual(self.local.serialize(), self.remote.serialize())
+        # 每个节点都分到了区块
+        self.assertTrue(all(state.received_count > 0 for state in self.download.peers.values()))
+        self.assertEqual(sum(state.received_count for state in self.download.peers.values()), 51)
+
+    def testReassignStalledChunks(self):
+        peers = [self.connect(node_id, self.remote) for node_id in range(2)]
+        peers[0].drop = True
+
+        async def run():
+            for peer in peers:
+                await self.download.add_peer(peer, self.remote.get_best_tip().height)
+            await self.pump(random.Random(2))
+            self.assertTrue(self.download.is_downloading())
+            # 卡住的节点的请求超时后分配给另一个节点
+            await self.download.check_stalls(time.time() + 10)
+            await self.pump(random.Random(3))
+
+        asyncio.run(run())
+        self.assertEqual(self.local.get_best_tip().hash(), self.remote.get_best_tip().hash())
+        self.assertEqual(self.download.peers[0].stalls, 1)
+        self.assertEqual(self.download.peers[0].received_count, 0)
+
+    def testForkFallsBackToLocator(self):
+        other = new_chain(create_genesis=False)
+        other.import_headers(self.remote.serialize()[:5 * BLOCK_BIN_LEN])
+        extend_chain(other, 40, step=90)
+        peer = self.connect(1, other)
+
+        async def run():
+            self.assertTrue(await self.download.add_peer(peer, other.get_best_tip().height))
+            await self.pump(random.Random(4))
+
+        asyncio.run(run())
+        self.assertEqual(self.forks, [peer])
+        self.assertFalse(self.download.is_downloading())
+        self.assertEqual(self.local.get_best_tip().height, 10)
@@ -0,0 +1,66 @@
+import tempfile
+import unittest
+
+from p2p_minner.block_chain import Block, BlockChain
+from p2p_minner.block_store import BlockStore, BLOCK_FILE_NAME
+from test_block_chian import EASY_BITS, mine_block
+
+
+class testBlockStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.data_dir = self.tmp_dir.name
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def build_chain(self, count):
+        store = BlockStore(self.data_dir, sync_every=3)
+        chain = BlockChain.load(store, EASY_BITS)
+        for timestamp in range(1, count):
+            chain.add_block(mine_block(chain.get_best_tip(), timestamp))
+        store.close()
+        return chain
+
+    def testReloadChain(self):
+        chain = self.build_chain(10)
+        store = BlockStore(self.data_dir)
+        self.assertEqual(store.count, 10)
+        loaded = BlockChain.load(store, EASY_BITS)
+        self.assertEqual(loaded.hash(), chain.hash())
+        self.assertTrue(loaded.contains(chain.get_best_tip().hash()))
+        store.close()
+
+    def testTruncatePartialTail(self):
+        chain = self.build_chain(5)
+        # 模拟写到一半崩溃
+        with open(f'{self.data_dir}/{BLOCK_FILE_NAME}', 'ab') as f:
+            f.write(b'\x01' * 10)
+        store = BlockStore(self.data_dir)
+        self.assertEqual(store.count, 5)
+        self.assertEqual(BlockChain.load(store, EASY_BITS).hash(), chain.hash())
+        store.close()
+
+    def testTruncateCorruptTail(self):
+        self.build_chain(5)
+        with open(f'{self.data_dir}/{BLOCK_FILE_NAME}', 'r+b') as f:
+            f.seek(Block.BLOCK_BIN_LEN * 3 + 40)
+            f.write(b'\xff\xff\xff\xff')
+        store = BlockStore(self.data_dir)
+        self.assertEqual(store.count, 3)
+        store.close()
+
+    def testReorgTruncatesStore(self):
+        store = BlockStore(self.data_dir)
+        chain = BlockChain.load(store, EASY_BITS)
+        genesis = chain.get_best_tip()
+        chain.add_block(mine_block(genesis, 1))
+        b1 = mine_block(genesis, 11)
+        b2 = mine_block(b1, 12)
+        chain.add_block(b1)
+        chain.add_block(b2)
+        store.close()
+        store = BlockStore(self.data_dir)
+        self.assertEqual(store.hashes(), [genesis.hash(), b1.hash(), b2.hash()])
+        store.close()
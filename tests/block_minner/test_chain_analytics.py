@@ -0,0 +1,86 @@
+import csv
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from config import BLOCK_STATUS_INVALID
+from p2p_minner.block_chain import BlockChain, BlockTemplate, block_work, mine_nonce_range
+from p2p_minner.chain_analytics import ChainColumns, analyze, implied_hashrate, moving_difficulty, \
+    run_analytics_command
+from p2p_minner.columnar_chain import ColumnarBlockChain
+from p2p_minner.ledger import block_reward
+from p2p_minner.transaction import Transaction, merkle_root
+from test_block_chian import EASY_BITS, mine_block
+
+
+class testChainAnalytics(unittest.TestCase):
+
+    def setUp(self):
+        self.chain = BlockChain(EASY_BITS, adjustment_interval=4, target_timespan=4 * 60)
+        timestamp = self.chain.get_best_tip().timestamp
+        for step in range(1, 11):
+            timestamp += 20 * step
+            self.chain.add_block(mine_block(self.chain.get_best_tip(), timestamp, self.chain.next_tip_bits()))
+
+    def testColumns(self):
+        columns = ChainColumns.from_chain(self.chain)
+        self.assertEqual(columns.heights.tolist(), [block.height for block in self.chain.blocks])
+        self.assertEqual(columns.timestamps.tolist(), [block.timestamp for block in self.chain.blocks])
+        for work, block in zip(columns.work, self.chain.blocks):
+            self.assertAlmostEqual(work / block_work(block.bits), 1, delta=1e-6)
+        # 按列存储的链得到相同的列
+        columnar = ColumnarBlockChain(create_genesis=False, adjustment_interval=4, target_timespan=4 * 60)
+        columnar.import_headers(self.chain.serialize(), workers=1)
+        other = ChainColumns.from_chain(columnar, 3, 8)
+        self.assertEqual(other.heights.tolist(), [3, 4, 5, 6, 7])
+        self.assertTrue(np.array_equal(other.work, columns.work[2:7]))
+        # 快照不引用链的内存，之后还能继续增加区块
+        tip = columnar.get_best_tip()
+        self.assertTrue(columnar.add_block(mine_block(tip, tip.timestamp + 60, columnar.next_tip_bits())))
+        self.assertEqual(len(other), 5)
+
+    def testWindows(self):
+        columns = ChainColumns.from_chain(self.chain)
+        window = 4
+        difficulty = moving_difficulty(columns, window)
+        hashrate = implied_hashrate(columns, window)
+        self.assertTrue(np.isnan(difficulty[:window - 1]).all())
+        self.assertAlmostEqual(difficulty[-1], columns.work[-window:].mean())
+        span = columns.timestamps[-1] - columns.timestamps[-window]
+        self.assertAlmostEqual(hashrate[-1], columns.work[-window + 1:].sum() / span)
+
+    def testReportAndExport(self):
+        genesis = self.chain.blocks[0]
+        # 侧链上的区块计为孤块
+        self.chain.add_block(mine_block(genesis, genesis.timestamp + 1))
+        # 难度不对的区块和无效的区块不计为孤块
+        self.assertFalse(self.chain.add_block(mine_block(genesis, genesis.timestamp + 2, bytes.fromhex("207fffff"))))
+        txs = [Transaction.coinbase('alice', 2, block_reward(2) + 1)]
+        template = BlockTemplate(genesis.hash(), 0, genesis.bits, genesis.timestamp + 3, 2, merkle_root([tx.hash() for tx in txs]))
+        invalid = template.to_block(mine_nonce_range(template), txs)
+        self.assertFalse(self.chain.add_block(invalid))
+        self.assertEqual(self.chain.get_status(invalid.hash()), BLOCK_STATUS_INVALID)
+        columns = ChainColumns.from_chain(self.chain)
+        report = analyze(columns, window=4)
+        self.assertEqual(report['intervals']['count'], 10)
+        self.assertEqual((report['intervals']['min'], report['intervals']['max']), (20, 200))
+        self.assertEqual(sum(report['intervals']['histogram']['counts']), 10)
+        self.assertEqual(report['orphans']['orphans'], 1)
+        self.assertAlmostEqual(report['orphans']['orphan_rate'], 1 / 12)
+        self.assertEqual(report['orphans']['segment_rates'], [1 / 5, 0, 0])
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_path = os.path.join(tmp, 'chain.csv')
+            json_path = os.path.join(tmp, 'chain.json')
+            run_analytics_command(columns, ['4', csv_path])
+            run_analytics_command(columns, ['4', json_path])
+            with open(csv_path, 'r', encoding='utf8') as f:
+                rows = list(csv.DictReader(f))
+            with open(json_path, 'r', encoding='utf8') as f:
+                self.assertEqual(json.load(f), json.loads(json.dumps(report)))
+        self.assertEqual(len(rows), 11)
+        self.assertEqual(rows[0]['interval'], '')
+        self.assertEqual(rows[1]['interval'], '20')
+        self.assertEqual(rows[-1]['bits'], self.chain.blocks[-1].bits.hex())
@@ -0,0 +1,70 @@
+import unittest
+
+from p2p_minner.block_chain import BlockChain, BLOCK_BIN_LEN
+from p2p_minner.columnar_chain import ColumnarBlockChain
+from test_block_chian import EASY_BITS, mine_block
+
+
+class testColumnarBlockChain(unittest.TestCase):
+
+    def setUp(self):
+        self.chain = BlockChain(EASY_BITS, adjustment_interval=4, target_timespan=4 * 60)
+        timestamp = self.chain.get_best_tip().timestamp
+        for step in range(1, 11):
+            timestamp += 20 * step
+            self.chain.add_block(mine_block(self.chain.get_best_tip(), timestamp, self.chain.next_tip_bits()))
+
+    def new_columnar(self):
+        return ColumnarBlockChain(create_genesis=False, adjustment_interval=4, target_timespan=4 * 60)
+
+    def testImportMatchesBlockChain(self):
+        columnar = self.new_columnar()
+        self.assertTrue(columnar.import_headers(self.chain.serialize(), workers=1))
+        self.assertEqual(columnar.block_len(), self.chain.block_len())
+        self.assertEqual(columnar.serialize(), self.chain.serialize())
+        for block in self.chain.blocks:
+            self.assertEqual(columnar.get_by_hash(block.hash()).serialize(), block.serialize())
+            self.assertEqual(columnar.get_by_height(block.height).hash(), block.hash())
+        self.assertEqual(columnar.next_tip_bits(), self.chain.next_tip_bits())
+        self.assertFalse(columnar.contains(b'\x11' * 32))
+        self.assertTrue(columnar.check_chian())
+
+    def testAddBlockAndImportSuffix(self):
+        columnar = self.new_columnar()
+        data = self.chain.serialize()
+        split = 6 * BLOCK_BIN_LEN
+        self.assertTrue(columnar.import_headers(data[:split], workers=1))
+        # 逐个增加剩下的区块，难度调整的规则和BlockChain一致
+        for block in self.chain.blocks[6:9]:
+            self.assertTrue(columnar.add_block(block))
+        self.assertFalse(columnar.add_block(self.chain.blocks[3]))
+        self.assertTrue(columnar.import_headers(data[9 * BLOCK_BIN_LEN:], workers=1))
+        self.assertEqual(columnar.serialize(), data)
+
+    def testRejectBadBits(self):
+        bad = BlockChain(EASY_BITS, adjustment_interval=8, target_timespan=8 * 60)
+        timestamp = bad.get_best_tip().timestamp
+        for step in range(1, 11):
+            bad.add_block(mine_block(bad.get_best_tip(), timestamp + step, bad.next_tip_bits()))
+        self.assertFalse(self.new_columnar().import_headers(bad.serialize(), workers=1))
+
+    def testTimestampStats(self):
+        columnar = self.new_columnar()
+        columnar.import_headers(self.chain.serialize(), workers=1)
+        stats = columnar.timestamp_stats()
+        timestamps = [block.timestamp for block in self.chain.blocks]
+        self.assertEqual(stats['count'], len(timestamps))
+        self.assertEqual(stats['min_interval'], 20)
+        self.assertEqual(stats['max_interval'], 200)
+        self.assertEqual(stats['max_timestamp'], timestamps[-1])
+        self.assertEqual(columnar.timestamp_stats(3, 5)['count'], 2)
+
+    def testCheckpoints(self):
+        data = self.chain.serialize()
+        checkpoint = {6: self.chain.get_by_height(6).hash()}
+        columnar = ColumnarBlockChain(create_genesis=False, adjustment_interval=4, target_timespan=4 * 60,
+                                      checkpoints=checkpoint, assume_valid=True)
+        self.assertTrue(columnar.import_headers(data, workers=1))
+        wrong = ColumnarBlockChain(create_genesis=False, adjustment_interval=4, target_timespan=4 * 60,
+                                   checkpoints={6: b'\x11' * 32}, assume_valid=True)
+        self.assertFalse(wrong.import_headers(data, workers=1))
@@ -0,0 +1,37 @@
+import os
+import tempfile
+import unittest
+
+import yaml
+
+from p2p_minner.difficulty_calibration import bits_for_interval, expected_interval, measure_hashrate, \
+    write_genesis_bits
+
+
+class testDifficultyCalibration(unittest.TestCase):
+
+    def testBitsForInterval(self):
+        for hashrate, interval, miners in ((1e6, 60, 1), (5e5, 10, 8), (2e6, 600, 3)):
+            bits = bits_for_interval(hashrate, interval, miners)
+            self.assertAlmostEqual(expected_interval(bits, hashrate, miners), interval, delta=interval * 0.01)
+        # 更多的矿工需要更高的难度
+        self.assertLess(int.from_bytes(bits_for_interval(1e6, 60, 10), 'big'),
+                        int.from_bytes(bits_for_interval(1e6, 60, 1), 'big'))
+
+    def testMeasureHashrate(self):
+        rates = measure_hashrate(seconds=0.05, rounds=2, check_interval=1000)
+        self.assertEqual(len(rates), 2)
+        self.assertTrue(all(rate > 0 for rate in rates))
+
+    def testWriteGenesisBits(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'config.yaml')
+            with open(path, 'w', encoding='utf8') as f:
+                f.write('p2p:\n  listen_port: 1989 # 监听端口\n')
+            write_genesis_bits(path, bytes.fromhex('1e00d15f'))
+            write_genesis_bits(path, bytes.fromhex('1d7fffff'))
+            with open(path, 'r', encoding='utf8') as f:
+                text = f.read()
+            self.assertIn('# 监听端口', text)
+            self.assertEqual(text.count('genesis_bits'), 1)
+            self.assertEqual(yaml.safe_load(text)['p2p'], {'listen_port': 1989, 'genesis_bits': '1d7fffff'})
@@ -0,0 +1,112 @@
+import asyncio
+import json
+import unittest
+from collections import deque
+
+from p2p_minner.block_chain import BlockChain, BLOCK_BIN_LEN, locator_heights
+from p2p_minner.header_sync import HeaderSync, connect_headers
+from p2p_minner.protocol import Protocol, HEADER_LEN
+from test_block_chian import EASY_BITS, mine_block
+
+
+def new_chain(create_genesis=True):
+    return BlockChain(EASY_BITS, create_genesis=create_genesis, adjustment_interval=4, target_timespan=4 * 60)
+
+
+def extend_chain(chain, count, step=80):
+    timestamp = chain.get_best_tip().timestamp
+    for _ in range(count):
+        timestamp += step
+        chain.add_block(mine_block(chain.get_best_tip(), timestamp, chain.next_tip_bits()))
+
+
+class FakePeer:
+    # 消息放进共享的队列，由pump按顺序交给对方的HeaderSync处理，经过一次编码和真实连接一样
+    def __init__(self, node_id, outbox):
+        self.node_id = node_id
+        self.outbox = outbox
+        self.remote_sync = None
+        self.remote_peer = None
+
+    async def send_message(self, msgtype, payload=None):
+        self.outbox.append((self.remote_sync, self.remote_peer, msgtype, json.loads(json.dumps(payload))))
+
+    async def send_binary_message(self, msgtype, data, **fields):
+        frame = Protocol.serialize_binary_message(msgtype, data, **fields)
+        message = Protocol.deserialize_binary_payload(frame[HEADER_LEN:])
+        self.outbox.append((self.remote_sync, self.remote_peer, msgtype, message['payload']))
+
+
+def connect(local_sync, remote_sync):
+    outbox = deque()
+    to_remote, to_local = FakePeer(2, outbox), FakePeer(1, outbox)
+    to_remote.remote_sync, to_remote.remote_peer = remote_sync, to_local
+    to_local.remote_sync, to_local.remote_peer = local_sync, to_remote
+    return to_remote, outbox
+
+
+async def pump(outbox, sync):
+    max_in_flight = 0
+    while outbox:
+        max_in_flight = max(max_in_flight, len(sync.pending))
+        target, peer, msgtype, payload = outbox.popleft()
+        await getattr(target, f'on_{msgtype}')(peer, payload)
+    return max_in_flight
+
+
+class testHeaderSync(unittest.TestCase):
+
+    def setUp(self):
+        self.remote = new_chain()
+        extend_chain(self.remote, 30)
+
+    def testLocator(self):
+        heights = locator_heights(1, 1000)
+        self.assertEqual(heights[:10], list(range(1000, 990, -1)))
+        self.assertEqual(heights[-1], 1)
+        self.assertLess(len(heights), 25)
+        locator = self.remote.block_locator()
+        self.assertEqual(locator[0], self.remote.get_best_tip().hash())
+        self.assertEqual(self.remote.find_fork_height(locator), self.remote.get_best_tip().height)
+        self.assertIsNone(self.remote.find_fork_height([b'\x11' * 32]))
+
+    def testSyncNewNodeWithPipeline(self):
+        local = new_chain()
+        local_sync = HeaderSync(local, batch_size=4, pipeline_depth=3)
+        peer, outbox = connect(local_sync, HeaderSync(self.remote))
+
+        async def run():
+            await local_sync.start(peer)
+            return await pump(outbox, local_sync)
+
+        max_in_flight = asyncio.run(run())
+        self.assertEqual(max_in_flight, 3)
+        self.assertFalse(local_sync.is_syncing())
+        self.assertEqual(local.serialize(), self.remote.serialize())
+        self.assertTrue(local.check_chian(full=True))
+
+    def testSyncOnlyMissingSuffix(self):
+        local = new_chain(create_genesis=False)
+        local.import_headers(self.remote.serialize()[:20 * BLOCK_BIN_LEN])
+        extend_chain(local, 3, step=90)  # 本地的短分叉
+        local_sync = HeaderSync(local, batch_size=4, pipeline_depth=2)
+        peer, outbox = connect(local_sync, HeaderSync(self.remote))
+
+        async def run():
+            await local_sync.start(peer)
+            await pump(outbox, local_sync)
+
+        asyncio.run(run())
+        self.assertEqual(local_sync.received_count, self.remote.block_len() - 20)
+        self.assertEqual(local.get_best_tip().hash(), self.remote.get_best_tip().hash())
+        self.assertEqual(local.serialize(), self.remote.serialize())
+
+    def testBadGenesisBatchKeepsLocalGenesis(self):
+        local = new_chain()
+        genesis = local.get_best_tip()
+        # 对方的创世区块后面跟着一个接不上的区块头
+        data = bytearray(self.remote.serialize()[:3 * BLOCK_BIN_LEN])
+        data[BLOCK_BIN_LEN:BLOCK_BIN_LEN + 32] = b'\x11' * 32
+        self.assertFalse(connect_headers(local, bytes(data)))
+        self.assertEqual(local.block_len(), 1)
+        self.assertEqual(local.get_best_tip().hash(), genesis.hash())
@@ -0,0 +1,84 @@
+import unittest
+
+from config import INITIAL_BLOCK_REWARD, REWARD_CUTOFF_BLOCKS
+from p2p_minner.block_chain import BlockChain, BlockTemplate, mine_nonce_range
+from p2p_minner.ledger import block_reward
+from p2p_minner.mempool import Mempool
+from p2p_minner.transaction import Transaction, merkle_root
+from test_block_chian import EASY_BITS
+
+
+def mine_coinbase_block(prev_block, timestamp, address, amount=None):
+    height = prev_block.height + 1
+    txs = [Transaction.coinbase(address, height, block_reward(height) if amount is None else amount)]
+    template = BlockTemplate(prev_block.hash(), 0, EASY_BITS, timestamp, height, merkle_root([tx.hash() for tx in txs]))
+    return template.to_block(mine_nonce_range(template), txs)
+
+
+class testRewardLedger(unittest.TestCase):
+
+    def setUp(self):
+        self.chain = BlockChain(EASY_BITS)
+        self.genesis = self.chain.get_best_tip()
+
+    def extend(self, prev_block, count, address, step=60):
+        blocks = []
+        for _ in range(count):
+            prev_block = mine_coinbase_block(prev_block, prev_block.timestamp + step, address)
+            self.chain.add_block(prev_block)
+            blocks.append(prev_block)
+        return blocks
+
+    def testBlockReward(self):
+        self.assertEqual(block_reward(1), INITIAL_BLOCK_REWARD)
+        self.assertEqual(block_reward(REWARD_CUTOFF_BLOCKS), INITIAL_BLOCK_REWARD)
+        self.assertEqual(block_reward(REWARD_CUTOFF_BLOCKS + 1), INITIAL_BLOCK_REWARD // 2)
+        self.assertEqual(block_reward(REWARD_CUTOFF_BLOCKS * 64 + 1), 0)
+
+    def testReorgRevertsRewards(self):
+        self.extend(self.genesis, 2, 'alice')
+        ledger = self.chain.ledger
+        self.assertEqual(ledger.balance('alice'), 2 * INITIAL_BLOCK_REWARD)
+        # 更长的分叉，重组后alice的奖励被撤销
+        fork = self.extend(self.genesis, 3, 'bob', step=61)
+        self.assertEqual(self.chain.get_best_tip().hash(), fork[-1].hash())
+        self.assertEqual(ledger.balance('alice'), 0)
+        self.assertEqual(ledger.balance('bob'), 3 * INITIAL_BLOCK_REWARD)
+        self.assertEqual(ledger.total_issued, 3 * INITIAL_BLOCK_REWARD)
+        self.assertEqual(len(ledger.undo_records), 3)
+
+    def testHeaderOnlyBlocksMarkLedgerIncomplete(self):
+        self.extend(self.genesis, 3, 'alice')
+        self.assertTrue(self.chain.ledger.complete)
+        # 只导入区块头，不知道交易，余额为0但账本标记为不完整
+        chain = BlockChain.deserialize(self.chain.serialize())
+        self.assertEqual(chain.block_len(), self.chain.block_len())
+        self.assertEqual(chain.ledger.balance('alice'), 0)
+        self.assertFalse(chain.ledger.complete)
+        self.assertEqual(chain.ledger.stats()['missing_bodies'], 3)
+        # 重组断开只有区块头的区块后账本恢复完整
+        prev_block = chain.get_by_height(1)
+        for _ in range(4):
+            prev_block = mine_coinbase_block(prev_block, prev_block.timestamp + 61, 'bob')
+            self.assertTrue(chain.add_block(prev_block))
+        self.assertTrue(chain.ledger.complete)
+        self.assertEqual(chain.ledger.balance('bob'), 4 * INITIAL_BLOCK_REWARD)
+
+    def testRejectInvalidCoinbase(self):
+        block = mine_coinbase_block(self.genesis, self.genesis.timestamp + 60, 'alice', INITIAL_BLOCK_REWARD + 1)
+        self.assertFalse(self.chain.add_block(block))
+        self.assertEqual(self.chain.ledger.balance('alice'), 0)
+
+    def testMempoolCoinbaseSlot(self):
+        mempool = Mempool()
+        mempool.add(Transaction('alice', 'bob', 1, 5, 1))
+        mempool.add(Transaction('alice', 'bob', 1, 6, 2))
+        for height in (2, 3):
+            mempool.set_coinbase(Transaction.coinbase('carol', height, block_reward(height)))
+            root, txs, _ = mempool.block_template()
+            self.assertEqual(txs[0].nonce, height)
+            self.assertEqual(root, merkle_root([tx.hash() for tx in txs]))
+        mempool.remove(txs[1].hash())
+        root, txs, _ = mempool.block_template()
+        self.assertTrue(txs[0].is_coinbase())
+        self.assertEqual(root, merkle_root([tx.hash() for tx in txs]))
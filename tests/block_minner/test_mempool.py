@@ -0,0 +1,175 @@
+import asyncio
+import hashlib
+import random
+import unittest
+
+from p2p_minner.block_chain import Block, BlockChain, MiningWorkerPool, mine_nonce_range
+from p2p_minner.mempool import Mempool, MAX_BLOCK_TXS
+from p2p_minner.transaction import MerkleTree, Transaction, merkle_root, ZERO_HASH
+from test_block_chian import EASY_BITS, mine_block
+
+
+def new_tx(fee, nonce=0, sender='alice'):
+    return Transaction(sender, 'bob', 100, fee, nonce)
+
+
+class testMerkleTree(unittest.TestCase):
+
+    def testIncrementalMatchesFullRebuild(self):
+        rng = random.Random(7)
+        tree = MerkleTree()
+        leaves = []
+        self.assertEqual(tree.root(), ZERO_HASH)
+        for step in range(300):
+            leaf = hashlib.sha256(step.to_bytes(4, 'little')).digest()
+            action = rng.random()
+            if action < 0.6 or not leaves:
+                tree.append(leaf)
+                leaves.append(leaf)
+            elif action < 0.8:
+                index = rng.randrange(len(leaves))
+                tree.set(index, leaf)
+                leaves[index] = leaf
+            else:
+                index = rng.randrange(len(leaves))
+                tree.remove(index)
+                last = leaves.pop()
+                if index < len(leaves):
+                    leaves[index] = last
+            self.assertEqual(tree.root(), merkle_root(leaves))
+        self.assertEqual(MerkleTree(leaves).root(), merkle_root(leaves))
+
+
+class testMempool(unittest.TestCase):
+
+    def testFeePriorityAndBlockTemplate(self):
+        mempool = Mempool(max_block_txs=2)
+        low, mid, high = new_tx(1, 1), new_tx(5, 2), new_tx(9, 3)
+        for tx in (low, mid, high):
+            self.assertTrue(mempool.add(tx))
+        self.assertFalse(mempool.add(new_tx(5, 2)))
+        # 区块满了时替换掉手续费最低的交易
+        root, txs, _ = mempool.block_template()
+        self.assertEqual({tx.hash() for tx in txs}, {mid.hash(), high.hash()})
+        self.assertEqual(root, merkle_root([tx.hash() for tx in txs]))
+        # 区块中的交易被打包后用等待中的交易补上
+        mempool.remove_for_block(Block(ZERO_HASH, 0, EASY_BITS, 1, 2, transactions=[high]))
+        root, txs, _ = mempool.block_template()
+        self.assertEqual({tx.hash() for tx in txs}, {mid.hash(), low.hash()})
+        self.assertEqual(root, merkle_root([tx.hash() for tx in txs]))
+
+    def testMemoryCap(self):
+        size = new_tx(0).size()
+        mempool = Mempool(max_bytes=size * 3)
+        for nonce in range(3):
+            mempool.add(new_tx(10 + nonce, nonce))
+        self.assertFalse(mempool.add(new_tx(5, 10)))
+        self.assertTrue(mempool.add(new_tx(20, 11)))
+        self.assertEqual(len(mempool), 3)
+        self.assertNotIn(new_tx(10, 0).hash(), mempool)
+        self.assertLessEqual(mempool.total_bytes, mempool.max_bytes)
+        self.assertEqual(mempool.stats()['evicted'], 1)
+
+    def testCoinbaseCountsAgainstBlockCap(self):
+        # 随机加入、删除交易和设置coinbase，区块中的交易数不超过上限，Merkle树和交易一致
+        rng = random.Random(11)
+        for _ in range(100):
+            mempool = Mempool(max_block_txs=rng.randint(1, 6))
+            for step in range(rng.randint(0, 12)):
+                action = rng.random()
+                if action < 0.7:
+                    mempool.add(new_tx(rng.randint(0, 20), step))
+                elif action < 0.8 and mempool.txs:
+                    mempool.remove(rng.choice(list(mempool.txs)))
+                else:
+                    mempool.set_coinbase(Transaction.coinbase('miner', step, 50))
+                root, txs, _ = mempool.block_template()
+                self.assertLessEqual(len(txs), mempool.max_block_txs)
+                self.assertEqual(root, merkle_root([tx.hash() for tx in txs]))
+                self.assertEqual(len(mempool.block_positions) + (mempool.coinbase is not None), len(txs))
+
+    def testReorgReturnsTransactions(self):
+        chain = BlockChain(EASY_BITS)
+        mempool = Mempool()
+        genesis = chain.get_best_tip()
+        tx_a, tx_b = new_tx(1, 1), new_tx(2, 2)
+        for tx in (tx_a, tx_b):
+            mempool.add(tx)
+
+        def block_with(prev_block, txs, timestamp):
+            template = Block(prev_block.hash(), 0, EASY_BITS, timestamp, prev_block.height + 1,
+                             merkle_root([tx.hash() for tx in txs]), txs)
+            nonce = mine_nonce_range(template)
+            return Block(template.prev_hash, nonce, EASY_BITS, timestamp, template.height, template.merkle_root, txs)
+
+        a1 = block_with(genesis, [tx_a], 1)
+        old_tip = chain.get_best_tip()
+        self.assertTrue(chain.add_block(a1))
+        mempool.update_main_chain(chain, old_tip)
+        self.assertNotIn(tx_a.hash(), mempool)
+        # 只接到侧链的区块不影响交易池
+        b1 = block_with(genesis, [tx_b], 2)
+        old_tip = chain.get_best_tip()
+        self.assertTrue(chain.add_block(b1))
+        mempool.update_main_chain(chain, old_tip)
+        self.assertIn(tx_b.hash(), mempool)
+        # 侧链更长，重组后a1中的交易回到池中，b1中的交易删除
+        old_tip = chain.get_best_tip()
+        self.assertTrue(chain.add_block(mine_block(b1, 3)))
+        mempool.update_main_chain(chain, old_tip)
+        self.assertIn(tx_a.hash(), mempool)
+        self.assertNotIn(tx_b.hash(), mempool)
+
+
+class testBlockTransactions(unittest.TestCase):
+
+    def testMerkleRootChecked(self):
+        chain = BlockChain(EASY_BITS)
+        txs = [new_tx(fee, fee) for fee in range(3)]
+        tip = chain.get_best_tip()
+        bad = mine_block(tip, tip.timestamp + 60)
+        bad.transactions = txs
+        self.assertFalse(chain.add_block(bad))
+        block = Block.deserialize_full(Block(tip.hash(), 0, EASY_BITS, tip.timestamp + 60, tip.height + 1,
+                                             merkle_root([tx.hash() for tx in txs]), txs).serialize_full())
+        self.assertEqual([tx.hash() for tx in block.transactions], [tx.hash() for tx in txs])
+        self.assertTrue(block.check_merkle_root())
+
+    def testOversizedBlockRejected(self):
+        chain = BlockChain(EASY_BITS)
+        tip = chain.get_best_tip()
+        txs = [new_tx(1, nonce) for nonce in range(MAX_BLOCK_TXS + 1)]
+        template = Block(tip.hash(), 0, EASY_BITS, tip.timestamp + 60, tip.height + 1,
+                         merkle_root([tx.hash() for tx in txs]), txs)
+        block = Block(template.prev_hash, mine_nonce_range(template), EASY_BITS, template.timestamp, template.height,
+                      template.merkle_root, txs)
+        self.assertFalse(block.check_size())
+        self.assertFalse(chain.add_block(block))
+        self.assertIsNone(chain.get_status(block.hash()))
+        self.assertTrue(Block(tip.hash(), 0, EASY_BITS, 1, 2, transactions=txs[:MAX_BLOCK_TXS]).check_size())
+
+    def testMinePicksUpNewTransactions(self):
+        # 挖矿过程中交易池变化，模板换成新的merkle_root
+        mempool = Mempool()
+        mempool.add(new_tx(1, 1))
+        prev_block = Block(b'\x22' * 32, nonce=0, bits=EASY_BITS, timestamp=1700000000, height=1)
+        pool = MiningWorkerPool(1, check_interval=1000)
+
+        async def run():
+            task = asyncio.create_task(pool.mine(prev_block, b'\x00' * 4, mempool, refresh_interval=0.01))
+            await asyncio.sleep(0.05)
+            generation = pool.generation.value
+            mempool.add(new_tx(2, 2))
+            await asyncio.sleep(0.05)
+            self.assertGreater(pool.generation.value, generation)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            return await pool.mine(prev_block, EASY_BITS, mempool)
+
+        try:
+            block = asyncio.run(run())
+        finally:
+            pool.close()
+        self.assertEqual(len(block.transactions), 2)
+        self.assertTrue(block.check_merkle_root())
+        self.assertTrue(block.is_validate())
@@ -0,0 +1,90 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from p2p_minner.block_chain import BlockChain
+from p2p_minner.ledger import block_reward
+from p2p_minner.mempool import Mempool
+from p2p_minner.mining_pool import PoolCoordinator, PoolWorker, PoolWorkerSession, parse_address
+from p2p_minner.transaction import Transaction
+from test_block_chian import mine_block
+
+# 大约65536次hash一个区块，份额难度低256倍
+POOL_BITS = bytes.fromhex("1f00ffff")
+
+
+async def wait_for(condition, timeout=20):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise TimeoutError()
+        await asyncio.sleep(0.01)
+
+
+class testMiningPool(unittest.TestCase):
+
+    def setUp(self):
+        self.chain = BlockChain(POOL_BITS)
+        self.mempool = Mempool()
+        self.mempool.add(Transaction('alice', 'bob', 1, 5, 1))
+
+    def run_pool(self, address, worker_count, blocks):
+        coordinator = PoolCoordinator(self.chain, self.mempool, 'miner', share_shift=8, refresh_interval=0.05)
+        start_height = self.chain.get_best_tip().height
+
+        async def run():
+            await coordinator.start(address)
+            workers = [PoolWorker(coordinator.listen_address(), f'w{index}') for index in range(worker_count)]
+            tasks = [asyncio.create_task(worker.run()) for worker in workers]
+            try:
+                await wait_for(lambda: self.chain.get_best_tip().height >= start_height + blocks)
+                # 新的tip同时推送给所有worker
+                tip_hash = self.chain.get_best_tip().hash()
+                await wait_for(lambda: all(worker.job and worker.job[1].prev_hash == tip_hash for worker in workers))
+                return workers, coordinator.stats(), [session.jobs for session in coordinator.sessions.values()]
+            finally:
+                for worker in workers:
+                    worker.stop()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                await coordinator.close()
+
+        return asyncio.run(run())
+
+    def testSharesAndBlocks(self):
+        workers, stats, jobs = self.run_pool('127.0.0.1:0', 2, 2)
+        # 每个worker的extranonce不同，merkle_root也不同
+        extranonces = {job.extranonce for session_jobs in jobs for job in session_jobs.values()}
+        merkle_roots = {job.template.merkle_root for session_jobs in jobs for job in session_jobs.values()}
+        self.assertEqual(len(extranonces), len(merkle_roots))
+        self.assertGreater(sum(worker.accepted_shares for worker in workers), stats['blocks_found'])
+        # 被拒绝的只有新tip推送之前已经在路上的旧任务的份额
+        self.assertLess(sum(worker.rejected_shares for worker in workers), sum(worker.accepted_shares for worker in workers))
+        self.assertGreater(stats['hashrate'], 0)
+        # 区块中有交易池的交易，奖励记到矿池的地址上
+        tip = self.chain.get_best_tip()
+        self.assertTrue(tip.transactions[0].is_coinbase())
+        # 两个worker在同一高度找到的区块只有一个在主链上
+        self.assertEqual(self.chain.ledger.balance('miner'), sum(block_reward(block.height) for block in
+                                                                 self.chain.blocks if block.transactions))
+        self.assertNotIn(Transaction('alice', 'bob', 1, 5, 1).hash(), self.mempool)
+
+    @unittest.skipUnless(hasattr(asyncio, 'start_unix_server'), 'unix socket')
+    def testUnixSocket(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            address = 'unix:' + os.path.join(tmp, 'pool.sock')
+            self.assertEqual(parse_address(address), (None, os.path.join(tmp, 'pool.sock')))
+            self.assertEqual(parse_address('127.0.0.1:3333'), ('127.0.0.1', 3333))
+            workers, stats, _ = self.run_pool(address, 1, 1)
+        self.assertGreaterEqual(stats['blocks_found'], 1)
+        self.assertGreater(workers[0].accepted_shares, 0)
+
+    def testRejectedBlockNotCounted(self):
+        async def reject(block):
+            return False
+
+        coordinator = PoolCoordinator(self.chain, self.mempool, 'miner', on_block=reject)
+        session = PoolWorkerSession(1, None, None)
+        tip = self.chain.get_best_tip()
+        asyncio.run(coordinator.on_block_found(session, mine_block(tip, tip.timestamp + 1)))
+        self.assertEqual((coordinator.blocks_found, session.blocks_found), (0, 0))
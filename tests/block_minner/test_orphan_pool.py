@@ -0,0 +1,73 @@
+import unittest
+
+from p2p_minner.block_chain import Block, BlockChain, BlockTemplate, mine_nonce_range
+from p2p_minner.orphan_pool import OrphanPool
+from p2p_minner.transaction import Transaction
+from test_block_chian import EASY_BITS, mine_block
+
+
+class testOrphanPool(unittest.TestCase):
+
+    def setUp(self):
+        self.chain = BlockChain(EASY_BITS)
+        self.blocks = []
+        prev_block = self.chain.get_best_tip()
+        for timestamp in range(1, 6):
+            prev_block = mine_block(prev_block, timestamp)
+            self.blocks.append(prev_block)
+
+    def testCascadeConnect(self):
+        # 倒序收到，前面的都是孤块
+        for block in reversed(self.blocks[1:]):
+            self.assertFalse(self.chain.add_block(block, peer_id=1))
+        self.assertEqual(len(self.chain.orphan_pool), 4)
+        self.assertTrue(self.chain.add_block(self.blocks[0], peer_id=2))
+        self.assertEqual(self.chain.get_best_tip().hash(), self.blocks[-1].hash())
+        self.assertEqual(len(self.chain.orphan_pool), 0)
+        self.assertEqual(self.chain.orphan_pool.by_parent, {})
+
+    def testCascadeAfterImport(self):
+        self.chain.add_block(self.blocks[2])
+        self.assertTrue(self.chain.import_headers(b''.join(block.serialize() for block in self.blocks[:2]), workers=1))
+        self.assertEqual(self.chain.get_best_tip().hash(), self.blocks[2].hash())
+
+    def testInvalidBlockNotPooled(self):
+        self.assertFalse(self.chain.add_block(Block(b'\x33' * 32, 0, b'\x03\x00\x00\x01', 1, 5)))
+        self.assertEqual(len(self.chain.orphan_pool), 0)
+        # 难度比主链tip低的孤块不放入孤块池
+        easy = BlockTemplate(b'\x33' * 32, 0, bytes.fromhex("207fffff"), 1, 5)
+        self.assertFalse(self.chain.add_block(easy.to_block(mine_nonce_range(easy))))
+        self.assertEqual(len(self.chain.orphan_pool), 0)
+
+    def testByteLimit(self):
+        txs = [Transaction('alice', 'bob', 1, 1, nonce) for nonce in range(10)]
+        blocks = [Block(block.prev_hash, block.nonce, block.bits, block.timestamp, block.height, transactions=txs)
+                  for block in self.blocks]
+        pool = OrphanPool(max_bytes=blocks[0].size() * 2)
+        for block in blocks[:3]:
+            self.assertTrue(pool.add(block, now=100))
+        self.assertNotIn(blocks[0].hash(), pool)
+        self.assertEqual(len(pool), 2)
+        self.assertEqual(pool.total_bytes, blocks[0].size() * 2)
+        pool.pop_children(blocks[1].prev_hash)
+        self.assertEqual(pool.total_bytes, blocks[0].size())
+        self.assertFalse(OrphanPool(max_bytes=100).add(blocks[0]))
+
+    def testLimits(self):
+        pool = OrphanPool(max_blocks=3, max_per_peer=2, max_age=10)
+        self.assertTrue(pool.add(self.blocks[0], peer_id=1, now=100))
+        self.assertFalse(pool.add(self.blocks[0], peer_id=1, now=100))
+        pool.add(self.blocks[1], peer_id=1, now=101)
+        # 节点1超过配额，淘汰它最早的孤块
+        pool.add(self.blocks[2], peer_id=1, now=102)
+        self.assertNotIn(self.blocks[0].hash(), pool)
+        pool.add(self.blocks[3], peer_id=2, now=103)
+        # 超过总数量，淘汰最早的
+        pool.add(self.blocks[4], peer_id=3, now=104)
+        self.assertNotIn(self.blocks[1].hash(), pool)
+        self.assertEqual(len(pool), 3)
+        # 超过max_age的被淘汰
+        pool.expire(now=113)
+        self.assertEqual([block.hash() for block in pool.pop_children(self.blocks[3].hash())], [self.blocks[4].hash()])
+        self.assertEqual(len(pool), 1)
+        self.assertEqual(pool.stats()['evicted'], 3)
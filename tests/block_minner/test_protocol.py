@@ -0,0 +1,49 @@
+import asyncio
+import base64
+import unittest
+
+from p2p_minner.block_chain import Block, BLOCK_BIN_LEN
+from p2p_minner.protocol import Protocol
+from test_block_chian import EASY_BITS
+
+
+class testProtocol(unittest.TestCase):
+
+    def setUp(self):
+        self.blocks = [Block(b'\x11' * 32, nonce, EASY_BITS, 1700000000, 2) for nonce in range(100)]
+        self.data = b''.join(block.serialize() for block in self.blocks)
+
+    def read_messages(self, stream_bytes, count):
+        async def read():
+            reader = asyncio.StreamReader()
+            reader.feed_data(stream_bytes)
+            reader.feed_eof()
+            messages, buffer = [], b''
+            for _ in range(count):
+                message, buffer = await Protocol.deserialize_stream(reader, buffer)
+                messages.append(message)
+            return messages
+
+        return asyncio.run(read())
+
+    def testMixedFrames(self):
+        stream_bytes = Protocol.serialize_message('ping', {'msg': 'a'}) + \
+            Protocol.serialize_binary_message('headers', self.data, request_id=3, start_height=2, tip_height=101) + \
+            Protocol.serialize_binary_message('block', self.blocks[0].serialize()) + \
+            Protocol.serialize_message('pong')
+        ping, headers, block, pong = self.read_messages(stream_bytes, 4)
+        self.assertEqual(ping['payload'], {'msg': 'a'})
+        self.assertEqual(headers['type'], 'headers')
+        self.assertEqual(headers['payload']['request_id'], 3)
+        self.assertEqual(headers['payload']['tip_height'], 101)
+        self.assertEqual(headers['payload']['data'], self.data)
+        self.assertEqual(Block.deserialize(block['payload']['data']).hash(), self.blocks[0].hash())
+        self.assertEqual(pong['type'], 'pong')
+
+    def testBinarySmallerThanJson(self):
+        binary = Protocol.serialize_binary_message('headers', self.data, request_id=1, start_height=2, tip_height=3)
+        json_frame = Protocol.serialize_message('headers', {'request_id': 1, 'start_height': 2, 'tip_height': 3,
+                                                            'headers': base64.b64encode(self.data).decode('utf8')})
+        self.assertLess(len(binary), len(self.data) + 64)
+        self.assertGreater(len(json_frame), len(self.data) * 4 // 3)
+        self.assertEqual(len(self.data), 100 * BLOCK_BIN_LEN)
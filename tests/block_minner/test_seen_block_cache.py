@@ -0,0 +1,21 @@
+import unittest
+
+from p2p_minner.seen_block_cache import SeenBlockCache, SEEN_VALID, SEEN_INVALID, SEEN_CONNECTED
+
+
+class testSeenBlockCache(unittest.TestCase):
+
+    def testHitMissAndEviction(self):
+        cache = SeenBlockCache(capacity=2)
+        self.assertIsNone(cache.get(b'a'))
+        cache.put(b'a', SEEN_VALID)
+        cache.put(b'b', SEEN_INVALID)
+        self.assertEqual(cache.get(b'a'), SEEN_VALID)
+        # b最久没有使用，放入c时被淘汰
+        cache.put(b'c', SEEN_CONNECTED)
+        self.assertIsNone(cache.get(b'b'))
+        self.assertEqual(cache.get(b'c'), SEEN_CONNECTED)
+        self.assertEqual(len(cache), 2)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 2))
+        self.assertEqual(stats['hit_rate'], 0.5)